@@ -1,21 +1,90 @@
 from django import get_version
 from django.contrib import admin
 from django.forms.models import BaseInlineFormSet
+from django.utils.html import format_html
 from django.utils.translation import string_concat
 
-from flag.models import FlaggedContent, FlagInstance
+from flag.models import FlaggedContent, FlagInstance, FlagMail
 from django import forms
 from django.contrib.admin import SimpleListFilter
 from flag import settings as flag_settings
 
 
+# number of pages of flags linked at both ends and on each side of the
+# current page, as in the pagination of the admin changelist
+PAGES_ON_ENDS = 2
+PAGES_ON_EACH_SIDE = 3
+
+
+def get_page_range(page, pages_count):
+    """
+    Return the numbers of the pages of flags to link to from the given page
+    (from 1), with None for each run of pages not linked, like the
+    pagination of the admin changelist: all the pages if there are 10 or
+    fewer
+    """
+    if pages_count <= 10:
+        return range(1, pages_count + 1)
+    page = min(page, pages_count)
+    page_range = []
+    if page > PAGES_ON_EACH_SIDE + PAGES_ON_ENDS + 1:
+        page_range.extend(range(1, PAGES_ON_ENDS + 1))
+        page_range.append(None)
+        page_range.extend(range(page - PAGES_ON_EACH_SIDE, page + 1))
+    else:
+        page_range.extend(range(1, page + 1))
+    if page < pages_count - PAGES_ON_EACH_SIDE - PAGES_ON_ENDS:
+        page_range.extend(range(page + 1, page + PAGES_ON_EACH_SIDE + 1))
+        page_range.append(None)
+        page_range.extend(range(pages_count - PAGES_ON_ENDS + 1,
+                                pages_count + 1))
+    else:
+        page_range.extend(range(page + 1, pages_count + 1))
+    return page_range
+
+
 class FlagInstanceFormSet(BaseInlineFormSet):
+    """
+    Formset for the flags of a flagged content, showing only a page of
+    `per_page` flags (the most recent first), among the ones up to `max_id`
+    (so the flags added later do not shift the pages between the display of
+    the page and the submission of the form)
+    """
+    page = 1
+    per_page = 50
+    max_id = None
+
+    def __init__(self, *args, **kwargs):
+        super(FlagInstanceFormSet, self).__init__(*args, **kwargs)
+        # the same choices for all the forms
+        self.status_choices = self.instance.settings.STATUSES
+
+    def get_queryset(self):
+        if not hasattr(self, '_page_queryset'):
+            queryset = super(FlagInstanceFormSet, self).get_queryset()
+            if self.max_id is not None:
+                queryset = queryset.filter(id__lte=self.max_id)
+            start = (self.page - 1) * self.per_page
+            self._page_queryset = self._queryset = \
+                queryset.select_related('user').order_by('-id')[
+                    start:start + self.per_page]
+        return self._page_queryset
+
+    def clean(self):
+        """
+        Refuse the submitted flags which are not in the page anymore (some
+        flags were deleted since it was displayed), instead of ignoring them
+        """
+        super(FlagInstanceFormSet, self).clean()
+        if any(form.instance.pk is None for form in self.initial_forms):
+            raise forms.ValidationError(
+                'The flags changed since the page was displayed, please '
+                'reload it.')
+
     def _construct_form(self, i, **kwargs):
         form = super(FlagInstanceFormSet, self)._construct_form(i, **kwargs)
-        content_object = form.instance.flagged_content.content_object
-        choices = flag_settings.get_for_model(content_object, 'STATUSES')
         form.fields['status'] = forms.ChoiceField(label="Status",
-                                                  choices=choices)
+                                                  choices=self.status_choices)
         return form
 
 
@@ -24,15 +93,51 @@ class InlineFlagInstance(admin.TabularInline):
     model = FlagInstance
     extra = 0
     raw_id_fields = ('user', )
+    # number of flags by page, and name of the GET parameter for the page
+    per_page = 50
+    page_var = 'flags_page'
+    # name of the parameter (in the page links and the form) with the id of
+    # the most recent flag of the pages
+    max_id_var = 'flags_max_id'
+
+    def get_page(self, request):
+        """
+        Return the page of flags asked in the request (the first by default)
+        """
+        try:
+            return max(int(request.GET.get(self.page_var, 1)), 1)
+        except ValueError:
+            return 1
+
+    def get_max_id(self, request, obj):
+        """
+        Return the id of the most recent flag of the pages: the one sent with
+        the request, else the one of the last flag of `obj`
+        """
+        try:
+            return int(request.POST.get(self.max_id_var) or
+                       request.GET.get(self.max_id_var))
+        except (TypeError, ValueError):
+            if obj is None:
+                return None
+            return FlagInstance.objects.filter(flagged_content=obj) \
+                .order_by('-id').values_list('id', flat=True).first()
+
+    def get_formset(self, request, obj=None, **kwargs):
+        formset = super(InlineFlagInstance, self).get_formset(request, obj,
+                                                              **kwargs)
+        formset.page = self.get_page(request)
+        formset.per_page = self.per_page
+        formset.max_id = self.get_max_id(request, obj)
+        return formset
 
 
 class FlaggedContentForm(forms.ModelForm):
 
     def __init__(self, *args, **kwargs):
         super(FlaggedContentForm, self).__init__(*args, **kwargs)
-        content_object = self.instance.content_object
-        if content_object is not None:
-            choices = flag_settings.get_for_model(content_object, 'STATUSES')
+        if self.instance.content_type_id is not None:
+            choices = self.instance.settings.STATUSES
             self.fields['status'] = forms.ChoiceField(label="Status",
                                                       choices=choices)
 
@@ -41,37 +146,49 @@ class FlaggedContentForm(forms.ModelForm):
         fields = '__all__'
 
 
+# the labels of the statuses, with the settings they were computed from
+_status_labels = {}
+
+
+def get_status_labels():
+    """
+    Return a dict with the label of each status defined in the STATUSES
+    settings, globally or for a model (if many labels exist for a status,
+    they are joined with " | "). Computed again only if these settings are
+    replaced
+    """
+    sources = _status_labels.get('sources')
+    if sources is None or sources[0] is not flag_settings.STATUSES or \
+            sources[1] is not flag_settings.MODELS_SETTINGS:
+        sources = (flag_settings.STATUSES, flag_settings.MODELS_SETTINGS)
+        all_choices = [flag_settings.STATUSES] + [
+            model['STATUSES'] for model in
+            flag_settings.MODELS_SETTINGS.values() if 'STATUSES' in model]
+        labels = {}
+        for choices in all_choices:
+            for status, label in choices:
+                if label not in labels.setdefault(status, []):
+                    labels[status].append(label)
+        for status, status_labels in labels.items():
+            label = status_labels[0]
+            for _label in status_labels[1:]:
+                label = string_concat(label, u' | ', _label)
+            labels[status] = label
+        _status_labels['sources'] = sources
+        _status_labels['labels'] = labels
+    return _status_labels['labels']
+
+
 class StatusFilter(SimpleListFilter):
     title = 'status' # or use _('country') for translated title
     parameter_name = 'status'
 
     def lookups(self, request, model_admin):
-        model_settings = flag_settings.MODELS_SETTINGS
-        statuses = set([s.status for s in model_admin.model.objects.all()])
-        filters = []
-
-        def get_from_choices(choices):
-            for choice in choices:
-                if status == choice[0]:
-                    labels.append(choice[1])
-
-        for status in statuses:
-            labels = []
-            get_from_choices(flag_settings.STATUSES)
-
-            for model_name in model_settings:
-                model = model_settings[model_name]
-                if 'STATUSES' in model:
-                    get_from_choices(model['STATUSES'])
-            if labels:
-                label = labels[0]
-                if len(labels) > 1:
-                    for _label in labels[1:]:
-                        label = string_concat(label, u' | ', _label)
-            else:
-                label = status
-            filters.append((status, label))
-        return filters
+        statuses = model_admin.model.objects.order_by().values_list(
+            'status', flat=True).distinct()
+        labels = get_status_labels()
+        return [(status, labels.get(status, status))
+                for status in sorted(statuses)]
 
     def queryset(self, request, queryset):
         if self.value():
@@ -83,8 +200,9 @@ class StatusFilter(SimpleListFilter):
 class FlaggedContentAdmin(admin.ModelAdmin):
     form = FlaggedContentForm
     inlines = [InlineFlagInstance]
-    list_display = ('id', '__unicode__', 'get_status', 'count')
-    list_display_links = ('id', '__unicode__')
+    list_display = ('id', 'get_content', 'get_content_object', 'get_status',
+                    'count', 'get_creator', 'get_moderator', 'when_updated')
+    list_display_links = ('id', 'get_content')
     list_filter = (StatusFilter,)
     readonly_fields = ('content_type', 'object_id')
     raw_id_fields = ('creator', 'moderator')
@@ -102,10 +220,134 @@ class FlaggedContentAdmin(admin.ModelAdmin):
                   'count',
                   'moderator')
 
+    def get_queryset(self, request):
+        """
+        Get the related objects and the flagged objects with the rows, to
+        display them without a query for each row (the flagged objects are
+        fetched with one query by content type)
+        """
+        queryset = super(FlaggedContentAdmin, self).get_queryset(request)
+        return queryset.select_related('content_type', 'creator',
+                                       'moderator') \
+                       .prefetch_related('content_object')
+
+    def get_readonly_fields(self, request, obj=None):
+        """
+        The `count` field is read-only if it is not saved by the form (with
+        the 'trigger' and 'cache' COUNTER_ENGINE settings)
+        """
+        readonly_fields = super(FlaggedContentAdmin,
+                                self).get_readonly_fields(request, obj)
+        if flag_settings.COUNTER_ENGINE != 'db':
+            readonly_fields = tuple(readonly_fields) + ('count',)
+        return readonly_fields
+
+    def get_actions(self, request):
+        """
+        Add an action to set each status to the selected flagged contents,
+        if the actions are not disabled (`actions = None`, popups)
+        """
+        actions = super(FlaggedContentAdmin, self).get_actions(request)
+        if not actions:
+            return actions
+        for status, label in sorted(get_status_labels().items()):
+            name = 'set_status_%s' % status
+            actions[name] = (self._set_status_action(status), name,
+                             string_concat(u'Set status: ', label))
+        return actions
+
+    def _set_status_action(self, status):
+        """
+        Return an action setting the given status to the selected flagged
+        contents and to their flags, with `bulk_set_status`
+        """
+        def set_status(model_admin, request, queryset):
+            count = FlaggedContent.objects.bulk_set_status(queryset, status,
+                                                           request.user)
+            model_admin.message_user(request, u'%s flagged content(s) updated'
+                                              % count)
+        return set_status
+
+    def render_change_form(self, request, context, add=False, change=False,
+                           form_url='', obj=None):
+        """
+        Add the summary of the flags of the content, and the links to the
+        pages of its flags (see `get_page_range`, with the `max_id` of the
+        formset of flags, also sent by the form), to the context of the
+        change form
+        """
+        if obj is not None:
+            summary = obj.get_flags_summary()
+            for inline_admin_formset in context.get('inline_admin_formsets',
+                                                    []):
+                inline = inline_admin_formset.opts
+                if not isinstance(inline, InlineFlagInstance):
+                    continue
+                formset = inline_admin_formset.formset
+                pages_count = max(-(-summary['total'] // formset.per_page), 1)
+                query = request.GET.copy()
+                if formset.max_id is not None:
+                    query[inline.max_id_var] = formset.max_id
+                pages = []
+                for number in get_page_range(formset.page, pages_count):
+                    if number is None:
+                        pages.append((None, None))
+                        continue
+                    query[inline.page_var] = number
+                    pages.append((number, '?%s' % query.urlencode()))
+                context.update(flags_page=formset.page, flags_pages=pages,
+                               flags_max_id_var=inline.max_id_var,
+                               flags_max_id=formset.max_id)
+                break
+            context['flags_summary'] = summary
+        return super(FlaggedContentAdmin, self).render_change_form(
+            request, context, add, change, form_url, obj)
+
+    def get_content(self, obj):
+        return u'%s.%s #%s' % (obj.content_type.app_label,
+                               obj.content_type.model, obj.object_id)
+
+    get_content.short_description = 'Flagged content'
+    get_content.admin_order_field = 'id'
+
+    def get_content_object(self, obj):
+        content_object = obj.content_object
+        if content_object is None:
+            return u'-'
+        url = obj.get_content_object_admin_url()
+        if url:
+            return format_html(u'<a href="{0}">{1}</a>', url, content_object)
+        return content_object
+
+    get_content_object.short_description = 'Object'
+
     def get_status(self, obj):
         return obj.get_status_display()
 
     get_status.short_description = 'Status'
+    get_status.admin_order_field = 'status'
+
+    def get_creator(self, obj):
+        return obj.creator or u'-'
+
+    get_creator.short_description = 'Creator'
+    get_creator.admin_order_field = 'creator'
+
+    def get_moderator(self, obj):
+        return obj.moderator or u'-'
+
+    get_moderator.short_description = 'Moderator'
+    get_moderator.admin_order_field = 'moderator'
 
 
 admin.site.register(FlaggedContent, FlaggedContentAdmin)
+
+
+class FlagMailAdmin(admin.ModelAdmin):
+    list_display = ('id', 'subject', 'when_added', 'next_try', 'tries',
+                    'failed')
+    list_filter = ('failed',)
+    raw_id_fields = ('flag_instance',)
+
+
+admin.site.register(FlagMail, FlagMailAdmin)
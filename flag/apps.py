@@ -0,0 +1,32 @@
+from django.apps import AppConfig
+from django.core import checks
+from django.core.signals import request_started
+from django.db.models.signals import post_migrate
+
+
+class FlagConfig(AppConfig):
+    name = 'flag'
+    verbose_name = 'Flag'
+
+    def ready(self):
+        """
+        Compile the settings of all flaggable models, forget the known
+        content types when some may have been created, register the check of
+        the count triggers, and start the mail workers at the first request
+        if wanted (so not in the processes of the management commands like
+        `migrate` or `shell`)
+        """
+        from flag import settings as flag_settings
+        from flag.triggers import check_triggers
+        from flag.utils import clear_content_type_cache
+        flag_settings.compile_models_settings()
+        post_migrate.connect(lambda **kwargs: clear_content_type_cache(),
+                             weak=False,
+                             dispatch_uid='flag_clear_content_type_cache')
+        checks.register(check_triggers)
+
+        if flag_settings.SEND_MAILS_OUTBOX and \
+                flag_settings.SEND_MAILS_OUTBOX_WORKERS:
+            from flag.mails import start_workers_on_request
+            request_started.connect(start_workers_on_request,
+                                    dispatch_uid='flag_start_workers')
@@ -0,0 +1,246 @@
+"""
+Benchmarks of the write and read paths of flags, run by the `flag_benchmark`
+management command (in the `testproject`, on SQLite, or in any project).
+Each benchmark runs an operation `iterations` times, and reports its
+throughput, its p50/p99 latencies and its number of queries.
+The data (users flagging and flagged, flags) are created in a transaction
+which is rolled back at the end, so the database is left untouched. The
+flagged objects are users, and all models can be flagged during the run.
+"""
+import math
+import platform
+import time
+from datetime import timedelta
+
+import django
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
+from django.core.urlresolvers import reverse, NoReverseMatch
+from django.db import connection, reset_queries, transaction
+from django.template import Context, Template
+from django.test.client import Client
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.utils import timezone
+
+from flag.forms import get_default_form
+from flag.models import FlaggedContent, FlagInstance
+from flag.views import reverse_flag_url
+
+# the settings used by all the benchmarks (the same as the default ones,
+# without limits, trust and mails), updated by each benchmark
+BASE_SETTINGS = dict(
+    FLAG_MODELS=None,
+    FLAG_ALLOW_COMMENTS=True,
+    FLAG_LIMIT_SAME_OBJECT_FOR_USER=0,
+    FLAG_LIMIT_FOR_OBJECT=0,
+    FLAG_RATE_LIMIT=None,
+    FLAG_NEEDS_TRUST=False,
+    FLAG_SEND_MAILS=False,
+    EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+    # the host of the requests of the test client
+    ALLOWED_HOSTS=['testserver'],
+)
+
+# the template of the list page, and the same with the `prefetch_flags`
+# templatetag
+LIST_PAGE_TEMPLATE = """{% load flag_tags %}
+{% for object in objects %}
+    {{ object|flag_count }} {{ object|flag_status:"full" }}
+    {{ object|can_be_flagged_by:user }}
+{% endfor %}"""
+LIST_PAGE_PREFETCH_TEMPLATE = LIST_PAGE_TEMPLATE.replace(
+    '{% load flag_tags %}', '{% load flag_tags %}{% prefetch_flags objects %}')
+
+# password of the users logged in for the views
+PASSWORD = 'flag-benchmark'
+
+
+def percentile(values, percent):
+    """
+    Return the given percentile of the given sorted values (nearest rank)
+    """
+    if not values:
+        return None
+    index = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[max(index, 0)]
+
+
+def measure(operation, iterations):
+    """
+    Call `operation(index)` `iterations` times, and return a dict with the
+    throughput, the latencies (in milliseconds) and the number of queries
+    """
+    timings = []
+    queries = 0
+    for index in range(iterations):
+        # else the queries are not counted once the log of the connection
+        # is full
+        reset_queries()
+        with CaptureQueriesContext(connection) as context:
+            start = time.time()
+            operation(index)
+            timings.append(time.time() - start)
+        queries += len(context.captured_queries)
+    total = sum(timings)
+    timings.sort()
+    return dict(
+        iterations=iterations,
+        total_seconds=total,
+        ops_per_second=iterations / total if total else None,
+        mean_ms=total * 1000 / iterations,
+        p50_ms=percentile(timings, 50) * 1000,
+        p99_ms=percentile(timings, 99) * 1000,
+        queries_per_op=float(queries) / iterations,
+    )
+
+
+class BenchmarkData(object):
+    """
+    The users and objects used by the benchmarks
+    """
+
+    def __init__(self, nb_objects, nb_users):
+        # old enough to be trusted
+        date_joined = timezone.now() - timedelta(days=365)
+        self.objects = [User.objects.create(
+            username='flag-benchmark-object-%d' % index,
+            date_joined=date_joined) for index in range(nb_objects)]
+        self.users = [User.objects.create(
+            username='flag-benchmark-user-%d' % index,
+            date_joined=date_joined) for index in range(nb_users)]
+        self.user = User.objects.create_user('flag-benchmark-flagger',
+                                             password=PASSWORD)
+        self.user.date_joined = date_joined
+        self.user.save()
+        self.superuser = User.objects.create_superuser(
+            'flag-benchmark-admin', 'flag-benchmark@example.com', PASSWORD)
+
+    def get_pair(self, index):
+        """
+        Return the user and the object of the flag of the given iteration:
+        the same user never flags the same object twice, as long as there
+        are less iterations than users * objects
+        """
+        nb_objects = len(self.objects)
+        return (self.users[(index // nb_objects) % len(self.users)],
+                self.objects[index % nb_objects])
+
+
+def _add(data):
+    # each benchmark flags objects never flagged
+    FlaggedContent.objects.filter(
+        content_type=ContentType.objects.get_for_model(User),
+        object_id__in=[content_object.pk for content_object in data.objects]
+    ).delete()
+
+    def operation(index):
+        user, content_object = data.get_pair(index)
+        FlagInstance.objects.add(user, content_object, comment='benchmark',
+                                 send_mails=True)
+    return operation
+
+
+def _render_list_page(data, template):
+    template = Template(template)
+
+    def operation(index):
+        # new objects, without the prefetched flags of the previous rendering
+        objects = list(User.objects.filter(
+            pk__in=[content_object.pk for content_object in data.objects]))
+        template.render(Context({'objects': objects, 'user': data.user}))
+    return operation
+
+
+def _post_flag(data):
+    url = reverse_flag_url('flag_content')
+    client = Client()
+    client.login(username=data.user.username, password=PASSWORD)
+    forms_data = [dict(get_default_form(content_object).initial,
+                       comment='benchmark', next='/')
+                  for content_object in data.objects]
+
+    def operation(index):
+        response = client.post(url, forms_data[index % len(forms_data)])
+        if response.status_code not in (200, 302):
+            raise AssertionError('The flag view returned a %d status code'
+                                 % response.status_code)
+    return operation
+
+
+def _admin_changelist(data):
+    url = reverse('admin:flag_flaggedcontent_changelist')
+    client = Client()
+    client.login(username=data.superuser.username, password=PASSWORD)
+
+    def operation(index):
+        response = client.get(url)
+        if response.status_code != 200:
+            raise AssertionError('The admin changelist returned a %d status '
+                                 'code' % response.status_code)
+    return operation
+
+
+# the benchmarks: name, settings, and function returning the operation to run
+# for each iteration
+BENCHMARKS = [
+    ('add', {}, _add),
+    ('add_limits', dict(FLAG_LIMIT_SAME_OBJECT_FOR_USER=1,
+                        FLAG_LIMIT_FOR_OBJECT=1000000),
+     _add),
+    ('add_trust', dict(FLAG_NEEDS_TRUST=True, FLAG_TRUST_TIME=3),
+     _add),
+    ('add_mails', dict(FLAG_SEND_MAILS=True,
+                       FLAG_SEND_MAILS_TO=['flag-benchmark@example.com'],
+                       FLAG_SEND_MAILS_RULES=[(1, 1)]),
+     _add),
+    ('list_page', {},
+     lambda data: _render_list_page(data, LIST_PAGE_TEMPLATE)),
+    ('list_page_prefetch', {},
+     lambda data: _render_list_page(data, LIST_PAGE_PREFETCH_TEMPLATE)),
+    ('flag_view', {}, _post_flag),
+    ('admin_changelist', {}, _admin_changelist),
+]
+BENCHMARKS_NAMES = [name for name, _settings, _func in BENCHMARKS]
+
+
+def run_benchmarks(iterations=200, nb_objects=50, nb_users=50, names=None,
+                   label=None):
+    """
+    Run the benchmarks with the given names (all by default), and return a
+    dict with their results by name, and the environment of the run.
+    A benchmark which cannot be run in this project (no url for a view, or
+    an ImproperlyConfigured error) gets a `skipped` result with the error,
+    and the next ones are run. Any other error is raised
+    """
+    results = {}
+    with transaction.atomic():
+        with override_settings(**BASE_SETTINGS):
+            data = BenchmarkData(nb_objects, nb_users)
+        for name, settings, func in BENCHMARKS:
+            if names is not None and name not in names:
+                continue
+            with override_settings(**dict(BASE_SETTINGS, **settings)):
+                try:
+                    # a savepoint, to roll back the changes of a skipped
+                    # benchmark
+                    with transaction.atomic():
+                        results[name] = measure(func(data), iterations)
+                except (NoReverseMatch, ImproperlyConfigured), e:
+                    results[name] = dict(skipped='%s: %s' % (
+                        e.__class__.__name__, e))
+                mail.outbox = []
+        transaction.set_rollback(True)
+
+    return dict(
+        label=label,
+        date=timezone.now().isoformat(),
+        django_version=django.get_version(),
+        python_version=platform.python_version(),
+        database=connection.vendor,
+        iterations=iterations,
+        objects=nb_objects,
+        users=nb_users,
+        results=results,
+    )
@@ -0,0 +1,199 @@
+"""
+Write-behind counters of flags, used with the 'cache' COUNTER_ENGINE settings
+The flags added to an object are counted in the cache (see `increment`), and
+added to the `count` field of its FlaggedContent object by `flush_counter`,
+when COUNTER_FLUSH_THRESHOLD flags are waiting, or by `flush_counters` (the
+`flag_flush_counters` management command) for all the objects.
+The objects with flags waiting are listed in a log kept in the cache, so
+`flush_counters` does not have to look at all of them.
+The counts are not exact if a process is stopped at the wrong time: the flags
+counted in the cache for an object are not added to its `count` field if the
+cache loses them, or if the process flushing them is stopped between the
+`decr` in the cache and the UPDATE. A log entry not written because the
+process adding it was stopped is given up after LOG_MAX_WAITS flushes, and
+the flags waiting for its object are then only added to the `count` field
+when COUNTER_FLUSH_THRESHOLD are waiting. The flags themselves are always
+saved.
+"""
+from django.core.cache import caches
+from django.db import models
+from django.utils import timezone
+
+from flag import settings as flag_settings
+
+# prefix of the keys with the number of flags waiting for an object
+KEY_PREFIX = 'flag:count:'
+# key with the number of entries in the log of objects with flags waiting,
+# and the one with the number of entries already flushed
+LOG_KEY = 'flag:count-log'
+FLUSHED_KEY = 'flag:count-log-flushed'
+# key with the first entry of the log not written yet, and the number of
+# flushes which have waited for it
+WAITING_KEY = 'flag:count-log-waiting'
+# number of flushes waiting for an entry of the log before giving it up
+LOG_MAX_WAITS = 3
+# seconds during which only one process can flush the counter of an object
+LOCK_TIMEOUT = 30
+
+
+def is_enabled():
+    """
+    Return True if the flags are counted in the cache
+    """
+    return flag_settings.COUNTER_ENGINE == 'cache'
+
+
+def get_cache():
+    """
+    Return the cache used for the counters (see the COUNTER_CACHE settings)
+    """
+    return caches[flag_settings.COUNTER_CACHE]
+
+
+def _key(flagged_content_id):
+    return '%s%s' % (KEY_PREFIX, flagged_content_id)
+
+
+def _incr(cache, key, delta=1):
+    """
+    Increment the value of `key`, created (without expiration) if needed
+    """
+    cache.add(key, 0, None)
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        # removed from the cache in between
+        cache.add(key, 0, None)
+        return cache.incr(key, delta)
+
+
+def _log(cache, flagged_content_id):
+    """
+    Add the given FlaggedContent id to the log of objects with flags waiting
+    The entry is written after its index is taken, so `flush_counters` can
+    find an index without its entry for a short time
+    """
+    index = _incr(cache, LOG_KEY)
+    cache.set('%s:%d' % (LOG_KEY, index), flagged_content_id, None)
+
+
+def increment(flagged_content_id):
+    """
+    Count a new flag for the given FlaggedContent id, and flush its counter
+    if COUNTER_FLUSH_THRESHOLD flags are waiting.
+    Return the number of flags still waiting, and the number of flags just
+    added to the `count` field by the flush
+    """
+    cache = get_cache()
+    pending = _incr(cache, _key(flagged_content_id))
+    if pending == 1:
+        # no flags were waiting: add the object to the log
+        _log(cache, flagged_content_id)
+    flushed = 0
+    if pending >= flag_settings.COUNTER_FLUSH_THRESHOLD:
+        flushed = flush_counter(flagged_content_id)
+    return pending - flushed, flushed
+
+
+def get_pending(flagged_content_id):
+    """
+    Return the number of flags waiting for the given FlaggedContent id
+    """
+    return get_cache().get(_key(flagged_content_id)) or 0
+
+
+def get_pending_many(flagged_content_ids):
+    """
+    Return a dict with the number of flags waiting for each of the given
+    FlaggedContent ids, with one request to the cache
+    """
+    flagged_content_ids = list(flagged_content_ids)
+    values = get_cache().get_many([_key(flagged_content_id) for
+                                   flagged_content_id in flagged_content_ids])
+    return dict((flagged_content_id,
+                 values.get(_key(flagged_content_id)) or 0)
+                for flagged_content_id in flagged_content_ids)
+
+
+def attach_pending(flagged_contents):
+    """
+    Get the number of flags waiting for all the given FlaggedContent objects
+    at once, and store it on them (see `FlaggedContent.pending_count`)
+    """
+    flagged_contents = [flagged_content for flagged_content in
+                        flagged_contents if flagged_content.id is not None]
+    pending = get_pending_many(flagged_content.id for flagged_content in
+                               flagged_contents)
+    for flagged_content in flagged_contents:
+        flagged_content._pending_count = pending[flagged_content.id]
+
+
+def discard(flagged_content_ids):
+    """
+    Forget the flags waiting for the given FlaggedContent ids, when their
+    `count` field was computed again from their flags (their entries in the
+    log are then flushed without any update)
+    """
+    get_cache().delete_many([_key(flagged_content_id) for
+                             flagged_content_id in flagged_content_ids])
+
+
+def flush_counter(flagged_content_id):
+    """
+    Add the flags waiting for the given FlaggedContent id to its `count`
+    field (and update its `when_updated` field), unless another process is
+    already doing it.
+    Return the number of flags added
+    """
+    from flag.models import FlaggedContent
+
+    cache = get_cache()
+    lock_key = '%s:lock' % _key(flagged_content_id)
+    if not cache.add(lock_key, 1, LOCK_TIMEOUT):
+        return 0
+    try:
+        pending = cache.get(_key(flagged_content_id)) or 0
+        if not pending:
+            return 0
+        if cache.decr(_key(flagged_content_id), pending) > 0:
+            # flags counted in between are kept, for the next flush
+            _log(cache, flagged_content_id)
+        FlaggedContent.objects.filter(id=flagged_content_id).update(
+            count=models.F('count') + pending,
+            when_updated=timezone.now())
+        return pending
+    finally:
+        cache.delete(lock_key)
+
+
+def flush_counters():
+    """
+    Flush the counters of all the objects with flags waiting.
+    The log is only consumed up to its first entry not written yet, which is
+    read again by the next flushes (given up after LOG_MAX_WAITS of them).
+    Return the number of flags added to the `count` fields
+    """
+    cache = get_cache()
+    last = cache.get(LOG_KEY) or 0
+    first = (cache.get(FLUSHED_KEY) or 0) + 1
+    if first > last:
+        return 0
+    keys = ['%s:%d' % (LOG_KEY, index) for index in range(first, last + 1)]
+    entries = cache.get_many(keys)
+
+    flushed = first - 1
+    waiting = cache.get(WAITING_KEY)
+    for index, key in enumerate(keys, first):
+        if key not in entries:
+            waits = waiting[1] + 1 if waiting and waiting[0] == index else 1
+            if waits < LOG_MAX_WAITS:
+                cache.set(WAITING_KEY, (index, waits), None)
+                break
+            # never written
+        flushed = index
+    cache.set(FLUSHED_KEY, flushed, None)
+    cache.delete_many(keys[:flushed - first + 1])
+
+    # the entries after the missing one are flushed now, and again later
+    return sum(flush_counter(flagged_content_id)
+               for flagged_content_id in set(entries.values()))
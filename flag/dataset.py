@@ -0,0 +1,285 @@
+"""
+Generation of a synthetic dataset of flags, used by the `flag_generate_data`
+management command, to run the benchmarks and test the indexes at a
+realistic scale.
+The number of flags of the flagged contents follows a Zipf distribution (a
+few viral contents, and a long tail), and the rows are inserted with
+`bulk_create`, by chunks, each in a transaction. The same seed gives the same
+dataset.
+The flagged objects are not created: each FlaggedContent gets a new
+`object_id` for its model. The users flagging them are created once, and
+used again by the next runs.
+"""
+import math
+import random
+from bisect import bisect_right
+from collections import Counter
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.management.color import no_style
+from django.db import connections, router, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from flag import settings as flag_settings
+from flag import triggers
+from flag.models import FlaggedContent, FlagInstance, FlagUserCount
+from flag.utils import get_content_type_id
+
+# prefix of the usernames of the users created to flag the contents
+USERNAME_PREFIX = 'flag-data-user-'
+
+# words of the comments
+WORDS = ('spam', 'offensive', 'fake', 'this', 'is', 'not', 'allowed', 'here',
+         'please', 'remove', 'content', 'again', 'abuse', 'the', 'user',
+         'posted', 'a', 'link', 'to', 'scam', 'website', 'and', 'it')
+
+
+@contextmanager
+def _without_auto_dates():
+    """
+    Let the generated dates be saved by `bulk_create`, instead of the current
+    date set by the `auto_now` and `auto_now_add` fields
+    """
+    fields = [FlaggedContent._meta.get_field('when_updated'),
+              FlagInstance._meta.get_field('when_added')]
+    saved = [(field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, (auto_now, auto_now_add) in zip(fields, saved):
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+def parse_weights(value):
+    """
+    Return a list of `(key, weight)` tuples from a "key:weight,key:weight"
+    string (the weight is optional, default to 1)
+    """
+    result = []
+    for item in value.split(','):
+        key, _sep, weight = item.strip().rpartition(':')
+        if not key:
+            key, weight = weight, 1
+        result.append((key, float(weight)))
+    return result
+
+
+class WeightedChoice(object):
+    """
+    Choose a value from a list of `(value, weight)` tuples, with a random
+    number generator
+    """
+
+    def __init__(self, choices):
+        self.values = [value for value, weight in choices]
+        self.cumulated = []
+        total = 0
+        for value, weight in choices:
+            total += weight
+            self.cumulated.append(total)
+        if not total:
+            raise ValueError('The sum of the weights must be positive')
+
+    def __call__(self, rng):
+        index = bisect_right(self.cumulated, rng.random() * self.cumulated[-1])
+        return self.values[min(index, len(self.values) - 1)]
+
+
+class DataGenerator(object):
+    """
+    Generate `nb_contents` FlaggedContent objects with about `nb_flags`
+    flags in total, by `nb_users` users, with:
+    - `models`: a list of `("app_label.model_name", weight)` tuples, the
+      models of the flagged contents
+    - `zipf`: the exponent of the Zipf distribution of the number of flags by
+      content (the content of rank `r` gets flags proportionally to
+      `1 / r ** zipf`), each content having at least one flag
+    - `flags_per_user`: the number of flags of a user on a content (if there
+      are enough users)
+    - `comment_length`: the mean length of the comments (exponential
+      distribution), not longer than `comment_max_length` (0 for no comments)
+    - `statuses`: a list of `(status, weight)` tuples, the statuses of the
+      contents, also given to their flags (as done by `bulk_set_status`).
+      By default, 90% of DEFAULT_STATUS, and the other STATUSES for the rest
+    - `days`: the flags are added in the last `days` days
+    - `seed`: the seed of the random number generator
+    - `chunk_size`: the number of flags inserted in a transaction
+    """
+
+    def __init__(self, nb_contents, nb_flags, nb_users, models, zipf=1.1,
+                 flags_per_user=1, comment_length=80, comment_max_length=1000,
+                 statuses=None, days=365, seed=42, chunk_size=10000):
+        self.nb_contents = nb_contents
+        self.nb_flags = max(nb_flags, nb_contents)
+        self.nb_users = nb_users
+        self.zipf = zipf
+        self.flags_per_user = max(flags_per_user, 1)
+        self.comment_length = comment_length
+        self.comment_max_length = comment_max_length
+        self.days = days
+        self.chunk_size = chunk_size
+        self.rng = random.Random(seed)
+
+        self.choose_model = WeightedChoice([(get_content_type_id(model),
+                                             weight)
+                                            for model, weight in models])
+        if statuses is None:
+            others = [status for status, label in flag_settings.STATUSES
+                      if status != flag_settings.DEFAULT_STATUS]
+            statuses = [(flag_settings.DEFAULT_STATUS,
+                         0.9 if others else 1)] + \
+                [(status, 0.1 / len(others)) for status in others]
+        self.choose_status = WeightedChoice(statuses)
+
+        self.using = router.db_for_write(FlaggedContent)
+        self.text = ' '.join(self.rng.choice(WORDS) for index in
+                             range(comment_max_length // 2 + 1))
+
+    def get_users_ids(self):
+        """
+        Return the ids of `nb_users` users, created if needed
+        """
+        User = get_user_model()
+        users = User._default_manager.db_manager(self.using).filter(
+            username__startswith=USERNAME_PREFIX)
+        existing = users.count()
+        if existing < self.nb_users:
+            # without random numbers, to generate the same flags when the
+            # users already exist
+            now = timezone.now()
+            User._default_manager.db_manager(self.using).bulk_create([
+                User(username='%s%d' % (USERNAME_PREFIX, index),
+                     password='!', date_joined=now - timedelta(
+                         days=index % (3 * self.days + 1)))
+                for index in range(existing, self.nb_users)])
+        return list(users.order_by('pk').values_list(
+            'pk', flat=True)[:self.nb_users])
+
+    def get_nb_flags(self, rank, total_weight):
+        """
+        Return the number of flags of the content of the given rank (from 1)
+        """
+        expected = self.nb_flags * rank ** -self.zipf / total_weight
+        nb_flags = int(expected)
+        if self.rng.random() < expected - nb_flags:
+            nb_flags += 1
+        return max(nb_flags, 1)
+
+    def get_comment(self):
+        if not self.comment_length:
+            return None
+        length = min(int(self.rng.expovariate(1.0 / self.comment_length)),
+                     self.comment_max_length)
+        start = self.rng.randint(0, len(self.text) - length)
+        return self.text[start:start + length]
+
+    def _next_id(self, model):
+        return (model._default_manager.db_manager(self.using).aggregate(
+            max_id=Max('id'))['max_id'] or 0) + 1
+
+    def _insert(self, contents, flags, users_counts):
+        with transaction.atomic(using=self.using):
+            FlaggedContent.objects.db_manager(self.using).bulk_create(
+                contents)
+            FlagInstance.objects.db_manager(self.using).bulk_create(flags)
+            FlagUserCount.objects.db_manager(self.using).bulk_create(
+                users_counts)
+
+    def generate(self, progress=None):
+        """
+        Insert the rows, calling `progress(result)` after each chunk if
+        given. Return a dict with the number of `users`, `contents`, `flags`
+        and `users_counts` (FlagUserCount objects)
+        """
+        users_ids = self.get_users_ids()
+        result = dict(users=len(users_ids), contents=0, flags=0,
+                      users_counts=0)
+        if not users_ids:
+            return result
+
+        content_id = self._next_id(FlaggedContent)
+        flag_id = self._next_id(FlagInstance)
+        user_count_id = self._next_id(FlagUserCount)
+        objects_ids = {}
+        now = timezone.now()
+        # with the triggers, the counts are kept by the database
+        keep_counts = not triggers.is_enabled()
+
+        # the viral contents get random ids
+        ranks = range(1, self.nb_contents + 1)
+        self.rng.shuffle(ranks)
+        total_weight = sum(rank ** -self.zipf for rank in ranks)
+
+        contents, flags, users_counts = [], [], []
+        with _without_auto_dates():
+            for rank in ranks:
+                content_type_id = self.choose_model(self.rng)
+                if content_type_id not in objects_ids:
+                    objects_ids[content_type_id] = FlaggedContent.objects. \
+                        db_manager(self.using).filter(
+                            content_type_id=content_type_id).aggregate(
+                            max_id=Max('object_id'))['max_id'] or 0
+                objects_ids[content_type_id] += 1
+                status = self.choose_status(self.rng)
+                nb_flags = self.get_nb_flags(rank, total_weight)
+                nb_flaggers = min(len(users_ids), int(math.ceil(
+                    float(nb_flags) / self.flags_per_user)))
+                flaggers = self.rng.sample(users_ids, nb_flaggers)
+
+                dates = sorted(now - timedelta(
+                    seconds=self.rng.random() * self.days * 86400)
+                    for index in range(nb_flags))
+                for index, when_added in enumerate(dates):
+                    flags.append(FlagInstance(
+                        id=flag_id, flagged_content_id=content_id,
+                        user_id=flaggers[index % nb_flaggers],
+                        when_added=when_added, comment=self.get_comment(),
+                        status=status))
+                    flag_id += 1
+                for user_id, count in Counter(
+                        flaggers[index % nb_flaggers]
+                        for index in range(nb_flags)).items():
+                    users_counts.append(FlagUserCount(
+                        id=user_count_id, flagged_content_id=content_id,
+                        user_id=user_id, count=count))
+                    user_count_id += 1
+                contents.append(FlaggedContent(
+                    id=content_id, content_type_id=content_type_id,
+                    object_id=objects_ids[content_type_id], status=status,
+                    count=nb_flags if keep_counts and
+                    status == flag_settings.DEFAULT_STATUS else 0,
+                    when_updated=dates[-1]))
+                content_id += 1
+
+                if len(flags) >= self.chunk_size:
+                    self._insert(contents, flags, users_counts)
+                    result['contents'] += len(contents)
+                    result['flags'] += len(flags)
+                    result['users_counts'] += len(users_counts)
+                    contents, flags, users_counts = [], [], []
+                    if progress is not None:
+                        progress(result)
+
+            if contents:
+                self._insert(contents, flags, users_counts)
+                result['contents'] += len(contents)
+                result['flags'] += len(flags)
+                result['users_counts'] += len(users_counts)
+
+        # the ids were given, update the sequences of the database
+        connection = connections[self.using]
+        statements = connection.ops.sequence_reset_sql(
+            no_style(), [FlaggedContent, FlagInstance, FlagUserCount])
+        if statements:
+            cursor = connection.cursor()
+            try:
+                for statement in statements:
+                    cursor.execute(statement)
+            finally:
+                cursor.close()
+        return result
@@ -3,7 +3,8 @@ __all__ = ('FlagException',
            'ContentAlreadyFlaggedByUserException',
            'ContentFlaggedEnoughException',
            'FlagCommentException',
-           'FlagUserNotTrustedException')
+           'FlagUserNotTrustedException',
+           'FlagRateLimitException')
 
 
 class FlagException(Exception):
@@ -59,3 +60,11 @@ class FlagUserNotTrustedException(FlagException):
     see FlagInstance.can_creator_be_trusted() for details
     """
     pass
+
+
+class FlagRateLimitException(FlagException):
+    """
+    Exception raised when a user try to flag an object while the number of
+    its flags on objects of the same model raised the RATE_LIMIT
+    """
+    pass
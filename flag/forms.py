@@ -1,3 +1,4 @@
+import hmac
 import time
 from hashlib import sha1
 
@@ -5,11 +6,83 @@ from django import forms
 from django.utils.translation import ugettext_lazy as _
 from django.forms.utils import ErrorDict
 from django.utils.crypto import salted_hmac, constant_time_compare
+from django.utils.encoding import force_bytes
 from django.conf import settings
 
 from flag import settings as flag_settings
 
 
+# max age, in seconds, of the timestamp of a flag form
+SECURITY_TIMESTAMP_MAX_AGE = 2 * 60 * 60
+# salt of the key of the HMAC security hash
+SECURITY_KEY_SALT = "flag.forms.SecurityForm"
+
+
+def generate_security_hash(content_type, object_pk, timestamp):
+    """
+    Generate the HMAC security hash of a flag form from the provided info
+    (all strings)
+    """
+    info = (content_type, object_pk, timestamp)
+    value = "-".join(info)
+    return salted_hmac(SECURITY_KEY_SALT, value).hexdigest()
+
+
+class SecurityDataGenerator(object):
+    """
+    Generate the security data of the flag forms of many objects (the same
+    as `SecurityForm.generate_security_data`), with the same timestamp and
+    the key of the HMAC derived only once. To use for one request.
+    """
+
+    def __init__(self, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self.timestamp = str(int(timestamp))
+        # as done by `salted_hmac` for each hash
+        self.key = sha1(force_bytes(SECURITY_KEY_SALT) +
+                        force_bytes(settings.SECRET_KEY)).digest()
+
+    def generate(self, content_object):
+        """
+        Return a dict with the security data for the given object
+        """
+        content_type = str(content_object._meta)
+        object_pk = str(content_object._get_pk_val())
+        value = "-".join((content_type, object_pk, self.timestamp))
+        return {
+            'content_type': content_type,
+            'object_pk': object_pk,
+            'timestamp': self.timestamp,
+            'security_hash': hmac.new(self.key, msg=force_bytes(value),
+                                      digestmod=sha1).hexdigest(),
+        }
+
+    def generate_many(self, content_objects):
+        """
+        Return a list with the security data of each given object
+        """
+        return [self.generate(content_object)
+                for content_object in content_objects]
+
+
+def check_security_data(content_type, object_pk, timestamp, security_hash):
+    """
+    Return True if the given security hash and timestamp (as sent by a flag
+    form) are valid for the given content type and object pk, without
+    building the form
+    """
+    try:
+        if time.time() - int(timestamp) > SECURITY_TIMESTAMP_MAX_AGE:
+            return False
+    except (TypeError, ValueError):
+        return False
+    expected_hash = generate_security_hash(unicode(content_type),
+                                           unicode(object_pk),
+                                           unicode(timestamp))
+    return constant_time_compare(expected_hash, unicode(security_hash))
+
+
 class SecurityForm(forms.Form):
     """
     Handles the security aspects (anti-spoofing) for comment forms.
@@ -61,7 +134,7 @@ class SecurityForm(forms.Form):
     def clean_timestamp(self):
         """Make sure the timestamp isn't too far (> 2 hours) in the past."""
         ts = self.cleaned_data["timestamp"]
-        if time.time() - ts > (2 * 60 * 60):
+        if time.time() - ts > SECURITY_TIMESTAMP_MAX_AGE:
             raise forms.ValidationError("Timestamp check failed")
         return ts
 
@@ -93,10 +166,7 @@ class SecurityForm(forms.Form):
         """
         Generate a HMAC security hash from the provided info.
         """
-        info = (content_type, object_pk, timestamp)
-        key_salt = "flag.forms.SecurityForm"
-        value = "-".join(info)
-        return salted_hmac(key_salt, value).hexdigest()
+        return generate_security_hash(content_type, object_pk, timestamp)
 
     def _generate_security_hash_old(self, content_type, object_pk, timestamp):
         """Generate a (SHA1) security hash from the provided info."""
@@ -0,0 +1,232 @@
+"""
+Sending of the mails stored in the outbox (see the SEND_MAILS_OUTBOX settings)
+and of the digests (see the SEND_MAILS_DIGEST settings)
+The `flag_dispatch_mail` management command and the worker threads both use
+`flush_digests` and `dispatch_mails`
+"""
+import logging
+import threading
+from collections import OrderedDict
+from uuid import uuid4
+
+from django.contrib.sites.models import Site
+from django.core.mail import get_connection
+from django.core.signals import request_started
+from django.db import connections, transaction
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from flag import settings as flag_settings
+from flag.models import FlagMail, FlagDigestEntry
+from flag.utils import get_content_type_tuple
+
+logger = logging.getLogger('flag.mails')
+
+# the running worker threads
+_workers = []
+_workers_lock = threading.Lock()
+# set to wake the workers when a mail is stored, or to stop them
+_wake = threading.Event()
+_stop = threading.Event()
+
+
+def dispatch_mails(batch_size=100, connection=None):
+    """
+    Send at most `batch_size` mails of the outbox, all with the same mail
+    `connection` (a new one from `get_connection` by default).
+    The sent mails are removed from the outbox, the others will be sent again
+    later.
+    Return the number of sent and failed mails
+    """
+    mails = FlagMail.objects.claim(batch_size)
+    if not mails:
+        return 0, 0
+
+    if connection is None:
+        connection = get_connection()
+    try:
+        connection.open()
+    except Exception, e:
+        for mail in mails:
+            mail.retry_later(e)
+        return 0, len(mails)
+
+    sent_ids = []
+    failed = 0
+    try:
+        for mail in mails:
+            try:
+                connection.send_messages([mail.get_message(connection)])
+            except Exception, e:
+                mail.retry_later(e)
+                failed += 1
+            else:
+                sent_ids.append(mail.id)
+    finally:
+        connection.close()
+
+    FlagMail.objects.filter(id__in=sent_ids).delete()
+    return len(sent_ids), failed
+
+
+def _render_digest(recipient, entries):
+    """
+    Return the subject and the body of the digest for the given entries
+    """
+    objects = []
+    by_flagged_content = {}
+    for entry in entries:
+        flagged_content = entry.flagged_content
+        if flagged_content.id not in by_flagged_content:
+            app_label, model_name = get_content_type_tuple(
+                flagged_content.content_type_id)
+            by_flagged_content[flagged_content.id] = dict(
+                flagged_content=flagged_content,
+                app_label=app_label,
+                model_name=model_name,
+                object_id=flagged_content.object_id,
+                object=flagged_content.content_object,
+                count=flagged_content.current_count,
+                object_url=flagged_content.get_content_object_absolute_url(),
+                object_admin_url=flagged_content. \
+                    get_content_object_admin_url(),
+                flags=0,
+                untrusted=0,
+                flaggers=[])
+            objects.append(by_flagged_content[flagged_content.id])
+        data = by_flagged_content[flagged_content.id]
+        data['untrusted' if entry.untrusted else 'flags'] += 1
+        if entry.user not in data['flaggers']:
+            data['flaggers'].append(entry.user)
+
+    context = dict(
+        recipient=recipient,
+        objects=objects,
+        flags_count=sum(data['flags'] for data in objects),
+        untrusted_count=sum(data['untrusted'] for data in objects),
+        site=Site.objects.get_current(),
+    )
+    subject = render_to_string('flag/digest_mail_subject.txt', context)
+    subject = subject.replace("\n", " ").replace("\r", " ")
+    message = render_to_string('flag/digest_mail_body.txt', context)
+    return subject, message
+
+
+def flush_digests():
+    """
+    Store in the outbox a digest for each recipient with flags waiting for
+    their digest and for which the SEND_MAILS_DIGEST_WINDOW delay (of the
+    flagged model) is over, or one for each SEND_MAILS_FROM settings of the
+    flagged models.
+    Return the number of digests stored
+    """
+    now = timezone.now()
+    # the earliest due first, each one once
+    recipients = OrderedDict.fromkeys(
+        FlagDigestEntry.objects.filter(due_at__lte=now).order_by('due_at')
+        .values_list('recipient', flat=True))
+    count = 0
+    for recipient in recipients:
+        with transaction.atomic():
+            # mark the entries, if not already done by another worker
+            token = uuid4().hex
+            if not FlagDigestEntry.objects.filter(
+                    recipient=recipient, due_at__lte=now, claim='').update(
+                    claim=token):
+                continue
+            entries = FlagDigestEntry.objects.filter(claim=token) \
+                .select_related('flagged_content', 'user') \
+                .prefetch_related('flagged_content__content_object') \
+                .order_by('id')
+            by_from_email = OrderedDict()
+            for entry in entries:
+                from_email = flag_settings.get_for_content_type(
+                    entry.flagged_content.content_type_id).SEND_MAILS_FROM
+                by_from_email.setdefault(from_email, []).append(entry)
+            for from_email, from_entries in by_from_email.items():
+                subject, message = _render_digest(recipient, from_entries)
+                FlagMail.objects.enqueue(
+                    subject=subject,
+                    message=message,
+                    from_email=from_email,
+                    recipient_list=[recipient])
+            FlagDigestEntry.objects.filter(claim=token).delete()
+        count += len(by_from_email)
+    return count
+
+
+class MailWorker(threading.Thread):
+    """
+    A thread sending the mails of the outbox: a batch is sent as soon as it
+    is stored (see `wake_workers`) or every `interval` seconds
+    """
+
+    def __init__(self, batch_size=100, interval=30):
+        super(MailWorker, self).__init__(name='flag-mail-worker')
+        self.daemon = True
+        self.batch_size = batch_size
+        self.interval = interval
+
+    def run(self):
+        while not _stop.is_set():
+            try:
+                flush_digests()
+                sent, failed = dispatch_mails(self.batch_size)
+            except Exception:
+                logger.exception('Unable to dispatch the flag mails')
+                sent, failed = 0, 0
+            finally:
+                # each thread has its own connections
+                connections.close_all()
+            if sent + failed < self.batch_size:
+                # outbox empty: wait for a new mail
+                _wake.wait(self.interval)
+                _wake.clear()
+
+
+def start_workers(count=None, batch_size=100, interval=30):
+    """
+    Start `count` (default to the SEND_MAILS_OUTBOX_WORKERS settings) worker
+    threads, if not already started
+    """
+    if count is None:
+        count = flag_settings.SEND_MAILS_OUTBOX_WORKERS
+    with _workers_lock:
+        if _workers:
+            return
+        _stop.clear()
+        for i in range(count):
+            worker = MailWorker(batch_size, interval)
+            worker.start()
+            _workers.append(worker)
+
+
+def start_workers_on_request(**kwargs):
+    """
+    Start the worker threads at the first request of the process: connected
+    to the `request_started` signal by the app if the
+    SEND_MAILS_OUTBOX_WORKERS settings is set
+    """
+    request_started.disconnect(start_workers_on_request,
+                               dispatch_uid='flag_start_workers')
+    start_workers()
+
+
+def stop_workers(timeout=None):
+    """
+    Stop the worker threads, and wait for them to end
+    """
+    with _workers_lock:
+        _stop.set()
+        _wake.set()
+        for worker in _workers:
+            worker.join(timeout)
+        del _workers[:]
+
+
+def wake_workers():
+    """
+    Tell the worker threads, if any, that a mail is in the outbox
+    """
+    if _workers:
+        _wake.set()
@@ -0,0 +1,59 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from flag.benchmarks import run_benchmarks, BENCHMARKS_NAMES
+
+
+class Command(BaseCommand):
+    help = "Measure the throughput, latencies and queries of the flag write " \
+           "and read paths (in a transaction rolled back at the end)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmarks', nargs='*',
+                            help='Names of the benchmarks to run (all by '
+                                 'default): %s' % ', '.join(BENCHMARKS_NAMES))
+        parser.add_argument('--iterations', type=int, default=200,
+                            help='Number of operations of each benchmark')
+        parser.add_argument('--objects', type=int, default=50,
+                            help='Number of flagged objects')
+        parser.add_argument('--users', type=int, default=50,
+                            help='Number of users flagging the objects')
+        parser.add_argument('--label', default=None,
+                            help='Label of the run, kept in the JSON output '
+                                 '(a version...)')
+        parser.add_argument('--output', default=None,
+                            help='File to write the results to, in JSON')
+
+    def handle(self, **options):
+        names = options['benchmarks'] or None
+        unknown = set(names or []) - set(BENCHMARKS_NAMES)
+        if unknown:
+            raise CommandError('Unknown benchmark(s): %s' %
+                               ', '.join(sorted(unknown)))
+        if options['iterations'] < 1 or options['objects'] < 1 or \
+                options['users'] < 1:
+            raise CommandError('iterations, objects and users must be '
+                               'positive')
+
+        report = run_benchmarks(options['iterations'], options['objects'],
+                                options['users'], names, options['label'])
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2, sort_keys=True)
+
+        if int(options['verbosity']) > 0:
+            self.stdout.write('%-20s %10s %10s %10s %10s' % (
+                'benchmark', 'ops/s', 'p50 (ms)', 'p99 (ms)', 'queries'))
+            for name in BENCHMARKS_NAMES:
+                result = report['results'].get(name)
+                if result is None:
+                    continue
+                if 'skipped' in result:
+                    self.stdout.write('%-20s skipped: %s' % (
+                        name, result['skipped']))
+                    continue
+                self.stdout.write('%-20s %10.1f %10.2f %10.2f %10.1f' % (
+                    name, result['ops_per_second'] or 0, result['p50_ms'],
+                    result['p99_ms'], result['queries_per_op']))
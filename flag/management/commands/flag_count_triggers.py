@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from flag.triggers import install_triggers, remove_triggers
+
+
+class Command(BaseCommand):
+    help = "Install the database triggers maintaining the flags counts (see " \
+           "FLAG_COUNTER_ENGINE), and compute again all the counts"
+    # the system checks fail while the triggers are missing
+    requires_system_checks = False
+
+    def add_arguments(self, parser):
+        parser.add_argument('--remove', action='store_true', default=False,
+                            help='Remove the triggers instead')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+                            help='The database to use')
+
+    def handle(self, **options):
+        connection = connections[options['database']]
+        if options['remove']:
+            remove_triggers(connection)
+            message = 'Triggers removed'
+        else:
+            install_triggers(connection)
+            message = 'Triggers installed'
+
+        if int(options['verbosity']) > 0:
+            self.stdout.write(message)
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from flag.mails import dispatch_mails, flush_digests
+
+
+class Command(BaseCommand):
+    help = "Send the mails stored in the outbox (see FLAG_SEND_MAILS_OUTBOX) " \
+           "and the digests (see FLAG_SEND_MAILS_DIGEST)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of mails sent with one connection')
+        parser.add_argument('--loop', action='store_true', default=False,
+                            help='Do not stop when the outbox is empty, but '
+                                 'check it again every `interval` seconds')
+        parser.add_argument('--interval', type=int, default=30,
+                            help='Seconds to wait when the outbox is empty '
+                                 '(with --loop)')
+
+    def handle(self, **options):
+        batch_size = options['batch_size']
+        total_sent = total_failed = 0
+        while True:
+            flush_digests()
+            sent, failed = dispatch_mails(batch_size)
+            total_sent += sent
+            total_failed += failed
+            if sent + failed < batch_size:
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+
+        if int(options['verbosity']) > 0:
+            self.stdout.write('%d mail(s) sent, %d failed' % (
+                total_sent, total_failed))
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from flag.counters import flush_counters
+
+
+class Command(BaseCommand):
+    help = "Add the flags counted in the cache to the count of the flagged " \
+           "contents (see FLAG_COUNTER_ENGINE)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', default=False,
+                            help='Do not stop, but flush the counters again '
+                                 'every `interval` seconds')
+        parser.add_argument('--interval', type=int, default=10,
+                            help='Seconds to wait between two flushes '
+                                 '(with --loop)')
+
+    def handle(self, **options):
+        total = 0
+        while True:
+            total += flush_counters()
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+        if int(options['verbosity']) > 0:
+            self.stdout.write('%d flag(s) added to the counts' % total)
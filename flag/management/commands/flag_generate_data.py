@@ -0,0 +1,96 @@
+import time
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from flag import settings as flag_settings
+from flag.dataset import DataGenerator, parse_weights
+
+
+class Command(BaseCommand):
+    help = "Fill the database with a synthetic dataset of flagged contents " \
+           "and flags, with a Zipf distribution of the flags by content"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--contents', type=int, default=10000,
+                            help='Number of flagged contents')
+        parser.add_argument('--flags', type=int, default=100000,
+                            help='Approximate number of flags')
+        parser.add_argument('--users', type=int, default=1000,
+                            help='Number of users flagging the contents '
+                                 '(created if needed)')
+        parser.add_argument('--models', default=None,
+                            help='Models of the flagged contents, with '
+                                 'optional weights: "auth.user:3,app.model:1"'
+                                 ' (default to the FLAG_MODELS settings, or '
+                                 'auth.user)')
+        parser.add_argument('--zipf', type=float, default=1.1,
+                            help='Exponent of the Zipf distribution of the '
+                                 'flags by content')
+        parser.add_argument('--flags-per-user', type=int, default=1,
+                            help='Number of flags of a user on a content')
+        parser.add_argument('--comment-length', type=int, default=80,
+                            help='Mean length of the comments (0 for no '
+                                 'comments)')
+        parser.add_argument('--comment-max-length', type=int, default=1000,
+                            help='Max length of the comments')
+        parser.add_argument('--statuses', default=None,
+                            help='Statuses of the contents, with weights: '
+                                 '"1:90,2:5,5:5" (default to 90%% of '
+                                 'FLAG_DEFAULT_STATUS)')
+        parser.add_argument('--days', type=int, default=365,
+                            help='The flags are added in the last `days` '
+                                 'days')
+        parser.add_argument('--seed', type=int, default=42,
+                            help='Seed of the random number generator')
+        parser.add_argument('--chunk-size', type=int, default=10000,
+                            help='Number of flags inserted in a transaction')
+
+    def handle(self, **options):
+        models = options['models']
+        if models is None:
+            models = ','.join(flag_settings.MODELS or ['auth.user'])
+        if options['contents'] < 1 or options['users'] < 1 or \
+                options['chunk_size'] < 1:
+            raise CommandError('contents, users and chunk-size must be '
+                               'positive')
+        try:
+            models = parse_weights(models)
+            for model, weight in models:
+                apps.get_model(model)
+        except (ValueError, LookupError), e:
+            raise CommandError('Invalid models: %s' % e)
+        try:
+            statuses = options['statuses']
+            if statuses is not None:
+                statuses = [(int(status), weight) for status, weight in
+                            parse_weights(statuses)]
+            generator = DataGenerator(
+                options['contents'], options['flags'], options['users'],
+                models, zipf=options['zipf'],
+                flags_per_user=options['flags_per_user'],
+                comment_length=options['comment_length'],
+                comment_max_length=options['comment_max_length'],
+                statuses=statuses, days=options['days'],
+                seed=options['seed'], chunk_size=options['chunk_size'])
+        except (ValueError, ZeroDivisionError), e:
+            raise CommandError('Invalid parameters: %s' % e)
+
+        verbosity = int(options['verbosity'])
+        start = time.time()
+
+        def progress(result):
+            if verbosity > 1:
+                self.stdout.write('%(contents)d contents, %(flags)d flags'
+                                  % result)
+
+        result = generator.generate(progress)
+        if verbosity > 0:
+            duration = time.time() - start
+            self.stdout.write(
+                '%d contents, %d flags and %d user counts created in %.1fs '
+                '(%d flags/s), by %d users' % (
+                    result['contents'], result['flags'],
+                    result['users_counts'], duration,
+                    result['flags'] / duration if duration else 0,
+                    result['users']))
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flag', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FlagMail',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('subject', models.TextField()),
+                ('message', models.TextField()),
+                ('from_email', models.CharField(max_length=254, blank=True)),
+                ('recipients', models.TextField()),
+                ('when_added', models.DateTimeField(auto_now_add=True)),
+                ('next_try', models.DateTimeField(db_index=True)),
+                ('tries', models.PositiveSmallIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('failed', models.BooleanField(default=False)),
+                ('claim', models.CharField(db_index=True, max_length=32, blank=True)),
+                ('flag_instance', models.ForeignKey(related_name='mails', on_delete=django.db.models.deletion.SET_NULL, blank=True, to='flag.FlagInstance', null=True)),
+            ],
+            options={
+                'ordering': ('next_try', 'id'),
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('flag', '0002_flagmail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FlagDigestEntry',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('recipient', models.CharField(max_length=254)),
+                ('untrusted', models.BooleanField(default=False)),
+                ('when_added', models.DateTimeField(auto_now_add=True)),
+                ('due_at', models.DateTimeField(db_index=True)),
+                ('claim', models.CharField(db_index=True, max_length=32, blank=True)),
+                ('flagged_content', models.ForeignKey(related_name='digest_entries', to='flag.FlaggedContent')),
+                ('user', models.ForeignKey(related_name='flag_digest_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ('due_at', 'id'),
+            },
+        ),
+    ]
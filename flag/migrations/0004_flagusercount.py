@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.conf import settings
+
+
+def fill_user_counts(apps, schema_editor):
+    """
+    Create the FlagUserCount objects from the existing flags
+    """
+    FlagInstance = apps.get_model('flag', 'FlagInstance')
+    FlagUserCount = apps.get_model('flag', 'FlagUserCount')
+    db_alias = schema_editor.connection.alias
+
+    counts = FlagInstance.objects.using(db_alias).order_by().values_list(
+        'flagged_content', 'user').annotate(models.Count('id'))
+    user_counts = []
+    for flagged_content_id, user_id, count in counts.iterator():
+        user_counts.append(FlagUserCount(flagged_content_id=flagged_content_id,
+                                         user_id=user_id,
+                                         count=count))
+        if len(user_counts) >= 1000:
+            FlagUserCount.objects.using(db_alias).bulk_create(user_counts)
+            user_counts = []
+    FlagUserCount.objects.using(db_alias).bulk_create(user_counts)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('flag', '0003_flagdigestentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FlagUserCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('flagged_content', models.ForeignKey(related_name='user_counts', to='flag.FlaggedContent')),
+                ('user', models.ForeignKey(related_name='flag_counts', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='flagusercount',
+            unique_together=set([('flagged_content', 'user')]),
+        ),
+        migrations.RunPython(fill_user_counts, migrations.RunPython.noop),
+    ]
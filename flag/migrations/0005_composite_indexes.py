@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flag', '0004_flagusercount'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='flaginstance',
+            name='when_added',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='flagdigestentry',
+            index_together=set([('recipient', 'due_at')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='flaggedcontent',
+            index_together=set([('creator', 'status'), ('status', 'when_updated')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='flaginstance',
+            index_together=set([('flagged_content', 'user'), ('flagged_content', 'when_added')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='flagmail',
+            index_together=set([('failed', 'next_try')]),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flag', '0005_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='flaggedcontent',
+            index_together=set([('when_updated', 'id'), ('content_type', 'status', 'when_updated', 'id'), ('status', 'when_updated', 'id'), ('creator', 'status')]),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def install_triggers(apps, schema_editor):
+    """
+    Install the triggers maintaining the flags counts, only if the
+    COUNTER_ENGINE settings is 'trigger'
+    """
+    from flag import triggers
+    if not triggers.is_enabled() or \
+            not triggers.triggers_supported(schema_editor.connection):
+        return
+    triggers.install_triggers(
+        schema_editor.connection,
+        flagged_content_model=apps.get_model('flag', 'FlaggedContent'),
+        flag_instance_model=apps.get_model('flag', 'FlagInstance'))
+
+
+def remove_triggers(apps, schema_editor):
+    """
+    Remove the triggers maintaining the flags counts, if installed
+    """
+    from flag import triggers
+    triggers.remove_triggers(
+        schema_editor.connection,
+        flagged_content_model=apps.get_model('flag', 'FlaggedContent'),
+        flag_instance_model=apps.get_model('flag', 'FlagInstance'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flag', '0006_moderation_queue_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(install_triggers, remove_triggers),
+    ]
@@ -1,20 +1,27 @@
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.fields import GenericForeignKey
-from django.db import models
+from django.db import (models, connections, router, transaction,
+                       IntegrityError)
 from django.core import urlresolvers
 from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext_lazy as _, ungettext
-from django.core.mail import send_mail
+from django.core.mail import send_mail, EmailMessage
 from django.template.loader import render_to_string
 from django.contrib.sites.models import Site
 from django.utils.encoding import force_unicode
+from django.utils import timezone
+from django.core.cache import caches
 
+from datetime import datetime, timedelta
 from importlib import import_module
+from uuid import uuid4
+
 from flag import settings as flag_settings
-from flag import signals
+from flag import counters, ratelimit, signals, triggers
 from flag.exceptions import *
-from flag.utils import get_content_type_tuple
+from flag.utils import (get_content_type_tuple, get_content_type_id,
+                        get_content_type_ids)
 
 try:
     line = flag_settings.TRUST_EVAL_FUNC
@@ -24,6 +31,65 @@ try:
 except (ImportError, IndexError), e:
     from flag.utils import can_user_be_trusted
 
+# prefix of the keys with the trust of a user (see TRUST_CACHE_TIMEOUT)
+TRUST_KEY_PREFIX = 'flag:trust:'
+
+
+def are_users_trusted(users):
+    """
+    Return a dict with, for the pk of each given user, True if it can be
+    trusted. The users not in the cache (see TRUST_CACHE_TIMEOUT) are
+    evaluated all at once by the TRUST_EVAL_BATCH_FUNC function if any, else
+    one by one by the TRUST_EVAL_FUNC one
+    """
+    by_pk = dict((user.pk, user) for user in users)
+    timeout = flag_settings.TRUST_CACHE_TIMEOUT
+    result = {}
+    if timeout:
+        cache = caches[flag_settings.TRUST_CACHE]
+        cached = cache.get_many(['%s%s' % (TRUST_KEY_PREFIX, pk)
+                                 for pk in by_pk])
+        for pk in by_pk:
+            key = '%s%s' % (TRUST_KEY_PREFIX, pk)
+            if key in cached:
+                result[pk] = cached[key]
+
+    missing = [user for pk, user in by_pk.items() if pk not in result]
+    if missing:
+        if flag_settings.TRUST_EVAL_BATCH_FUNC:
+            path, func = flag_settings.TRUST_EVAL_BATCH_FUNC.rsplit('.', 1)
+            trusted = getattr(import_module(path), func)(missing)
+        else:
+            trusted = dict((user.pk, can_user_be_trusted(user))
+                           for user in missing)
+        for user in missing:
+            result[user.pk] = bool(trusted.get(user.pk))
+        if timeout:
+            cache.set_many(dict(('%s%s' % (TRUST_KEY_PREFIX, user.pk),
+                                 result[user.pk]) for user in missing),
+                           timeout)
+    return result
+
+
+def is_user_trusted(user):
+    """
+    Return True if the given user can be trusted (see `are_users_trusted`)
+    """
+    return are_users_trusted([user])[user.pk]
+
+
+# name of the attribute used to store prefetched FlaggedContent objects on
+# the flagged objects (see `FlaggedContentManager.get_for_objects`)
+PREFETCH_ATTRIBUTE = '_flagged_content_prefetched'
+
+# format of the date in the cursors of the moderation queue (UTC)
+MODERATION_CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+# seconds during which a mail claimed by a worker is not returned to another
+FLAG_MAIL_LEASE = 300
+# seconds before the first retry of a mail of the outbox not sent
+FLAG_MAIL_RETRY_DELAY = 60
+
 
 class FlaggedContentManager(models.Manager):
     """
@@ -74,6 +140,417 @@ class FlaggedContentManager(models.Manager):
             defaults=defaults)
         return flagged_content, created
 
+    def in_bulk_for_keys(self, keys):
+        """
+        Return, in one query, a dict with the FlaggedContent objects for the
+        given `(content_type_id, object_id)` keys (only existing ones)
+        """
+        by_content_type = {}
+        for content_type_id, object_id in keys:
+            by_content_type.setdefault(content_type_id, []).append(object_id)
+        if not by_content_type:
+            return {}
+        query = models.Q()
+        for content_type_id, objects_ids in by_content_type.items():
+            query |= models.Q(content_type_id=content_type_id,
+                              object_id__in=objects_ids)
+        return dict(((flagged_content.content_type_id,
+                      flagged_content.object_id), flagged_content)
+                    for flagged_content in self.filter(query).order_by())
+
+    def get_for_objects(self, content_objects, user=None):
+        """
+        Get, in one query, the FlaggedContent objects for all the given
+        objects, and if a `user` is given, the number of flags of this user
+        on each of them in another query.
+        The result is stored on each object, to be used by
+        `get_prefetched_for_object` (and so by the template filters)
+        instead of making new queries (see the `prefetch_flags`
+        templatetag).
+        Return a dict with `(content_type_id, object_id)` as keys and the
+        FlaggedContent objects as values (only for objects with flags)
+        """
+        content_objects = [content_object for content_object in
+                           content_objects
+                           if content_object is not None and
+                           content_object.pk is not None]
+        keys = [(ContentType.objects.get_for_model(content_object).id,
+                 content_object.pk) for content_object in content_objects]
+        result = self.in_bulk_for_keys(keys)
+
+        if result and user is not None and user.is_authenticated():
+            counts = FlagUserCount.objects.get_counts(
+                [flagged_content.id for flagged_content in result.values()],
+                user.pk)
+            for flagged_content in result.values():
+                flagged_content.flags_count_by_user = {
+                    user.pk: counts.get(flagged_content.id, 0)}
+
+        if counters.is_enabled():
+            counters.attach_pending(result.values())
+
+        for key, content_object in zip(keys, content_objects):
+            flagged_content = result.get(key)
+            if flagged_content is not None:
+                # we already have it, avoid loading it again
+                flagged_content.content_object = content_object
+            setattr(content_object, PREFETCH_ATTRIBUTE, flagged_content)
+
+        return result
+
+    def get_prefetched_for_object(self, content_object):
+        """
+        Same as `get_for_object` but use the FlaggedContent object prefetched
+        by `get_for_objects` if any
+        """
+        try:
+            flagged_content = getattr(content_object, PREFETCH_ATTRIBUTE)
+        except AttributeError:
+            return self.get_for_object(content_object)
+        if flagged_content is None:
+            raise self.model.DoesNotExist
+        return flagged_content
+
+    def moderation_queue(self, status=None, model=None, after=None,
+                         limit=50):
+        """
+        Return a page of the moderation queue: at most `limit` FlaggedContent
+        objects, with the given `status` (all if None) and for the given
+        `model` (all if None, see `utils.get_content_type_tuple` for the
+        accepted values), the most recently updated first, with their
+        `content_type` and `creator`.
+        `after` is the cursor returned with the previous page. It is used for
+        a keyset pagination on `(when_updated, id)`, so each page is read with
+        one indexed query, whatever its position in the queue.
+        Return a tuple with the list of objects and the cursor of the next
+        page (None if it's the last one)
+        Raise a ValueError if the cursor is invalid
+        """
+        queryset = self.select_related('content_type', 'creator')
+        if status is not None:
+            queryset = queryset.filter(status=status)
+        if model is not None:
+            queryset = queryset.filter(
+                content_type=get_content_type_id(model))
+        if after:
+            when_updated, last_id = self._parse_moderation_cursor(after)
+            queryset = queryset.filter(
+                models.Q(when_updated__lt=when_updated) |
+                models.Q(id__lt=last_id),
+                when_updated__lte=when_updated)
+
+        flagged_contents = list(
+            queryset.order_by('-when_updated', '-id')[:limit + 1])
+        next_cursor = None
+        if len(flagged_contents) > limit:
+            flagged_contents = flagged_contents[:limit]
+            next_cursor = self.moderation_cursor(flagged_contents[-1])
+        if counters.is_enabled():
+            counters.attach_pending(flagged_contents)
+        return flagged_contents, next_cursor
+
+    def moderation_cursor(self, flagged_content):
+        """
+        Return the cursor to use in `moderation_queue` to get the objects
+        after the given one
+        """
+        when_updated = flagged_content.when_updated
+        if timezone.is_aware(when_updated):
+            when_updated = when_updated.astimezone(timezone.utc)
+        return '%s.%s' % (when_updated.strftime(MODERATION_CURSOR_FORMAT),
+                          flagged_content.id)
+
+    def _parse_moderation_cursor(self, cursor):
+        """
+        Return the `when_updated` and `id` values stored in a cursor returned
+        by `moderation_cursor`
+        """
+        when_updated, last_id = cursor.split('.')
+        when_updated = datetime.strptime(when_updated,
+                                         MODERATION_CURSOR_FORMAT)
+        if settings.USE_TZ:
+            when_updated = timezone.make_aware(when_updated, timezone.utc)
+        return when_updated, int(last_id)
+
+    def get_or_create_for_keys(self, statuses):
+        """
+        Get or create the FlaggedContent objects for many objects at once.
+        `statuses` is a dict with `(content_type_id, object_id)` tuples as
+        keys, and the status to use if the FlaggedContent object is created
+        as values (None for the default one).
+        Return a dict with the same keys and FlaggedContent objects as values
+        """
+        result = self.in_bulk_for_keys(statuses.keys())
+        missing = [key for key in statuses if key not in result]
+        if missing:
+            default_status = self.model._meta.get_field('status'). \
+                get_default()
+            try:
+                with transaction.atomic(using=self.db):
+                    self.bulk_create([self.model(
+                        content_type_id=content_type_id,
+                        object_id=object_id,
+                        status=statuses[(content_type_id, object_id)] or
+                            default_status)
+                        for content_type_id, object_id in missing])
+            except IntegrityError:
+                # some were created in the meantime
+                for content_type_id, object_id in missing:
+                    self.get_or_create(
+                        content_type_id=content_type_id,
+                        object_id=object_id,
+                        defaults=dict(
+                            status=statuses[(content_type_id, object_id)] or
+                                default_status))
+            result.update(self.in_bulk_for_keys(missing))
+        return result
+
+    def bulk_update_after_flags(self, flagged_contents):
+        """
+        Save, in one query, the `count`, `status` and `moderator` fields of the
+        given FlaggedContent objects, after flags were added by `bulk_add`
+        (`count` is incremented by the difference with `previous_count`),
+        and update their `when_updated` field.
+        """
+        if not flagged_contents:
+            return
+        now = timezone.now()
+        updates = dict(when_updated=now)
+
+        whens = [models.When(id=flagged_content.id, then=models.Value(
+                    flagged_content.count - flagged_content.previous_count))
+                 for flagged_content in flagged_contents
+                 if flagged_content.count != flagged_content.previous_count]
+        if whens and not triggers.is_enabled():
+            updates['count'] = models.F('count') + models.Case(
+                *whens, default=models.Value(0),
+                output_field=models.IntegerField())
+
+        changed = [flagged_content for flagged_content in flagged_contents
+                   if flagged_content.status != flagged_content.previous_status]
+        if changed:
+            updates['status'] = models.Case(
+                *[models.When(id=flagged_content.id,
+                              then=models.Value(flagged_content.status))
+                  for flagged_content in changed],
+                default=models.F('status'),
+                output_field=models.PositiveSmallIntegerField())
+            updates['moderator'] = models.Case(
+                *[models.When(id=flagged_content.id,
+                              then=models.Value(flagged_content.moderator_id))
+                  for flagged_content in changed],
+                default=models.F('moderator'),
+                output_field=models.IntegerField())
+
+        self.filter(id__in=[flagged_content.id for flagged_content in
+                            flagged_contents]).update(**updates)
+        for flagged_content in flagged_contents:
+            flagged_content.when_updated = now
+
+    def bulk_set_status(self, queryset, status, moderator=None,
+                        batch_size=1000):
+        """
+        Set the `status` of all the FlaggedContent objects of the given
+        queryset, and of all their flags, without loading the objects: for
+        each chunk of `batch_size` objects, one UPDATE for the flagged
+        contents (with the `moderator` if the status is not the default one,
+        and the `when_updated` field) and one for their flags.
+        As with the 'trigger' COUNTER_ENGINE settings, the `count` field is
+        then the number of flags with the DEFAULT_STATUS status: 0 if
+        `status` is not the default one, else the number of flags of the
+        content (with one more query, and one UPDATE by distinct count). With
+        the 'cache' COUNTER_ENGINE settings, the flags waiting in the cache
+        for these contents are forgotten, as they are already counted.
+        The `contents_status_changed` signal is sent once, at the end.
+        Return the number of updated flagged contents.
+        """
+        ids = list(queryset.order_by().values_list('id', flat=True))
+        if not ids:
+            return 0
+
+        updates = dict(status=status, when_updated=timezone.now())
+        if status != flag_settings.DEFAULT_STATUS:
+            updates['moderator'] = moderator
+        # with the triggers, the counts are kept by the database
+        sync_counts = not triggers.is_enabled()
+        if sync_counts and status != flag_settings.DEFAULT_STATUS:
+            updates['count'] = 0
+        for start in range(0, len(ids), batch_size):
+            chunk = ids[start:start + batch_size]
+            with transaction.atomic(using=self.db):
+                self.filter(id__in=chunk).update(**updates)
+                FlagInstance.objects.using(self.db).filter(
+                    flagged_content__in=chunk).update(status=status)
+                if sync_counts and status == flag_settings.DEFAULT_STATUS:
+                    self._set_counts_from_flags(chunk)
+            if counters.is_enabled():
+                counters.discard(chunk)
+
+        signals.contents_status_changed.send(
+            sender=FlaggedContent,
+            flagged_content_ids=ids,
+            status=status,
+            moderator=moderator)
+        return len(ids)
+
+    def _set_counts_from_flags(self, ids):
+        """
+        Set the `count` field of the FlaggedContent objects with the given
+        ids to their number of flags, with one UPDATE by distinct count
+        """
+        counts = dict(FlagInstance.objects.using(self.db).filter(
+            flagged_content__in=ids).order_by().values_list(
+            'flagged_content').annotate(models.Count('id')))
+        ids_by_count = {}
+        for flagged_content_id in ids:
+            ids_by_count.setdefault(counts.get(flagged_content_id, 0),
+                                    []).append(flagged_content_id)
+        for count, count_ids in ids_by_count.items():
+            self.filter(id__in=count_ids).update(count=count)
+
+    def update_counts(self, changes, using=None):
+        """
+        Add the given numbers (negative to remove flags) to the `count` field
+        of the FlaggedContent objects, given as a `{flagged_content_id:
+        number}` dict, with one UPDATE by distinct number (the counts do not
+        go below 0). Nothing is done with the 'trigger' COUNTER_ENGINE
+        settings, as the triggers already did it
+        """
+        if triggers.is_enabled():
+            return
+        ids_by_number = {}
+        for flagged_content_id, number in changes.items():
+            if number:
+                ids_by_number.setdefault(number, []).append(flagged_content_id)
+        for number, ids in ids_by_number.items():
+            self.using(using or self.db).filter(id__in=ids).update(
+                count=models.Case(
+                    models.When(count__gte=-number,
+                                then=models.F('count') + number),
+                    default=models.Value(0)))
+
+    def _upsert(self, connection, content_type, object_id,
+                content_creator, status, when_updated):
+        """
+        Create the FlaggedContent object for the given content type and object
+        id if it does not exist yet, in one statement. `content_creator` and
+        `status` are only set when creating the object (see
+        `get_or_create_for_object`)
+        """
+        opts = self.model._meta
+        qn = connection.ops.quote_name
+        fields = [opts.get_field(name) for name in (
+            'content_type', 'object_id', 'creator', 'status', 'count',
+            'when_updated')]
+        if status is None:
+            status = opts.get_field('status').get_default()
+        values = [
+            content_type.id,
+            object_id,
+            content_creator.pk if content_creator is not None else None,
+            status,
+            0,
+            opts.get_field('when_updated').get_db_prep_value(when_updated,
+                                                             connection),
+        ]
+        sql = 'INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s, %s) ' \
+              'DO NOTHING' % (
+            qn(opts.db_table),
+            ', '.join(qn(field.column) for field in fields),
+            ', '.join(['%s'] * len(fields)),
+            qn(fields[0].column),
+            qn(fields[1].column))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, values)
+
+    def _update_for_new_flag(self, connection, content_type, object_id,
+                             user, status, when_updated):
+        """
+        Update the FlaggedContent object for a new flag from `user`, only if
+        the LIMIT_FOR_OBJECT and LIMIT_SAME_OBJECT_FOR_USER settings are not
+        raised, in one `UPDATE ... RETURNING` statement. The moderator and
+        `when_updated` fields are set like in `FlagInstanceManager.add`,
+        and the count is incremented if the status is the default one.
+        Return the updated FlaggedContent object or None if a limit is raised
+        or if `status` is not the current status of the object
+        """
+        opts = self.model._meta
+        qn = connection.ops.quote_name
+        table = qn(opts.db_table)
+        column = lambda name: qn(opts.get_field(name).column)
+
+        assignments, assignments_params = [], []
+        conditions, conditions_params = [], []
+
+        # the status of the new flag, and of the flagged content (not changed
+        # here)
+        if status:
+            status_sql, status_params = '%s', [status]
+            if status != flag_settings.DEFAULT_STATUS:
+                assignments.append('%s = %%s' % column('moderator'))
+                assignments_params.append(user.pk)
+        else:
+            status_sql, status_params = column('status'), []
+
+        assignments.append('%s = %s + CASE WHEN %s = %%s THEN 1 ELSE 0 END' % (
+            column('count'), column('count'), status_sql))
+        assignments_params.extend(status_params +
+                                  [flag_settings.DEFAULT_STATUS])
+        assignments.append('%s = %%s' % column('when_updated'))
+        assignments_params.append(opts.get_field('when_updated').
+                                  get_db_prep_value(when_updated, connection))
+
+        conditions.append('%s = %%s AND %s = %%s' % (column('content_type'),
+                                                   column('object_id')))
+        conditions_params.extend([content_type.id, object_id])
+        if status:
+            conditions.append('%s = %%s' % column('status'))
+            conditions_params.append(status)
+
+        # limits are only checked for "normal" flags
+        model_settings = flag_settings.get_for_content_type(content_type.id)
+        limit = model_settings.LIMIT_FOR_OBJECT
+        if limit:
+            conditions.append('(%s <> 1 OR %s < %%s)' % (status_sql,
+                                                       column('count')))
+            conditions_params.extend(status_params + [limit])
+        limit = model_settings.LIMIT_SAME_OBJECT_FOR_USER
+        if limit:
+            count_opts = FlagUserCount._meta
+            conditions.append(
+                '(%s <> 1 OR COALESCE((SELECT %s FROM %s WHERE %s = %s.%s '
+                'AND %s = %%s), 0) < %%s)' % (
+                    status_sql,
+                    qn(count_opts.get_field('count').column),
+                    qn(count_opts.db_table),
+                    qn(count_opts.get_field('flagged_content').column),
+                    table,
+                    column('id'),
+                    qn(count_opts.get_field('user').column)))
+            conditions_params.extend(status_params + [user.pk, limit])
+
+        returned = ('id', 'creator', 'status', 'moderator', 'count')
+        sql = 'UPDATE %s SET %s WHERE %s RETURNING %s' % (
+            table,
+            ', '.join(assignments),
+            ' AND '.join(conditions),
+            ', '.join(column(name) for name in returned))
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, assignments_params + conditions_params)
+            row = cursor.fetchone()
+        if row is None:
+            return None
+
+        field_names = [opts.get_field(name).attname for name in returned]
+        flagged_content = self.model(content_type_id=content_type.id,
+                                     object_id=object_id,
+                                     when_updated=when_updated,
+                                     **dict(zip(field_names, row)))
+        flagged_content._state.adding = False
+        flagged_content._state.db = connection.alias
+        return flagged_content
+
     def model_can_be_flagged(self, content_type):
         """
         Return True if the model is listed in the MODELS settings (or if this
@@ -84,15 +561,14 @@ class FlaggedContentManager(models.Manager):
         if flag_settings.MODELS is None:
             return True
 
-        # try to find app and model from the content_type
+        # try to find the content type id from the content_type
         try:
-            app_label, model = get_content_type_tuple(content_type)
+            content_type_id = get_content_type_id(content_type)
         except:
             return False
 
         # finally we can check
-        model = '%s.%s' % (app_label, model)
-        return model in flag_settings.MODELS
+        return content_type_id in get_content_type_ids(flag_settings.MODELS)
 
     def assert_model_can_be_flagged(self, content_type):
         """
@@ -127,6 +603,14 @@ class FlaggedContent(models.Model):
 
     class Meta:
         unique_together = [("content_type", "object_id")]
+        index_together = [
+            # moderation queue (see `FlaggedContentManager.moderation_queue`)
+            ("status", "when_updated", "id"),
+            ("when_updated", "id"),
+            ("content_type", "status", "when_updated", "id"),
+            # contents of a creator
+            ("creator", "status"),
+        ]
         ordering = ('-id',)
 
     def __unicode__(self):
@@ -136,18 +620,53 @@ class FlaggedContent(models.Model):
         app_label, model = get_content_type_tuple(self.content_type_id)
         return u'%s.%s #%s' % (app_label, model, self.object_id)
 
+    @property
+    def settings(self):
+        """
+        The settings (see `flag.settings.ModelSettings`) for the model of the
+        current content object
+        """
+        return flag_settings.get_for_content_type(self.content_type_id)
+
     def content_settings(self, name):
         """
         Return the settings `name` for the current content object
         """
-        return flag_settings.get_for_model(self.content_object, name)
+        return getattr(self.settings, name)
+
+    @property
+    def pending_count(self):
+        """
+        The number of flags counted in the cache and not yet added to the
+        `count` field (always 0 if the COUNTER_ENGINE settings is not
+        'cache', see `flag.counters`)
+        """
+        if not counters.is_enabled() or self.id is None:
+            return 0
+        if not hasattr(self, '_pending_count'):
+            self._pending_count = counters.get_pending(self.id)
+        return self._pending_count
+
+    @property
+    def current_count(self):
+        """
+        The number of flags, including the ones not yet added to the `count`
+        field
+        """
+        return self.count + self.pending_count
 
     def count_flags_by_user(self, user):
         """
         Helper to get the number of flags on this flagged content by the
         given user
+        The count is taken from `flags_count_by_user` (a dict of counts by
+        user id), if set and if the user is in it, to avoid a query, else
+        from the FlagUserCount table
         """
-        return self.flag_instances.filter(user=user).count()
+        counts = getattr(self, 'flags_count_by_user', None)
+        if counts is not None and user.pk in counts:
+            return counts[user.pk]
+        return FlagUserCount.objects.get_count(self.id, user.pk)
 
     def can_be_flagged(self):
         """
@@ -156,7 +675,7 @@ class FlaggedContent(models.Model):
         limit = self.content_settings('LIMIT_FOR_OBJECT')
         if not limit:
             return True
-        return self.count < limit
+        return self.current_count < limit
 
     def assert_can_be_flagged(self):
         """
@@ -259,10 +778,22 @@ class FlaggedContent(models.Model):
     def save(self, *args, **kwargs):
         """
         Before the save, we check that we can flag this object
+        With the 'trigger' and 'cache' COUNTER_ENGINE settings, the `count`
+        field of an existing object is not saved (except if given in
+        `update_fields`): it is maintained by the triggers or the flushes of
+        the counters, and the value of the instance may be stale
         """
 
         # check if we can flag this model
-        FlaggedContent.objects.assert_model_can_be_flagged(self.content_object)
+        FlaggedContent.objects.assert_model_can_be_flagged(
+            self.content_type_id)
+        if flag_settings.COUNTER_ENGINE != 'db' and not args and \
+                not self._state.adding and \
+                kwargs.get('update_fields') is None and \
+                not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'count']
         super(FlaggedContent, self).save(*args, **kwargs)
 
     def flag_added(self, flag_instance, send_signal=False, send_mails=False):
@@ -271,10 +802,39 @@ class FlaggedContent(models.Model):
         """
         # get the the count value from the db, not from the stored Instance
         # increment the count if status == 1
-        if self.status == flag_settings.DEFAULT_STATUS:
+        if triggers.is_enabled():
+            # already counted by the trigger
+            if flag_instance.status == flag_settings.DEFAULT_STATUS:
+                self.count += 1
+            return self.flag_notify(flag_instance, send_signal=send_signal,
+                                    send_mails=send_mails)
+
+        if counters.is_enabled():
+            # counted in the cache: the row is neither updated nor read again
+            if flag_instance.status == flag_settings.DEFAULT_STATUS:
+                self._pending_count, flushed = counters.increment(self.id)
+                # the flags of the cache just added to the `count` field
+                self.count += flushed
+            return self.flag_notify(flag_instance, send_signal=send_signal,
+                                    send_mails=send_mails)
+
+        # as the triggers, count the flags with the default status
+        if flag_instance.status == flag_settings.DEFAULT_STATUS:
             self.count = models.F('count') + 1
-            self.save()
+            self.save(update_fields=['count', 'when_updated'])
+
+        # update count of the current object
+        new_self = FlaggedContent.objects.get(id=self.id)
+        self.count = new_self.count
+
+        self.flag_notify(flag_instance, send_signal=send_signal,
+                         send_mails=send_mails)
 
+    def flag_notify(self, flag_instance, send_signal=False, send_mails=False):
+        """
+        Send the signal and the mails (if wanted) for a flag just added. The
+        `count` of the current object must be up to date.
+        """
         # send a signal if wanted
         if send_signal:
             signals.content_flagged.send(
@@ -282,36 +842,30 @@ class FlaggedContent(models.Model):
                 flagged_content=self,
                 flagged_instance=flag_instance)
 
-        # update count of the current object
-        new_self = FlaggedContent.objects.get(id=self.id)
-        self.count = new_self.count
-
         # send emails if wanted
-        if send_mails and self.content_settings('SEND_MAILS'):
-            # always send mail if the max flag is reached
-            limit = self.content_settings('LIMIT_FOR_OBJECT')
-            really_send_mails = limit and self.count >= limit
-
-            # limit not reached, check rules
-            if not really_send_mails:
-                # check rule
-                current_min_count, current_step = 0, 0
-                for min_count, step in self.content_settings(
-                    'SEND_MAILS_RULES'):
-                    if self.count >= min_count:
-                        current_min_count, current_step = min_count, step
-                    else:
-                        break
-
-                # do we need to send mail ?
-                if current_step and \
-                    not (self.count - current_min_count) % current_step:
-                    really_send_mails = True
-
-            # finally send mails if we really want to do it
-            # if the flag is to be deleted, we send the mail anyway
-            if really_send_mails:
-                flag_instance.send_mails()
+        if send_mails and self.need_mails(self.current_count):
+            flag_instance.send_mails()
+
+    def need_mails(self, first_count, last_count=None):
+        """
+        Return True if mails are to be sent for at least one of the counts
+        between `first_count` and `last_count` (included, default to
+        `first_count`), regarding the SEND_MAILS, LIMIT_FOR_OBJECT and
+        SEND_MAILS_RULES settings
+        """
+        model_settings = self.settings
+        if not model_settings.SEND_MAILS:
+            return False
+        if last_count is None:
+            last_count = first_count
+
+        # always send mail if the max flag is reached
+        limit = model_settings.LIMIT_FOR_OBJECT
+        if limit and last_count >= limit:
+            return True
+
+        # limit not reached, check rules
+        return model_settings.mails_schedule.matches(first_count, last_count)
 
     def get_status_display(self):
         """
@@ -319,25 +873,155 @@ class FlaggedContent(models.Model):
         (replace the original get_FIELD_display for this field which act as a
         field with choices)
         """
-        statuses = dict(flag_settings.get_for_model(self.content_object,
-                                                    'STATUSES'))
+        statuses = dict(self.settings.STATUSES)
         return force_unicode(statuses[self.status], strings_only=True)
 
+    def get_flags_summary(self, days=30):
+        """
+        Return a dict with the number of flags of this content by status
+        (`by_status`, a list of `(status, label, count)`) and by day
+        (`by_day`, a list of `(day, count)` for the last `days` days with
+        flags, most recent first), and the total number of flags (`total`).
+        The counts are computed by the database, with one query each.
+        """
+        flags = FlagInstance.objects.filter(flagged_content=self).order_by()
+
+        labels = dict(self.settings.STATUSES)
+        by_status = [(status, labels.get(status, status), count)
+                     for status, count in flags.values_list('status')
+                                               .annotate(models.Count('id'))
+                                               .order_by('status')]
+
+        connection = connections[flags.db]
+        column = '%s.%s' % (connection.ops.quote_name(FlagInstance._meta.db_table),
+                            connection.ops.quote_name('when_added'))
+        if settings.USE_TZ:
+            day_sql, day_params = connection.ops.datetime_trunc_sql(
+                'day', column, timezone.get_current_timezone_name())
+        else:
+            day_sql, day_params = connection.ops.date_trunc_sql('day',
+                                                                column), []
+        # the truncated date may be a string or a datetime, depending on the
+        # database: only its date part is kept
+        by_day = [(unicode(day)[:10], count)
+                  for day, count in flags.extra(select={'day': day_sql},
+                                                select_params=day_params)
+                                         .values_list('day')
+                                         .annotate(models.Count('id'))
+                                         .order_by('-day')[:days]]
+
+        return dict(by_status=by_status,
+                    by_day=by_day,
+                    total=sum(count for status, label, count in by_status))
+
+
+def fast_add_supported(connection):
+    """
+    Return True if the given database connection can run the upsert and the
+    `UPDATE ... RETURNING` statements used by the fast `add` mode
+    """
+    if connection.vendor == 'postgresql':
+        return connection.pg_version >= 90500
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 35, 0)
+    return False
+
+
+class FlagInstanceQuerySet(models.QuerySet):
+    """
+    QuerySet for the FlagInstance model, keeping the FlagUserCount objects and
+    the `count` field of the flagged contents up to date when flags are
+    deleted
+    """
+
+    def delete(self):
+        """
+        Delete the flags, and remove them from the counts of their users with
+        one UPDATE by user (see `FlagUserCountManager.decrement_many`), and
+        the ones with the default status from the `count` field of their
+        flagged contents (see `FlaggedContentManager.update_counts`).
+        The counts of the flags deleted with their flagged content or their
+        user are deleted with them
+        """
+        counts = {}
+        content_changes = {}
+        for flagged_content_id, user_id, status, number in \
+                self.order_by().values_list(
+                    'flagged_content', 'user', 'status').annotate(
+                    models.Count('id')):
+            key = (flagged_content_id, user_id)
+            counts[key] = counts.get(key, 0) + number
+            if status == flag_settings.DEFAULT_STATUS:
+                content_changes[flagged_content_id] = content_changes.get(
+                    flagged_content_id, 0) - number
+        with transaction.atomic(using=self.db):
+            deleted = super(FlagInstanceQuerySet, self).delete()
+            FlagUserCount.objects.decrement_many(
+                [key + (number,) for key, number in counts.items()],
+                using=self.db)
+            FlaggedContent.objects.update_counts(content_changes,
+                                                 using=self.db)
+        return deleted
+    delete.alters_data = True
+    delete.queryset_only = True
+
 
 class FlagInstanceManager(models.Manager):
     """
     Manager for the FlagInstance model, adding a `add` method
     """
 
+    def get_queryset(self):
+        return FlagInstanceQuerySet(self.model, using=self._db)
+
     def add(self, user, content_object, content_creator=None, comment=None,
             status=None, send_signal=False, send_mails=False):
         """
         Helper to easily create a flag of an object
         `content_creator` can only be set if it's the first flag
         if `status` is updated, no signal/mails will be sent (update by staff)
+        and, if it changes the status of the content, it is set to all its
+        flags by `FlaggedContent.objects.bulk_set_status` (as by the admin
+        actions), so the `count` field is the number of its flags with the
+        default status
+        If the FAST_ADD settings is True (and the database supports it), the
+        flag is added by `fast_add`, except with the 'cache' and 'trigger'
+        COUNTER_ENGINE settings
+        Without `status`, a FlagRateLimitException is raised, before any
+        query, if the user raised the RATE_LIMIT. The flag is not counted in
+        the limit if it is refused for another reason, or not saved because
+        the user is not trusted
         TODO : move things in the `save` method of the `FlagInstance` model
         """
+        rate_key = None
+        if not status or status == flag_settings.DEFAULT_STATUS:
+            rate_key = ratelimit.count_flag(user, content_object)
+        try:
+            flag_instance = None
+            if flag_settings.FAST_ADD and \
+                    flag_settings.COUNTER_ENGINE == 'db':
+                connection = connections[router.db_for_write(FlaggedContent)]
+                if fast_add_supported(connection):
+                    flag_instance = self.fast_add(
+                        user, content_object, content_creator, comment,
+                        status, send_signal, send_mails)
+            if flag_instance is None:
+                flag_instance = self._add(user, content_object,
+                                          content_creator, comment, status,
+                                          send_signal, send_mails)
+        except FlagException:
+            ratelimit.uncount_flag(rate_key)
+            raise
+        if flag_instance.pk is None:
+            # not saved, the user is not trusted (see NEEDS_TRUST)
+            ratelimit.uncount_flag(rate_key)
+        return flag_instance
 
+    def _add(self, user, content_object, content_creator, comment, status,
+             send_signal, send_mails):
+        """
+        The default path of `add`, using the models methods
+        """
         # get or create the FlaggedContent object
         flagged_content, created = FlaggedContent.objects. \
             get_or_create_for_object(content_object,
@@ -345,13 +1029,24 @@ class FlagInstanceManager(models.Manager):
                                      status)
 
         # save new status, moderator and updated date
+        changed = status_changed = False
         if status:
+            changed = status_changed = status != flagged_content.status
             flagged_content.status = status
             # if the status is not the default one, we save the moderator
             if status != flag_settings.DEFAULT_STATUS:
                 flagged_content.moderator = user
-        # always update the `when_updated` field
-        flagged_content.save()
+                changed = True
+        if flag_settings.COUNTER_ENGINE == 'db':
+            # always update the `when_updated` field
+            flagged_content.save()
+        elif changed or triggers.is_enabled():
+            # the `count` field is maintained by the triggers, or by the
+            # cache counters (without locking the row if not needed, the
+            # `when_updated` field will be updated when the counter is
+            # flushed)
+            flagged_content.save(update_fields=['status', 'moderator',
+                                                'when_updated'])
 
         # add the flag
         params = dict(
@@ -366,14 +1061,259 @@ class FlagInstanceManager(models.Manager):
         flag_instance = FlagInstance(**params)
         flag_instance.save(send_signal=send_signal,
                            send_mails=send_mails)
+
+        if status_changed and flag_instance.pk is not None:
+            # set the status to all the flags, and count them again
+            FlaggedContent.objects.bulk_set_status(
+                FlaggedContent.objects.filter(id=flagged_content.id), status,
+                moderator=user)
+            flagged_content.count = FlaggedContent.objects.filter(
+                id=flagged_content.id).values_list('count', flat=True)[0]
+            # the flags waiting in the cache were counted
+            flagged_content._pending_count = 0
         return flag_instance
 
+    def fast_add(self, user, content_object, content_creator=None,
+                 comment=None, status=None, send_signal=False,
+                 send_mails=False):
+        """
+        Same as `add` but in one transaction with only four statements:
+        - an upsert of the FlaggedContent object
+        - a conditional `UPDATE ... RETURNING` which checks the limits and
+          updates the status, moderator, count and `when_updated` fields
+        - the insert of the FlagInstance object
+        - an upsert of the FlagUserCount object
+        The same exceptions are raised, and the signal and mails are sent
+        after the commit.
+        A flag changing the status of the content (a moderation) goes
+        through the normal path, which sets it to all the flags.
+        Untrusted users (if NEEDS_TRUST is set) go through the normal path.
+        """
+        content_type = ContentType.objects.get_for_model(content_object)
+        FlaggedContent.objects.assert_model_can_be_flagged(content_type)
+
+        model_settings = flag_settings.get_for_content_type(content_type.id)
+        if model_settings.NEEDS_TRUST and not is_user_trusted(user):
+            # the default path will send the warning mails
+            return self._add(user, content_object, content_creator, comment,
+                             status, send_signal, send_mails)
+
+        using = router.db_for_write(FlaggedContent)
+        connection = connections[using]
+        now = timezone.now()
+
+        with transaction.atomic(using=using):
+            FlaggedContent.objects._upsert(connection, content_type,
+                                           content_object.pk,
+                                           content_creator, status, now)
+            flagged_content = FlaggedContent.objects._update_for_new_flag(
+                connection, content_type, content_object.pk, user, status,
+                now)
+
+            if flagged_content is None:
+                # a limit is raised (get the real exception), or the status
+                # changes
+                flagged_content = FlaggedContent.objects.get(
+                    content_type=content_type, object_id=content_object.pk)
+                if status and status != flagged_content.status:
+                    flagged_content = None
+                else:
+                    flagged_content.assert_can_be_flagged_by_user(user)
+                    raise ContentFlaggedEnoughException(
+                        _('Flag limit raised'))
+
+            if flagged_content is not None:
+                # we already have it, avoid loading it again
+                flagged_content.content_object = content_object
+
+                flag_instance = FlagInstance(
+                    flagged_content=flagged_content,
+                    user=user,
+                    comment=comment,
+                    status=status or flagged_content.status)
+                flag_instance.check_comment()
+                flag_instance.save_base(force_insert=True, using=using)
+                FlagUserCount.objects._upsert_increment(
+                    connection, flagged_content.id, user.pk)
+
+        if flagged_content is None:
+            return self._add(user, content_object, content_creator, comment,
+                             status, send_signal, send_mails)
+
+        flagged_content.flag_notify(flag_instance, send_signal=send_signal,
+                                    send_mails=send_mails)
+        return flag_instance
+
+    def bulk_add(self, flags, send_signal=False, send_mails=False,
+                 batch_size=500):
+        """
+        Add many flags at once. `flags` is an iterable of
+        `(user, content_object, comment, status)` tuples (`comment` and
+        `status` are optional).
+        Flags are added by chunks of `batch_size`, each one in a transaction
+        with only a few queries. For each chunk, the `contents_flagged`
+        signal is sent once (if `send_signal`), and mails are sent at most
+        once by flagged object (if `send_mails`) if the SEND_MAILS_RULES
+        match one of the counts reached by this object in the chunk.
+        Return a list with, for each entry, the new FlagInstance, or the
+        FlagException which prevented it to be added.
+        Untrusted users (if NEEDS_TRUST is set) get a
+        FlagUserNotTrustedException, and no warning mails are sent.
+        The flags are saved with `bulk_create`, so the returned FlagInstance
+        objects (and the ones sent with the signal) have no `pk` if the
+        database backend cannot return the ids of a bulk insert (all of them
+        before django 1.10, PostgreSQL only after)
+        """
+        results = []
+        chunk = []
+        for entry in flags:
+            chunk.append((tuple(entry) + (None, None))[:4])
+            if len(chunk) >= batch_size:
+                results.extend(self._bulk_add_chunk(chunk, send_signal,
+                                                    send_mails))
+                chunk = []
+        if chunk:
+            results.extend(self._bulk_add_chunk(chunk, send_signal,
+                                                send_mails))
+        return results
+
+    def _bulk_add_chunk(self, chunk, send_signal, send_mails):
+        """
+        Add the flags of one chunk of `bulk_add`
+        """
+        results = [None] * len(chunk)
+
+        # get the key (content type id, object id) of each object to flag
+        keys = {}
+        for index, (user, content_object, comment, status) in enumerate(
+                chunk):
+            content_type = ContentType.objects.get_for_model(content_object)
+            if FlaggedContent.objects.model_can_be_flagged(content_type):
+                keys[index] = (content_type.id, content_object.pk)
+            else:
+                results[index] = ModelCannotBeFlaggedException(
+                    _('This model cannot be flagged'))
+        if not keys:
+            return results
+
+        with transaction.atomic(using=self.db):
+
+            # get or create all the FlaggedContent objects (the status used
+            # for creation is the one of the first flag of the object)
+            statuses = {}
+            for index in sorted(keys, reverse=True):
+                statuses[keys[index]] = chunk[index][3]
+            by_key = FlaggedContent.objects.get_or_create_for_keys(statuses)
+            by_id = {}
+            for index, key in keys.items():
+                flagged_content = by_key[key]
+                if flagged_content.id not in by_id:
+                    by_id[flagged_content.id] = flagged_content
+                    # we already have it, avoid loading it again
+                    flagged_content.content_object = chunk[index][1]
+                    flagged_content.flags_count_by_user = {}
+                    flagged_content.previous_count = flagged_content.count
+                    flagged_content.previous_status = flagged_content.status
+                    flagged_content.last_flag_instance = None
+            if counters.is_enabled():
+                counters.attach_pending(by_id.values())
+
+            # get the number of flags by user for each flagged content, in
+            # one query
+            users_ids = set(chunk[index][0].pk for index in keys)
+            for flagged_content_id, user_id, count in FlagUserCount.objects. \
+                    filter(flagged_content__in=by_id.keys(),
+                           user__in=users_ids).order_by().values_list(
+                        'flagged_content', 'user', 'count'):
+                by_id[flagged_content_id].flags_count_by_user[user_id] = count
+            for index, key in keys.items():
+                by_key[key].flags_count_by_user.setdefault(
+                    chunk[index][0].pk, 0)
+
+            # evaluate the trust of all the users at once, if needed
+            trusted = {}
+            if any(flagged_content.content_settings('NEEDS_TRUST')
+                   for flagged_content in by_id.values()):
+                trusted = are_users_trusted(chunk[index][0] for index in keys)
+
+            # check each flag like `add` does, but in memory
+            flag_instances = []
+            for index in sorted(keys):
+                user, content_object, comment, status = chunk[index]
+                flagged_content = by_key[keys[index]]
+                flag_instance = FlagInstance(
+                    flagged_content=flagged_content,
+                    user=user,
+                    comment=comment,
+                    status=status or flagged_content.status)
+                try:
+                    if flag_instance.status == 1:
+                        flagged_content.assert_can_be_flagged_by_user(user)
+                    flag_instance.check_comment()
+                    if flagged_content.content_settings('NEEDS_TRUST'):
+                        if not trusted[user.pk]:
+                            raise FlagUserNotTrustedException(
+                                _('You are not allowed to flag this'))
+                except FlagException, e:
+                    results[index] = e
+                    continue
+
+                # save new status and moderator
+                if status:
+                    flagged_content.status = status
+                    if status != flag_settings.DEFAULT_STATUS:
+                        flagged_content.moderator = user
+                if flagged_content.status == flag_settings.DEFAULT_STATUS:
+                    flagged_content.count += 1
+                counts = flagged_content.flags_count_by_user
+                counts[user.pk] = counts.get(user.pk, 0) + 1
+
+                flagged_content.last_flag_instance = flag_instance
+                flag_instances.append(flag_instance)
+                results[index] = flag_instance
+
+            if not flag_instances:
+                return results
+
+            self.bulk_create(flag_instances)
+
+            # update the number of flags by user, in a few queries
+            user_counts = {}
+            for flag_instance in flag_instances:
+                key = (flag_instance.flagged_content.id, flag_instance.user.pk)
+                user_counts[key] = user_counts.get(key, 0) + 1
+            FlagUserCount.objects.increment(user_counts, using=self.db)
+
+            # update the flagged contents in one query
+            flagged_contents = [flagged_content for flagged_content in
+                                by_id.values() if
+                                flagged_content.last_flag_instance is not None]
+            FlaggedContent.objects.bulk_update_after_flags(flagged_contents)
+
+        if send_signal:
+            signals.contents_flagged.send(
+                sender=FlaggedContent,
+                flagged_contents=flagged_contents,
+                flag_instances=flag_instances)
+
+        if send_mails:
+            for flagged_content in flagged_contents:
+                pending_count = flagged_content.pending_count
+                if flagged_content.need_mails(
+                        min(flagged_content.previous_count + 1,
+                            flagged_content.count) + pending_count,
+                        flagged_content.count + pending_count):
+                    flagged_content.last_flag_instance.send_mails()
+
+        return results
+
 
 class FlagInstance(models.Model):
     flagged_content = models.ForeignKey(FlaggedContent,
                                         related_name='flag_instances')
     user = models.ForeignKey(settings.AUTH_USER_MODEL)
-    when_added = models.DateTimeField(auto_now=False, auto_now_add=True)
+    when_added = models.DateTimeField(auto_now=False, auto_now_add=True,
+                                      db_index=True)
     comment = models.TextField(null=True, blank=True)
     status = models.PositiveSmallIntegerField(default=1, db_index=True)
 
@@ -381,6 +1321,12 @@ class FlagInstance(models.Model):
 
     class Meta:
         ordering = ('-when_added',)
+        index_together = [
+            # flags of a user on a content (LIMIT_SAME_OBJECT_FOR_USER)
+            ("flagged_content", "user"),
+            # history of the flags of a content
+            ("flagged_content", "when_added"),
+        ]
 
     def __unicode__(self):
         """
@@ -391,12 +1337,40 @@ class FlagInstance(models.Model):
         return u'flag on %s.%s #%s by user #%s' % (
             app_label, model, self.flagged_content.object_id, self.user_id)
 
+    def delete(self, using=None):
+        """
+        Delete the flag, and remove it from the count of its user, and from
+        the `count` field of its flagged content if it has the default status
+        """
+        using = using or router.db_for_write(FlagInstance, instance=self)
+        with transaction.atomic(using=using):
+            deleted = super(FlagInstance, self).delete(using=using)
+            FlagUserCount.objects.decrement(self.flagged_content_id,
+                                            self.user_id, using=using)
+            if self.status == flag_settings.DEFAULT_STATUS:
+                FlaggedContent.objects.update_counts(
+                    {self.flagged_content_id: -1}, using=using)
+        return deleted
+    delete.alters_data = True
+
     def content_settings(self, name):
         """
         Return the settings `name` for the object linked to the flagged_content
         """
         return self.flagged_content.content_settings(name)
 
+    def check_comment(self):
+        """
+        Raise an exception if a comment is given but not allowed, or if
+        it's missing but required (ALLOW_COMMENTS settings)
+        """
+        allow_comments = self.content_settings('ALLOW_COMMENTS')
+        if allow_comments and not self.comment:
+            raise FlagCommentException(_('You must add a comment'))
+        if not allow_comments and self.comment:
+            raise FlagCommentException(
+                _('You are not allowed to add a comment'))
+
     def save(self, *args, **kwargs):
         """
         Save the flag and, if it's a new one, tell it to the flagged_content.
@@ -404,6 +1378,8 @@ class FlagInstance(models.Model):
         If a `send_signal` is passed, we pass it to the `flag_added` method
         of the flagged_content to tell him to send the signal (default False)
         Idem with `send_mails`, to send emails if settings allow it.
+        If an existing flag gets or loses the default status, the `count`
+        field of its flagged content is updated (as the triggers do).
         """
         is_new = not bool(self.id)
         send_signal = kwargs.pop('send_signal', False)
@@ -415,37 +1391,77 @@ class FlagInstance(models.Model):
 
         # check comment
         if is_new:
-            allow_comments = self.content_settings('ALLOW_COMMENTS')
-            if allow_comments and not self.comment:
-                raise FlagCommentException(_('You must add a comment'))
-            if not allow_comments and self.comment:
-                raise FlagCommentException(
-                    _('You are not allowed to add a comment'))
+            self.check_comment()
 
         # we won't save this if the user is not trusted !
-        if self.content_settings('NEEDS_TRUST') and not can_user_be_trusted(
+        if self.content_settings('NEEDS_TRUST') and not is_user_trusted(
             self.user):
             self.send_untrusted_warning_mails()
         else:
-            super(FlagInstance, self).save(*args, **kwargs)
+            using = kwargs.get('using') or router.db_for_write(
+                FlagInstance, instance=self)
+            with transaction.atomic(using=using):
+                previous = None
+                if not is_new and not triggers.is_enabled():
+                    previous = FlagInstance.objects.using(using).filter(
+                        id=self.id).values_list('flagged_content',
+                                                'status').first()
+                super(FlagInstance, self).save(*args, **kwargs)
+                if is_new:
+                    FlagUserCount.objects.increment(
+                        {(self.flagged_content_id, self.user_id): 1},
+                        using=using)
+                elif previous:
+                    self._update_content_counts(previous, using)
 
             # tell the flagged_content that it has a new flag
             if is_new:
                 self.flagged_content.flag_added(self, send_signal=send_signal,
                                                 send_mails=send_mails)
 
-    def _send_mails(self, subject_templates, content_templates):
+    def _update_content_counts(self, previous, using):
+        """
+        Update the `count` field of the flagged content(s) of the flag if it
+        got or lost the default status, `previous` being its previous
+        `(flagged_content_id, status)`
+        """
+        changes = {}
+        previous_flagged_content_id, previous_status = previous
+        if previous_status == flag_settings.DEFAULT_STATUS:
+            changes[previous_flagged_content_id] = -1
+        if self.status == flag_settings.DEFAULT_STATUS:
+            changes[self.flagged_content_id] = changes.get(
+                self.flagged_content_id, 0) + 1
+        FlaggedContent.objects.update_counts(changes, using=using)
+
+    def get_mails_recipients(self):
+        """
+        Return the list of mail addresses to alert, regarding the SEND_MAILS
+        and SEND_MAILS_TO settings
+        """
         recipients = self.content_settings('SEND_MAILS_TO')
         if not (self.content_settings('SEND_MAILS') and recipients):
-            return
+            return []
 
-        # prepare recipients
         recipient_list = []
         for recipient in recipients:
             if isinstance(recipient, basestring):
                 recipient_list.append(recipient)
             else:
                 recipient_list.append(recipient[1])
+        return recipient_list
+
+    def _send_mails(self, subject_templates, content_templates,
+                    untrusted=False):
+        # prepare recipients
+        recipient_list = self.get_mails_recipients()
+        if not recipient_list:
+            return
+
+        # only add the flag to the next digest if wanted
+        if self.content_settings('SEND_MAILS_DIGEST'):
+            FlagDigestEntry.objects.add(self, recipient_list, untrusted)
+            return
 
         # subject and body from templates
         app_label = self.flagged_content.content_object._meta.app_label
@@ -458,7 +1474,7 @@ class FlagInstance(models.Model):
             app_label=app_label,
             model_name=model_name,
             object=self.flagged_content.content_object,
-            count=self.flagged_content.count,
+            count=self.flagged_content.current_count,
 
             object_url=self.flagged_content.get_content_object_absolute_url(),
             object_admin_url=self.flagged_content. \
@@ -482,7 +1498,19 @@ class FlagInstance(models.Model):
             "\r", " ")
         message = render_to_string(content_templates, context)
 
-        # really send the mails !
+        # store the mail in the outbox...
+        if flag_settings.SEND_MAILS_OUTBOX:
+            FlagMail.objects.enqueue(
+                subject=subject,
+                message=message,
+                from_email=self.content_settings('SEND_MAILS_FROM'),
+                recipient_list=recipient_list,
+                flag_instance=self)
+            from flag.mails import wake_workers
+            wake_workers()
+            return
+
+        # ...or really send the mails !
         send_mail(
             subject=subject,
             message=message,
@@ -506,7 +1534,7 @@ class FlagInstance(models.Model):
             'flag/untrusted_mail_alert_body_%s_%s.txt' % (
                 app_label, model_name),
             'flag/untrusted_mail_alert_body.txt']
-        self._send_mails(subject_templates, content_templates)
+        self._send_mails(subject_templates, content_templates, untrusted=True)
 
     def send_mails(self):
         """
@@ -547,6 +1575,324 @@ class FlagInstance(models.Model):
         return url
 
 
+class FlagUserCountManager(models.Manager):
+    """
+    Manager for the FlagUserCount model, to get and update the number of
+    flags of users on flagged contents
+    """
+
+    def get_count(self, flagged_content_id, user_id):
+        """
+        Return the number of flags of the user on the flagged content, with
+        one lookup on the unique index
+        """
+        counts = list(self.filter(flagged_content=flagged_content_id,
+                                  user=user_id).values_list('count',
+                                                            flat=True)[:1])
+        return counts[0] if counts else 0
+
+    def get_counts(self, flagged_content_ids, user_id):
+        """
+        Return, in one query, a dict with the number of flags of the user
+        for each of the given flagged contents ids (only the ones with
+        flags by this user)
+        """
+        return dict(self.filter(flagged_content__in=flagged_content_ids,
+                                user=user_id).order_by().values_list(
+                                    'flagged_content', 'count'))
+
+    def increment(self, counts, using=None):
+        """
+        For each `(flagged_content_id, user_id)` key of the `counts` dict, add
+        its value to the number of flags of the user on the flagged content.
+        Must be called in the transaction adding the flags
+        """
+        using = using or self.db
+        if len(counts) == 1:
+            key, value = counts.items()[0]
+            self._increment_one(key, value, using)
+            return
+
+        query = models.Q()
+        for flagged_content_id, user_id in counts:
+            query |= models.Q(flagged_content=flagged_content_id,
+                              user=user_id)
+        existing = dict(((flagged_content_id, user_id), id)
+                        for id, flagged_content_id, user_id in
+                        self.using(using).filter(query).order_by().values_list(
+                            'id', 'flagged_content', 'user'))
+
+        missing = [key for key in counts if key not in existing]
+        if missing:
+            try:
+                with transaction.atomic(using=using):
+                    self.using(using).bulk_create([
+                        FlagUserCount(flagged_content_id=key[0],
+                                      user_id=key[1],
+                                      count=counts[key])
+                        for key in missing])
+            except IntegrityError:
+                # some were created in another transaction in the meantime
+                for key in missing:
+                    self._increment_one(key, counts[key], using)
+
+        # one update for each different value
+        by_value = {}
+        for key, id in existing.items():
+            by_value.setdefault(counts[key], []).append(id)
+        for value, ids in by_value.items():
+            self.using(using).filter(id__in=ids).update(
+                count=models.F('count') + value)
+
+    def _increment_one(self, key, value, using):
+        """
+        Add `value` to the count for the `(flagged_content_id, user_id)` key,
+        creating it if needed
+        """
+        flagged_content_id, user_id = key
+        queryset = self.using(using).filter(flagged_content=flagged_content_id,
+                                            user=user_id)
+        if queryset.update(count=models.F('count') + value):
+            return
+        try:
+            with transaction.atomic(using=using):
+                self.using(using).create(flagged_content_id=flagged_content_id,
+                                         user_id=user_id,
+                                         count=value)
+        except IntegrityError:
+            # created in another transaction in the meantime
+            queryset.update(count=models.F('count') + value)
+
+    def _upsert_increment(self, connection, flagged_content_id, user_id):
+        """
+        Add one to the count for the flagged content and the user, in one
+        `INSERT ... ON CONFLICT DO UPDATE` statement (see `fast_add`)
+        """
+        opts = self.model._meta
+        qn = connection.ops.quote_name
+        table = qn(opts.db_table)
+        columns = [qn(opts.get_field(name).column)
+                   for name in ('flagged_content', 'user', 'count')]
+        sql = 'INSERT INTO %s (%s) VALUES (%%s, %%s, 1) ON CONFLICT (%s, %s) ' \
+              'DO UPDATE SET %s = %s.%s + 1' % (
+            table,
+            ', '.join(columns),
+            columns[0],
+            columns[1],
+            columns[2],
+            table,
+            columns[2])
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [flagged_content_id, user_id])
+
+    def decrement(self, flagged_content_id, user_id, using=None):
+        """
+        Remove one to the count for the flagged content and the user
+        """
+        self.using(using or self.db).filter(
+            flagged_content=flagged_content_id, user=user_id,
+            count__gt=0).update(count=models.F('count') - 1)
+
+    def decrement_many(self, counts, using=None):
+        """
+        Remove the given numbers of flags from the counts, given as a list of
+        `(flagged_content_id, user_id, number)` tuples, with one UPDATE by
+        user and number (the counts do not go below 0)
+        """
+        grouped = {}
+        for flagged_content_id, user_id, number in counts:
+            grouped.setdefault((user_id, number), []).append(
+                flagged_content_id)
+        for (user_id, number), flagged_content_ids in grouped.items():
+            self.using(using or self.db).filter(
+                flagged_content__in=flagged_content_ids, user=user_id,
+                count__gt=0).update(count=models.Case(
+                    models.When(count__gte=number,
+                                then=models.F('count') - number),
+                    default=models.Value(0)))
+
+
+class FlagUserCount(models.Model):
+    """
+    The number of flags of a user on a flagged content, kept up to date when
+    flags are added or deleted, to check the LIMIT_SAME_OBJECT_FOR_USER
+    settings without counting the FlagInstance objects
+    """
+    flagged_content = models.ForeignKey(FlaggedContent,
+                                        related_name='user_counts')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             related_name='flag_counts')
+    count = models.PositiveIntegerField(default=0)
+
+    objects = FlagUserCountManager()
+
+    class Meta:
+        unique_together = [('flagged_content', 'user')]
+
+    def __unicode__(self):
+        return u'%s flag(s) on %s by user #%s' % (
+            self.count, self.flagged_content, self.user_id)
+
+
+
+class FlagMailManager(models.Manager):
+    """
+    Manager for the FlagMail model, to store the mails to send and to get the
+    ones to send now
+    """
+
+    def enqueue(self, subject, message, from_email, recipient_list,
+                flag_instance=None):
+        """
+        Store a mail to be sent by `flag.mails.dispatch_mails`
+        """
+        return self.create(subject=subject,
+                           message=message,
+                           from_email=from_email or '',
+                           recipients='\n'.join(recipient_list),
+                           flag_instance=flag_instance,
+                           next_try=timezone.now())
+
+    def claim(self, batch_size=100, lease=FLAG_MAIL_LEASE):
+        """
+        Return at most `batch_size` mails to send now, and mark them to not
+        be returned again before `lease` seconds, so many workers can run
+        together. A mail not sent nor retried in this delay (the worker was
+        stopped...) will be returned again.
+        """
+        now = timezone.now()
+        ids = list(self.filter(failed=False, next_try__lte=now)
+                       .order_by('next_try', 'id')
+                       .values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return []
+        token = uuid4().hex
+        # only mails not claimed by another worker since the select
+        self.filter(id__in=ids, failed=False, next_try__lte=now).update(
+            next_try=now + timedelta(seconds=lease), claim=token)
+        return list(self.filter(claim=token).order_by('id'))
+
+
+class FlagMail(models.Model):
+    """
+    A mail to send, stored in the outbox (see the SEND_MAILS_OUTBOX settings)
+    """
+    flag_instance = models.ForeignKey(FlagInstance,
+                                      related_name='mails',
+                                      null=True,
+                                      blank=True,
+                                      on_delete=models.SET_NULL)
+    subject = models.TextField()
+    message = models.TextField()
+    from_email = models.CharField(max_length=254, blank=True)
+    # one address by line
+    recipients = models.TextField()
+    when_added = models.DateTimeField(auto_now_add=True)
+    # when to (re)try to send this mail
+    next_try = models.DateTimeField(db_index=True)
+    tries = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    # True if not sent after SEND_MAILS_OUTBOX_MAX_TRIES tries
+    failed = models.BooleanField(default=False)
+    # set for the mails returned by `FlagMail.objects.claim`
+    claim = models.CharField(max_length=32, blank=True, db_index=True)
+
+    objects = FlagMailManager()
+
+    class Meta:
+        ordering = ('next_try', 'id')
+        # mails to send (see `FlagMailManager.claim`)
+        index_together = [('failed', 'next_try')]
+
+    def __unicode__(self):
+        return u'mail #%s: %s' % (self.id, self.subject)
+
+    def get_message(self, connection=None):
+        """
+        Return the EmailMessage to send
+        """
+        return EmailMessage(subject=self.subject,
+                            body=self.message,
+                            from_email=self.from_email or None,
+                            to=self.recipients.split('\n'),
+                            connection=connection)
+
+    def retry_later(self, error):
+        """
+        Called when the mail could not be sent: try again later, with a delay
+        doubled at each try, or give up after SEND_MAILS_OUTBOX_MAX_TRIES tries
+        """
+        self.tries += 1
+        self.last_error = force_unicode(error)
+        self.claim = ''
+        if self.tries >= flag_settings.SEND_MAILS_OUTBOX_MAX_TRIES:
+            self.failed = True
+        else:
+            self.next_try = timezone.now() + timedelta(
+                seconds=FLAG_MAIL_RETRY_DELAY * 2 ** (self.tries - 1))
+        self.save(update_fields=['tries', 'last_error', 'claim', 'failed',
+                                 'next_try'])
+
+
+class FlagDigestEntryManager(models.Manager):
+    """
+    Manager for the FlagDigestEntry model, to add flags to the next digests
+    """
+
+    def add(self, flag_instance, recipient_list, untrusted=False):
+        """
+        Add the flag to the next digest of each recipient. For a recipient
+        without waiting entries for the flagged model, the digest will be
+        sent after the SEND_MAILS_DIGEST_WINDOW settings of this model.
+        """
+        content_type_id = flag_instance.flagged_content.content_type_id
+        waiting = self.filter(recipient__in=recipient_list,
+                              flagged_content__content_type=content_type_id)
+        due_dates = dict(waiting.order_by()
+                                .values_list('recipient')
+                                .annotate(models.Min('due_at')))
+        default_due_at = timezone.now() + timedelta(
+            seconds=flag_instance.content_settings('SEND_MAILS_DIGEST_WINDOW'))
+        flagged_content_id = flag_instance.flagged_content_id
+        self.bulk_create([
+            FlagDigestEntry(recipient=recipient,
+                            flagged_content_id=flagged_content_id,
+                            user_id=flag_instance.user_id,
+                            untrusted=untrusted,
+                            due_at=due_dates.get(recipient, default_due_at))
+            for recipient in recipient_list])
+
+
+class FlagDigestEntry(models.Model):
+    """
+    A flag (or a flag attempt by an untrusted user) waiting to be sent in a
+    digest to a recipient (see the SEND_MAILS_DIGEST settings)
+    """
+    recipient = models.CharField(max_length=254)
+    flagged_content = models.ForeignKey(FlaggedContent,
+                                        related_name='digest_entries')
+    # the flagger
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             related_name='flag_digest_entries')
+    untrusted = models.BooleanField(default=False)
+    when_added = models.DateTimeField(auto_now_add=True)
+    # when to send the digest
+    due_at = models.DateTimeField(db_index=True)
+    # set while the digest is prepared
+    claim = models.CharField(max_length=32, blank=True, db_index=True)
+
+    objects = FlagDigestEntryManager()
+
+    class Meta:
+        ordering = ('due_at', 'id')
+        # entries of a digest (see `flag.mails.flush_digests`)
+        index_together = [('recipient', 'due_at')]
+
+    def __unicode__(self):
+        return u'digest entry for %s on %s' % (self.recipient,
+                                               self.flagged_content)
+
+
 def add_flag(flagger, content_type, object_id, content_creator, comment,
              status=None, send_signal=True, send_mails=True):
     """
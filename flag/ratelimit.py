@@ -0,0 +1,122 @@
+"""
+Limit of the number of flags a user can add on objects of a model (see the
+RATE_LIMIT settings), checked with the cache only, before any query.
+The limit is a sliding window counter (not a token bucket, which would
+need an atomic read and write of the cache): a user can add `number` flags on
+objects of a model in any window of `seconds` seconds. The window is
+estimated with the atomic increments of the cache, from the number of flags
+of the current period of `seconds` seconds, and the number of flags of the
+previous period weighted by the part of it still in the window.
+"""
+import time
+
+from django.core.cache import caches
+from django.utils.translation import ugettext as _
+
+from flag import settings as flag_settings
+from flag.exceptions import FlagRateLimitException
+from flag.utils import get_content_type_id
+
+# prefix of the keys with the number of flags of a user in a period
+KEY_PREFIX = 'flag:rate:'
+
+
+def get_cache():
+    """
+    Return the cache used for the limits (see the RATE_LIMIT_CACHE settings)
+    """
+    return caches[flag_settings.RATE_LIMIT_CACHE]
+
+
+def _is_used():
+    """
+    Return True if the RATE_LIMIT settings is set, globally or for a model
+    """
+    return bool(flag_settings.RATE_LIMIT) or any(
+        model_settings.get('RATE_LIMIT') for model_settings in
+        flag_settings.MODELS_SETTINGS.values())
+
+
+def _get_window(user, content_type):
+    """
+    Return the limit for the given user and content type (anything accepted
+    by `utils.get_content_type_tuple`), the keys of the current and previous
+    periods, and the part of the current period already elapsed.
+    The limit is None if there is none
+    """
+    if not _is_used():
+        # without resolving the content type
+        return None, None, None, None
+    content_type_id = get_content_type_id(content_type)
+    limit = flag_settings.get_for_content_type(content_type_id).RATE_LIMIT
+    if not limit:
+        return None, None, None, None
+    number, seconds = limit
+    period, elapsed = divmod(time.time(), seconds)
+    key = '%s%s:%s:%%d' % (KEY_PREFIX, user.pk, content_type_id)
+    return limit, key % period, key % (period - 1), elapsed / seconds
+
+
+def _flags_in_window(current, previous, elapsed):
+    """
+    Return the estimated number of flags in the sliding window
+    """
+    return (current or 0) + (previous or 0) * (1 - elapsed)
+
+
+def is_rate_limited(user, content_type):
+    """
+    Return True if the given user cannot flag an object of the given content
+    type (anything accepted by `utils.get_content_type_tuple`) because of the
+    RATE_LIMIT settings. No flag is counted
+    """
+    limit, key, previous_key, elapsed = _get_window(user, content_type)
+    if limit is None:
+        return False
+    values = get_cache().get_many([key, previous_key])
+    return _flags_in_window(values.get(key), values.get(previous_key),
+                            elapsed) >= limit[0]
+
+
+def count_flag(user, content_type):
+    """
+    Count a flag of the given user on an object of the given content type
+    (anything accepted by `utils.get_content_type_tuple`) in its window, or
+    raise a FlagRateLimitException if the window is full.
+    Return the key of the period the flag is counted in, to remove it with
+    `uncount_flag` if the flag is refused, or None if there is no limit
+    """
+    limit, key, previous_key, elapsed = _get_window(user, content_type)
+    if limit is None:
+        return None
+    number, seconds = limit
+    cache = get_cache()
+    # kept during this period and the next one
+    cache.add(key, 0, seconds * 2)
+    try:
+        current = cache.incr(key)
+    except ValueError:
+        # expired in between
+        cache.add(key, 0, seconds * 2)
+        current = cache.incr(key)
+    if _flags_in_window(current - 1, cache.get(previous_key),
+                        elapsed) >= number:
+        # a refused flag is not counted
+        cache.decr(key)
+        raise FlagRateLimitException(
+            _('You added too many flags, please try again later'))
+    return key
+
+
+def uncount_flag(key):
+    """
+    Remove a flag from the period of the given key (returned by
+    `count_flag`), for a flag which was refused after it was counted
+    """
+    if key is None:
+        return
+    try:
+        get_cache().decr(key)
+    except ValueError:
+        # expired in between
+        pass
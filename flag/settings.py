@@ -1,4 +1,9 @@
+import sys
+from bisect import bisect_right
+
 from django import conf
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 
 from flag.utils import get_content_type_tuple
@@ -14,7 +19,23 @@ __all__ = ('ALLOW_COMMENTS',
            'SEND_MAILS_FROM',
            'SEND_MAILS_RULES',
            'NEEDS_TRUST',
-           'TRUST_TIME')
+           'TRUST_TIME',
+           'FAST_ADD',
+           'SEND_MAILS_OUTBOX',
+           'SEND_MAILS_OUTBOX_MAX_TRIES',
+           'SEND_MAILS_OUTBOX_WORKERS',
+           'SEND_MAILS_DIGEST',
+           'SEND_MAILS_DIGEST_WINDOW',
+           'COUNTER_ENGINE',
+           'COUNTER_CACHE',
+           'COUNTER_FLUSH_THRESHOLD',
+           'RATE_LIMIT',
+           'RATE_LIMIT_CACHE',
+           'TRUST_EVAL_BATCH_FUNC',
+           'TRUST_CACHE',
+           'TRUST_CACHE_TIMEOUT',
+           'WIDGET_CACHE',
+           'WIDGET_CACHE_TIMEOUT')
 
 # keep the default values
 _DEFAULTS = dict(
@@ -38,6 +59,22 @@ _DEFAULTS = dict(
     SEND_MAILS_FROM=conf.settings.DEFAULT_FROM_EMAIL,
     SEND_MAILS_RULES=[(1, 1), ],
     MODELS_SETTINGS={},
+    FAST_ADD=False,
+    SEND_MAILS_OUTBOX=False,
+    SEND_MAILS_OUTBOX_MAX_TRIES=5,
+    SEND_MAILS_OUTBOX_WORKERS=0,
+    SEND_MAILS_DIGEST=False,
+    SEND_MAILS_DIGEST_WINDOW=3600,
+    COUNTER_ENGINE='db',
+    COUNTER_CACHE='default',
+    COUNTER_FLUSH_THRESHOLD=100,
+    RATE_LIMIT=None,
+    RATE_LIMIT_CACHE='default',
+    TRUST_EVAL_BATCH_FUNC=None,
+    TRUST_CACHE='default',
+    TRUST_CACHE_TIMEOUT=0,
+    WIDGET_CACHE='default',
+    WIDGET_CACHE_TIMEOUT=0,
 )
 
 # Set FLAG_ALLOW_COMMENTS to False in settings to not allow users to
@@ -59,6 +96,21 @@ TRUST_TIME = getattr(conf.settings,
 TRUST_EVAL_FUNC = getattr(conf.settings, 
                          'FLAG_TRUST_EVAL_FUNC',
                          _DEFAULTS['TRUST_EVAL_FUNC'])
+# The function that evaluate if many users can be trusted at once: it takes a
+# list of users and returns a dict with True or False for each user pk (see
+# `flag.utils.can_users_be_trusted`). If None, the TRUST_EVAL_FUNC one is
+# called for each user
+TRUST_EVAL_BATCH_FUNC = getattr(conf.settings,
+                                'FLAG_TRUST_EVAL_BATCH_FUNC',
+                                _DEFAULTS['TRUST_EVAL_BATCH_FUNC'])
+# The name of the cache (in the CACHES settings) where the trust of the users
+# is kept, and the number of seconds it is kept (0 to evaluate it each time)
+TRUST_CACHE = getattr(conf.settings,
+                      'FLAG_TRUST_CACHE',
+                      _DEFAULTS['TRUST_CACHE'])
+TRUST_CACHE_TIMEOUT = getattr(conf.settings,
+                              'FLAG_TRUST_CACHE_TIMEOUT',
+                              _DEFAULTS['TRUST_CACHE_TIMEOUT'])
 
 
 # Set FLAG_LIMIT_SAME_OBJECT_FOR_USER to a number in settings to limit the
@@ -75,6 +127,23 @@ LIMIT_FOR_OBJECT = getattr(conf.settings,
                            'FLAG_LIMIT_FOR_OBJECT',
                            _DEFAULTS['LIMIT_FOR_OBJECT'])
 
+# Set FLAG_RATE_LIMIT to a `(number, seconds)` tuple in settings to limit the
+# number of flags a user can add on objects of a model: at most `number` in
+# any window of `seconds` seconds (see `flag.ratelimit`). Flags added with a
+# status by the staff are not limited
+# If None, there is no limit
+RATE_LIMIT = getattr(conf.settings,
+                     'FLAG_RATE_LIMIT',
+                     _DEFAULTS['RATE_LIMIT'])
+
+# Set FLAG_RATE_LIMIT_CACHE to the name of the cache (in the CACHES settings)
+# used to count the flags of the users for the FLAG_RATE_LIMIT settings. It
+# must be shared by all the processes
+# Default to 'default'
+RATE_LIMIT_CACHE = getattr(conf.settings,
+                           'FLAG_RATE_LIMIT_CACHE',
+                           _DEFAULTS['RATE_LIMIT_CACHE'])
+
 # Set FLAG_MODELS to a list/tuple of models in your settings to limit the
 # models that can be flagged. The syntax to use is a string for each model :
 # FLAG_MODELS = ('myapp.mymodel', 'otherapp.othermodel',)
@@ -137,11 +206,116 @@ MODELS_SETTINGS = getattr(conf.settings,
                           "FLAG_MODELS_SETTINGS",
                           _DEFAULTS['MODELS_SETTINGS'])
 
+# Set FLAG_FAST_ADD to True to let `FlagInstance.objects.add` use a single
+# transaction with an upsert and an `UPDATE ... RETURNING` instead of the
+# multiple queries of the default path. Only used with database backends
+# supporting it (PostgreSQL >= 9.5 and SQLite >= 3.35), ignored otherwise
+# Default to False
+FAST_ADD = getattr(conf.settings, "FLAG_FAST_ADD", _DEFAULTS['FAST_ADD'])
+
+# Set FLAG_SEND_MAILS_OUTBOX to True to not send mails while a flag is added,
+# but store them in the database (the `FlagMail` model). They are then sent by
+# the `flag_dispatch_mail` management command, or by the worker threads (see
+# FLAG_SEND_MAILS_OUTBOX_WORKERS)
+# Default to False : mails are sent directly
+SEND_MAILS_OUTBOX = getattr(conf.settings,
+                            "FLAG_SEND_MAILS_OUTBOX",
+                            _DEFAULTS['SEND_MAILS_OUTBOX'])
+
+# Set FLAG_SEND_MAILS_OUTBOX_MAX_TRIES to the number of times we try to send
+# a mail of the outbox before giving up. Between two tries, the delay is
+# doubled, starting at one minute.
+# Default to 5
+SEND_MAILS_OUTBOX_MAX_TRIES = getattr(conf.settings,
+                                      "FLAG_SEND_MAILS_OUTBOX_MAX_TRIES",
+                                      _DEFAULTS['SEND_MAILS_OUTBOX_MAX_TRIES'])
+
+# Set FLAG_SEND_MAILS_OUTBOX_WORKERS to a number of threads to start in each
+# process serving requests, at its first request, to send the mails of the
+# outbox (only if FLAG_SEND_MAILS_OUTBOX is True)
+# Default to 0 : use the `flag_dispatch_mail` management command
+SEND_MAILS_OUTBOX_WORKERS = getattr(conf.settings,
+                                    "FLAG_SEND_MAILS_OUTBOX_WORKERS",
+                                    _DEFAULTS['SEND_MAILS_OUTBOX_WORKERS'])
+
+# Set FLAG_SEND_MAILS_DIGEST to True to not send a mail for each flag (and
+# each untrusted flagger) matching the SEND_MAILS_RULES, but to collect them
+# and send, to each recipient, one mail listing all the flagged objects,
+# every FLAG_SEND_MAILS_DIGEST_WINDOW seconds. The digests are stored in the
+# outbox (see FLAG_SEND_MAILS_OUTBOX) by the `flag_dispatch_mail` management
+# command or the workers
+# Default to False
+SEND_MAILS_DIGEST = getattr(conf.settings,
+                            "FLAG_SEND_MAILS_DIGEST",
+                            _DEFAULTS['SEND_MAILS_DIGEST'])
+
+# Set FLAG_SEND_MAILS_DIGEST_WINDOW to the number of seconds during which the
+# flags are collected for a digest, starting at the first one
+# Default to 3600 (one hour)
+SEND_MAILS_DIGEST_WINDOW = getattr(conf.settings,
+                                   "FLAG_SEND_MAILS_DIGEST_WINDOW",
+                                   _DEFAULTS['SEND_MAILS_DIGEST_WINDOW'])
+
+# Set FLAG_COUNTER_ENGINE to 'cache' to not update the `count` field of a
+# flagged content each time a flag is added by `FlagInstance.objects.add`,
+# but to count the new flags in the cache (see FLAG_COUNTER_CACHE) and add
+# them to the `count` field later, by the `flag_flush_counters` management
+# command or when FLAG_COUNTER_FLUSH_THRESHOLD flags are waiting for an object
+# (see `flag.counters`). The limits and the `flag_count` filter use both
+# counts.
+# Set it to 'trigger' to let database triggers maintain the `count` field
+# when flags are added, deleted or get a new status (see `flag.triggers`,
+# only for SQLite and PostgreSQL). They are installed by the migrations if
+# this settings is set when they are applied, else by the
+# `flag_count_triggers` management command.
+# Default to 'db' : the `count` field is updated for each flag
+COUNTER_ENGINE = getattr(conf.settings,
+                         "FLAG_COUNTER_ENGINE",
+                         _DEFAULTS['COUNTER_ENGINE'])
+
+# Set FLAG_COUNTER_CACHE to the name of the cache (in the CACHES settings)
+# used by the 'cache' counter engine. It must be shared by all the processes
+# (locmem can only be used with a single process)
+# Default to 'default'
+COUNTER_CACHE = getattr(conf.settings,
+                        "FLAG_COUNTER_CACHE",
+                        _DEFAULTS['COUNTER_CACHE'])
+
+# Set FLAG_COUNTER_FLUSH_THRESHOLD to the number of flags counted in the cache
+# for an object (with the 'cache' counter engine) for which they are added to
+# its `count` field without waiting for the `flag_flush_counters` command
+# Default to 100
+COUNTER_FLUSH_THRESHOLD = getattr(conf.settings,
+                                  "FLAG_COUNTER_FLUSH_THRESHOLD",
+                                  _DEFAULTS['COUNTER_FLUSH_THRESHOLD'])
+
+# Set FLAG_WIDGET_CACHE_TIMEOUT to a number of seconds to keep in the cache
+# (the FLAG_WIDGET_CACHE one) the forms rendered by the `flag_widget`
+# templatetag for each object. The forms rendered during the same period of
+# FLAG_WIDGET_CACHE_TIMEOUT seconds share the same timestamp, so it must be
+# lower than the two hours a form is valid.
+# Default to 0 : not kept
+WIDGET_CACHE = getattr(conf.settings,
+                       'FLAG_WIDGET_CACHE',
+                       _DEFAULTS['WIDGET_CACHE'])
+WIDGET_CACHE_TIMEOUT = getattr(conf.settings,
+                               'FLAG_WIDGET_CACHE_TIMEOUT',
+                               _DEFAULTS['WIDGET_CACHE_TIMEOUT'])
+
 # do not send mails if no recipients
 if SEND_MAILS and not SEND_MAILS_TO:
     SEND_MAILS = False
 
-_ONLY_GLOBAL_SETTINGS = ('MODELS', 'MODELS_SETTINGS',)
+_ONLY_GLOBAL_SETTINGS = ('MODELS', 'MODELS_SETTINGS', 'FAST_ADD',
+                         'SEND_MAILS_OUTBOX', 'SEND_MAILS_OUTBOX_MAX_TRIES',
+                         'SEND_MAILS_OUTBOX_WORKERS', 'COUNTER_ENGINE',
+                         'COUNTER_CACHE', 'COUNTER_FLUSH_THRESHOLD',
+                         'RATE_LIMIT_CACHE', 'TRUST_EVAL_BATCH_FUNC',
+                         'TRUST_CACHE', 'TRUST_CACHE_TIMEOUT',
+                         'WIDGET_CACHE', 'WIDGET_CACHE_TIMEOUT',)
+
+
+_module = sys.modules[__name__]
 
 
 def get_for_model(model, name):
@@ -150,9 +324,9 @@ def get_for_model(model, name):
     See `utils.get_content_type_tuple` for description of the `name` parameter
     The fallback in all case (all exceptions or simply no specific
     settings) is the basic settings
+    Prefer `get_for_content_type` when the content type id is known.
     """
-    from flag import settings as flag_settings
-    result = getattr(flag_settings, name)
+    result = getattr(_module, name)
     if name not in _ONLY_GLOBAL_SETTINGS:
         try:
             model_id = '%s.%s' % get_content_type_tuple(model)
@@ -162,3 +336,155 @@ def get_for_model(model, name):
             if name in MODELS_SETTINGS.get(model_id, {}):
                 result = MODELS_SETTINGS[model_id][name]
     return result
+
+
+class MailsSchedule(object):
+    """
+    The SEND_MAILS_RULES settings, compiled to find the rule to apply for a
+    count with a bisect
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        rules = sorted(rules)
+        self.min_counts = [min_count for min_count, step in rules]
+        self.steps = [step for min_count, step in rules]
+
+    def matches(self, first_count, last_count):
+        """
+        Return True if at least one count between `first_count` and
+        `last_count` (included) needs a mail
+        """
+        index = max(bisect_right(self.min_counts, first_count) - 1, 0)
+        while index < len(self.min_counts):
+            min_count, step = self.min_counts[index], self.steps[index]
+            if min_count > last_count:
+                break
+            # a rule apply until the min count of the next one
+            if index + 1 < len(self.min_counts):
+                max_count = min(last_count, self.min_counts[index + 1] - 1)
+            else:
+                max_count = last_count
+            start = max(first_count, min_count)
+            if step and start <= max_count and \
+                    start + (min_count - start) % step <= max_count:
+                return True
+            index += 1
+        return False
+
+
+# compiled schedules, by id of the SEND_MAILS_RULES they come from
+_mails_schedules = {}
+
+
+def get_mails_schedule(rules):
+    """
+    Return the MailsSchedule for the given SEND_MAILS_RULES settings,
+    compiled only once
+    """
+    schedule = _mails_schedules.get(id(rules))
+    if schedule is None or schedule.rules is not rules:
+        if len(_mails_schedules) > 100:
+            _mails_schedules.clear()
+        schedule = _mails_schedules[id(rules)] = MailsSchedule(rules)
+    return schedule
+
+
+class ModelSettings(object):
+    """
+    The settings for one model, as attributes: the ones defined for this
+    model in MODELS_SETTINGS are compiled in the object, the others are the
+    global ones.
+    Instances are read-only, and are returned by `get_for_content_type`
+    """
+
+    def __init__(self, model_id, model_settings):
+        self.__dict__['model_id'] = model_id
+        for name, value in model_settings.items():
+            if name not in _ONLY_GLOBAL_SETTINGS:
+                self.__dict__[name] = value
+
+    def __getattr__(self, name):
+        """
+        Not defined for this model: use the global settings
+        """
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(_module, name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Settings for a model are read-only")
+
+    @property
+    def mails_schedule(self):
+        """
+        The compiled SEND_MAILS_RULES settings for this model
+        """
+        return get_mails_schedule(self.SEND_MAILS_RULES)
+
+
+class _ModelsSettingsRegistry(object):
+    """
+    Store the ModelSettings objects by content type id. It is compiled from
+    MODELS_SETTINGS, and compiled again if MODELS_SETTINGS is replaced or if
+    a FLAG_* django setting is changed
+    """
+
+    def __init__(self):
+        self.compile()
+
+    def compile(self):
+        self.source = MODELS_SETTINGS
+        self.by_model = dict((model_id, ModelSettings(model_id, value))
+                             for model_id, value in MODELS_SETTINGS.items())
+        self.default = ModelSettings(None, {})
+        self.by_content_type = {None: self.default}
+
+    def get(self, content_type_id):
+        if self.source is not MODELS_SETTINGS:
+            self.compile()
+        try:
+            return self.by_content_type[content_type_id]
+        except KeyError:
+            try:
+                model_id = '%s.%s' % get_content_type_tuple(
+                    int(content_type_id))
+            except:
+                return self.default
+            result = self.by_content_type[content_type_id] = \
+                self.by_model.get(model_id, self.default)
+            return result
+
+_registry = _ModelsSettingsRegistry()
+
+
+def get_for_content_type(content_type_id):
+    """
+    Return the settings (a read-only ModelSettings object) for the model of
+    the given content type id. Each settings is an attribute of this object.
+    Only the first call for a content type can make a query (the content
+    type is not in the django cache)
+    """
+    return _registry.get(content_type_id)
+
+
+def compile_models_settings():
+    """
+    Compile again the settings of all models
+    """
+    _registry.compile()
+
+
+@receiver(setting_changed)
+def _update_settings(sender, setting, **kwargs):
+    """
+    Update the settings of this module, and the compiled ones, when a
+    `FLAG_*` django setting is changed (`override_settings` in tests...)
+    """
+    if not setting.startswith('FLAG_'):
+        return
+    name = setting[5:]
+    if name in _DEFAULTS:
+        setattr(_module, name, getattr(conf.settings, setting,
+                                       _DEFAULTS[name]))
+        compile_models_settings()
@@ -2,3 +2,13 @@ from django.dispatch import Signal
 
 content_flagged = Signal(providing_args=["flagged_content",
                                          "flagged_instance"])
+
+# sent once for each chunk of flags added by `FlagInstance.objects.bulk_add`
+# (the flag instances may have no pk, see `bulk_add`)
+contents_flagged = Signal(providing_args=["flagged_contents",
+                                          "flag_instances"])
+
+# sent once by `FlaggedContent.objects.bulk_set_status`
+contents_status_changed = Signal(providing_args=["flagged_content_ids",
+                                                 "status",
+                                                 "moderator"])
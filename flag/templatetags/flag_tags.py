@@ -3,6 +3,7 @@ from django import template
 from flag.forms import get_default_form
 from flag.views import get_next, get_confirm_url_for_object, can_be_flagged_by
 from flag.models import FlaggedContent
+from flag.widgets import render_widgets
 
 register = template.Library()
 
@@ -31,6 +32,49 @@ def flag_with_status(context, content_object, creator_field=None):
     return flag(context, content_object, creator_field, True)
 
 
+@register.simple_tag(takes_context=True)
+def flag_widget(context, content_object, creator_field=None,
+                with_status=False):
+    """
+    This templatetag will display the same form as the `flag` one, rendered
+    without building a form, with the `flag/flag_widget.html` template
+    compiled once for each model (see `flag.widgets`). The HMAC key of the
+    security hash is derived once for the request. To use for many objects
+    in a page.
+    Usage : {% flag_widget some_object %}
+    Or : {% flag_widget some_object "some_field" True %}
+    """
+    if not content_object:
+        return ''
+    request = context.get('request', None)
+    generators = getattr(request, '_flag_security_data_generators', None)
+    if generators is None:
+        generators = {}
+        if request is not None:
+            request._flag_security_data_generators = generators
+    return render_widgets([content_object], context.get('csrf_token'),
+                          get_next(request), creator_field, with_status,
+                          generators)[0]
+
+
+@register.simple_tag(takes_context=True)
+def prefetch_flags(context, content_objects, user=None):
+    """
+    This templatetag will load, in two queries, the flags informations
+    for all the given objects, to be used by the `flag_count`, `flag_status`
+    and `can_be_flagged_by` filters without any other query.
+    The user is the one in the context if not given.
+    Usage : {% prefetch_flags object_list %}
+    Or : {% prefetch_flags object_list some_user %}
+    """
+    if user is None:
+        user = context.get('user', None)
+        if user is None and context.get('request', None) is not None:
+            user = getattr(context['request'], 'user', None)
+    FlaggedContent.objects.get_for_objects(content_objects or [], user)
+    return ''
+
+
 @register.filter
 def flag_count(content_object):
     """
@@ -38,7 +82,8 @@ def flag_count(content_object):
     Usage : {{ some_object|flag_count }}
     """
     try:
-        return FlaggedContent.objects.get_for_object(content_object).count
+        return FlaggedContent.objects.get_prefetched_for_object(
+            content_object).current_count
     except:
         return 0
 
@@ -52,7 +97,8 @@ def flag_status(content_object, full=False):
     Usage : {{ some_object|flag_status:"text" }}
     """
     try:
-        flagged_content = FlaggedContent.objects.get_for_object(content_object)
+        flagged_content = FlaggedContent.objects.get_prefetched_for_object(
+            content_object)
         if full:
             return flagged_content.get_status_display()
         return flagged_content.status
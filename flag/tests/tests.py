@@ -1,31 +1,49 @@
 from copy import copy
+import json
+import re
 import time
 import os
+from tempfile import mkdtemp
 
 from datetime import datetime, timedelta
-from django.test import TestCase
+from django.test import TestCase, RequestFactory
 from django.contrib.auth.models import User, AnonymousUser
 from django.contrib.contenttypes.models import ContentType
-from django.db import IntegrityError
-from django.core.management import call_command
-from django.db.models import ObjectDoesNotExist
+from django.db import IntegrityError, connection
+from django.core.management import call_command, CommandError
+from django.db.models import ObjectDoesNotExist, Sum
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.http import HttpResponseRedirect
 from django.core import mail
-
-from flag.models import FlaggedContent, FlagInstance, add_flag
+from django.core.cache import caches
+from django.core.signals import request_started
+from django.core.mail.backends.base import BaseEmailBackend
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.utils import timezone
+from django.apps import apps
+
+from flag.models import (FlaggedContent, FlagInstance, FlagMail,
+                         FlagDigestEntry, FlagUserCount, add_flag,
+                         fast_add_supported, are_users_trusted)
+from flag.mails import dispatch_mails, flush_digests
+from flag import benchmarks, counters, mails, ratelimit, triggers
 from flag.tests.models import ModelWithoutAuthor, ModelWithAuthor
 from flag import settings as flag_settings
+from flag import views
 from flag.exceptions import *
-from flag.signals import content_flagged
+from flag.signals import (content_flagged, contents_flagged,
+                          contents_status_changed)
 from flag.templatetags import flag_tags
 from flag.forms import (FlagForm, FlagFormWithCreator, get_default_form,
-        FlagFormWithStatus, FlagFormWithCreatorAndStatus)
+        FlagFormWithStatus, FlagFormWithCreatorAndStatus,
+        SecurityDataGenerator, SECURITY_TIMESTAMP_MAX_AGE)
+from flag.widgets import MAX_CACHE_TIMEOUT
 from flag.views import (get_confirm_url_for_object,
                        get_content_object,
                        FlagBadRequest)
-from flag.utils import get_content_type_tuple
+from flag.utils import (get_content_type_tuple, get_content_type_id,
+                        content_type_cache_info, clear_content_type_cache)
 
 
 class BaseTestCase(TestCase):
@@ -97,9 +115,10 @@ class BaseTestCase(TestCase):
         Save old flag settings and set them to default
         """
         super(BaseTestCase, self).setUp()
+        keys = flag_settings.__all__ + ('MODELS_SETTINGS',)
         self._original_flag_settings = dict((key, getattr(flag_settings, key))
-                for key in flag_settings.__all__)
-        for key in flag_settings.__all__:
+                for key in keys)
+        for key in keys:
             setattr(flag_settings, key, flag_settings._DEFAULTS[key])
 
     def tearDown(self):
@@ -276,6 +295,107 @@ class ModelsTestCase(BaseTestCaseWithData):
         self.assertNotRaises(
             self._add_flagged_content, self.model_with_author)
 
+    def test_content_object_not_loaded(self):
+        """
+        Test that the settings, the status display and the count update of a
+        flagged content do not load the flagged object
+        """
+        flagged_content = self._add_flagged_content(self.model_without_author)
+        flagged_content = FlaggedContent.objects.get(id=flagged_content.id)
+        flag_instance = FlagInstance(flagged_content=flagged_content,
+                                     user=self.user)
+        flagged_content.settings
+
+        with self.assertNumQueries(0):
+            self.assertEqual(flagged_content.get_status_display(),
+                             dict(flag_settings.STATUSES)[1])
+            self.assertEqual(flagged_content.content_settings('STATUSES'),
+                             flag_settings.STATUSES)
+
+        # one query to update, one to get the new count
+        with self.assertNumQueries(2):
+            flagged_content.flag_added(flag_instance)
+        self.assertEqual(flagged_content.count, 1)
+
+    def test_flags_count_by_user(self):
+        """
+        Test that the number of flags by user is kept up to date
+        """
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 3
+        flag_instance = FlagInstance.objects.add(
+                self.user, self.model_without_author, comment='comment')
+        FlagInstance.objects.add(
+                self.user, self.model_without_author, comment='comment')
+        FlagInstance.objects.add(
+                self.author, self.model_without_author, comment='comment')
+        flagged_content = FlaggedContent.objects.get_for_object(
+                self.model_without_author)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(flagged_content.count_flags_by_user(self.user),
+                             2)
+        self.assertEqual(flagged_content.count_flags_by_user(self.author), 1)
+        self.assertEqual(
+            flagged_content.count_flags_by_user(self.staff_user), 0)
+
+        # the limit uses the counts
+        FlagInstance.objects.add(
+                self.user, self.model_without_author, comment='comment')
+        self.assertRaises(ContentAlreadyFlaggedByUserException,
+                          FlagInstance.objects.add,
+                          self.user, self.model_without_author,
+                          comment='comment')
+
+        # deleting flags decrements the count
+        flag_instance.delete()
+        self.assertEqual(flagged_content.count_flags_by_user(self.user), 2)
+        FlagInstance.objects.filter(user=self.author).delete()
+        self.assertEqual(flagged_content.count_flags_by_user(self.author), 0)
+
+        # bulk add
+        FlagInstance.objects.bulk_add(
+            [(self.user, self.model_without_author, 'comment'),
+             (self.author, self.model_without_author, 'comment'),
+             (self.author, self.model_with_author, 'comment'),
+             (self.author, self.model_with_author, 'comment')])
+        self.assertEqual(flagged_content.count_flags_by_user(self.user), 3)
+        self.assertEqual(flagged_content.count_flags_by_user(self.author), 1)
+        self.assertEqual(FlaggedContent.objects.get_for_object(
+            self.model_with_author).count_flags_by_user(self.author), 2)
+        self.assertEqual(
+            sorted(FlagUserCount.objects.values_list('count', flat=True)),
+            [1, 2, 3])
+
+    def test_flags_count_by_user_delete(self):
+        """
+        Test that deleting flags updates the counts with one UPDATE by user,
+        and that deleting a flagged content deletes its counts without
+        updating them
+        """
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 0
+        for user in (self.user, self.user, self.user, self.author):
+            flag_instance = FlagInstance.objects.add(
+                user, self.model_without_author, comment='comment')
+        flagged_content = flag_instance.flagged_content
+        table = FlagUserCount._meta.db_table
+
+        def count_updates(context):
+            return len([query for query in context.captured_queries
+                        if 'UPDATE' in query['sql'] and
+                        table in query['sql']])
+
+        with CaptureQueriesContext(connection) as context:
+            FlagInstance.objects.filter(id__in=FlagInstance.objects.filter(
+                user=self.user).values_list('id', flat=True)[:2]).delete()
+        self.assertEqual(count_updates(context), 1)
+        self.assertEqual(flagged_content.count_flags_by_user(self.user), 1)
+        self.assertEqual(flagged_content.count_flags_by_user(self.author), 1)
+
+        with CaptureQueriesContext(connection) as context:
+            flagged_content.delete()
+        self.assertEqual(count_updates(context), 0)
+        self.assertEqual(FlagUserCount.objects.count(), 0)
+
     def test_flagged_content_unicity_without_author(self):
         """
         Test that we cannot add more than one FlaggedContent for the same
@@ -490,9 +610,32 @@ class ModelsTestCase(BaseTestCaseWithData):
         flag_instance.save()
         self.assertEqual(flag_instance.flagged_content.count, previous_count)
 
-        # add a flag with a moderation status : the count shouldn't change
+        # add a flag with a moderation status : as with `bulk_set_status`,
+        # it's set to all the flags, so none is counted
         flag_instance = add(status=2)
-        self.assertEqual(flag_instance.flagged_content.count, previous_count)
+        self.assertEqual(flag_instance.flagged_content.count, 0)
+        self.assertEqual(FlagInstance.objects.filter(status=2).count(), 3)
+
+        # as with the triggers, only the flags with the default status are
+        # counted, when they get or lose it, or are deleted
+        def get_count():
+            return FlaggedContent.objects.get(
+                id=flag_instance.flagged_content_id).count
+        flag_instance.status = 1
+        flag_instance.save()
+        self.assertEqual(get_count(), 1)
+        flag_instance.status = 3
+        flag_instance.save()
+        self.assertEqual(get_count(), 0)
+        flag_instance.status = 1
+        flag_instance.save()
+        flag_instance.delete()
+        self.assertEqual(get_count(), 0)
+
+        # the default status given back counts all the flags
+        self.assertEqual(add(status=1).flagged_content.count, 3)
+        FlagInstance.objects.all().delete()
+        self.assertEqual(get_count(), 0)
 
     def test_count_flags_by_user(self):
         """
@@ -738,6 +881,1384 @@ class ModelsTestCase(BaseTestCaseWithData):
         self.assertEqual(flagged_objects[0].id, self.model_without_author.id)
 
 
+class FastAddModelsTestCase(ModelsTestCase):
+    """
+    Run the models tests with the FAST_ADD settings
+    """
+
+    def setUp(self):
+        """
+        Activate the FAST_ADD settings
+        """
+        super(FastAddModelsTestCase, self).setUp()
+        if not fast_add_supported(connection):
+            self.skipTest('FAST_ADD not supported by the database')
+        flag_settings.FAST_ADD = True
+
+    def test_fast_add_queries(self):
+        """
+        Test that the fast add only use the upsert, the update, the insert
+        and the upsert of the user count (with the savepoint queries of the
+        transaction)
+        """
+        flag_settings.LIMIT_FOR_OBJECT = 10
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 5
+        ContentType.objects.get_for_model(self.model_without_author)
+
+        with self.assertNumQueries(6):
+            flag_instance = FlagInstance.objects.add(
+                    self.user, self.model_without_author, comment='comment')
+        self.assertEqual(flag_instance.flagged_content.count, 1)
+
+        with self.assertNumQueries(6):
+            flag_instance = FlagInstance.objects.add(
+                    self.user, self.model_without_author, comment='comment')
+        self.assertEqual(flag_instance.flagged_content.count, 2)
+        self.assertEqual(FlaggedContent.objects.get_for_object(
+                self.model_without_author).count, 2)
+
+    def test_fast_add_rollback(self):
+        """
+        Test that nothing is saved if the flag cannot be added
+        """
+        flag_settings.ALLOW_COMMENTS = True
+        self.assertRaises(FlagCommentException, FlagInstance.objects.add,
+                          self.user, self.model_without_author)
+        self.assertEqual(FlaggedContent.objects.count(), 0)
+        self.assertEqual(FlagInstance.objects.count(), 0)
+
+
+class CacheCounterTestCase(BaseTestCaseWithData):
+    """
+    Class to test the counting of flags in the cache (the 'cache'
+    COUNTER_ENGINE settings)
+    """
+
+    def setUp(self):
+        super(CacheCounterTestCase, self).setUp()
+        counters.get_cache().clear()
+        flag_settings.COUNTER_ENGINE = 'cache'
+        flag_settings.COUNTER_FLUSH_THRESHOLD = 3
+
+    def test_threshold(self):
+        """
+        Test that the flags are added to the count at the threshold, and
+        that the limits use the flags waiting in the cache
+        """
+        flag_settings.LIMIT_FOR_OBJECT = 4
+        for i in range(2):
+            flag_instance = FlagInstance.objects.add(
+                self.user, self.model_without_author, comment='comment')
+        flagged_content = FlaggedContent.objects.get_for_object(
+            self.model_without_author)
+        self.assertEqual(flagged_content.count, 0)
+        self.assertEqual(flagged_content.current_count, 2)
+        self.assertEqual(flag_instance.flagged_content.current_count, 2)
+        self.assertEqual(flag_tags.flag_count(self.model_without_author), 2)
+
+        flag_instance = FlagInstance.objects.add(
+            self.user, self.model_without_author, comment='comment')
+        # the flushed flags are counted without reading the row again
+        self.assertEqual(flag_instance.flagged_content.count, 3)
+        self.assertEqual(flag_instance.flagged_content.pending_count, 0)
+        flagged_content = FlaggedContent.objects.get_for_object(
+            self.model_without_author)
+        self.assertEqual(flagged_content.count, 3)
+        self.assertEqual(flagged_content.pending_count, 0)
+
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        self.assertRaises(ContentFlaggedEnoughException,
+                          FlagInstance.objects.add, self.user,
+                          self.model_without_author, comment='comment')
+        results = FlagInstance.objects.bulk_add(
+            [(self.user, self.model_without_author, 'comment')])
+        self.assertTrue(isinstance(results[0], ContentFlaggedEnoughException))
+
+    def test_row_not_updated(self):
+        """
+        Test that adding a flag with the default status, as the `flag` view
+        does, neither updates nor reads again the FlaggedContent row
+        """
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        table = FlaggedContent._meta.db_table
+        with CaptureQueriesContext(connection) as context:
+            flag_instance = FlagInstance.objects.add(
+                self.author, self.model_without_author, comment='comment',
+                status=flag_settings.DEFAULT_STATUS)
+        queries = [query['sql'] for query in context.captured_queries
+                   if table in query['sql']]
+        self.assertEqual(len(queries), 1)
+        self.assertFalse('UPDATE' in queries[0])
+        self.assertEqual(flag_instance.flagged_content.current_count, 2)
+
+    def test_bulk_set_status(self):
+        """
+        Test that the flags waiting in the cache are not counted twice when
+        the counts are computed again by `bulk_set_status`
+        """
+        for user in (self.user, self.author):
+            FlagInstance.objects.add(user, self.model_without_author,
+                                     comment='comment')
+        FlaggedContent.objects.bulk_set_status(FlaggedContent.objects.all(),
+                                               1, self.staff_user)
+        flagged_content = FlaggedContent.objects.get_for_object(
+            self.model_without_author)
+        self.assertEqual(flagged_content.count, 2)
+        self.assertEqual(flagged_content.pending_count, 0)
+        counters.flush_counters()
+        self.assertEqual(FlaggedContent.objects.get_for_object(
+            self.model_without_author).count, 2)
+
+    def test_flush_counters(self):
+        """
+        Test that all the waiting flags are added to the counts
+        """
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        FlagInstance.objects.add(self.user, self.model_with_author,
+                                 comment='comment')
+        FlagInstance.objects.add(self.user, self.model_with_author,
+                                 comment='comment')
+        self.assertEqual(FlaggedContent.objects.aggregate(
+            total=Sum('count'))['total'], 0)
+
+        self.assertEqual(counters.flush_counters(), 3)
+        self.assertEqual(FlaggedContent.objects.get_for_object(
+            self.model_without_author).count, 1)
+        self.assertEqual(FlaggedContent.objects.get_for_object(
+            self.model_with_author).count, 2)
+        self.assertEqual(counters.flush_counters(), 0)
+
+        FlagInstance.objects.add(self.user, self.model_with_author,
+                                 comment='comment')
+        self.assertEqual(counters.flush_counters(), 1)
+        self.assertEqual(FlaggedContent.objects.get_for_object(
+            self.model_with_author).current_count, 3)
+
+    def test_log_entry_not_written(self):
+        """
+        Test that an entry of the log not written yet when the counters are
+        flushed is read by the next flush, or given up
+        """
+        cache = counters.get_cache()
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        flagged_content = FlaggedContent.objects.get_for_object(
+            self.model_without_author)
+        # an index taken by `_log`, without its entry yet
+        index = counters._incr(cache, counters.LOG_KEY)
+        FlagInstance.objects.add(self.user, self.model_with_author,
+                                 comment='comment')
+
+        # the entries around are flushed, the log is kept from the missing one
+        self.assertEqual(counters.flush_counters(), 2)
+        self.assertEqual(cache.get(counters.FLUSHED_KEY), index - 1)
+        cache.set('%s:%d' % (counters.LOG_KEY, index), flagged_content.id,
+                  None)
+        cache.set(counters._key(flagged_content.id), 2, None)
+        self.assertEqual(counters.flush_counters(), 2)
+        self.assertEqual(FlaggedContent.objects.get(
+            id=flagged_content.id).count, 3)
+        self.assertEqual(cache.get(counters.FLUSHED_KEY),
+                         cache.get(counters.LOG_KEY))
+
+        # never written
+        index = counters._incr(cache, counters.LOG_KEY)
+        for i in range(counters.LOG_MAX_WAITS - 1):
+            counters.flush_counters()
+            self.assertEqual(cache.get(counters.FLUSHED_KEY), index - 1)
+        counters.flush_counters()
+        self.assertEqual(cache.get(counters.FLUSHED_KEY), index)
+
+
+class TriggerCounterTestCase(BaseTestCaseWithData):
+    """
+    Class to test the counts maintained by database triggers (the 'trigger'
+    COUNTER_ENGINE settings)
+    """
+
+    def setUp(self):
+        super(TriggerCounterTestCase, self).setUp()
+        if not triggers.triggers_supported(connection):
+            self.skipTest('Triggers not supported by the database')
+        flag_settings.COUNTER_ENGINE = 'trigger'
+        triggers.install_triggers(connection)
+
+    def tearDown(self):
+        triggers.remove_triggers(connection)
+        super(TriggerCounterTestCase, self).tearDown()
+
+    def get_count(self, content_object):
+        return FlaggedContent.objects.get_for_object(content_object).count
+
+    def test_counts(self):
+        """
+        Test that the count is maintained when flags are added, deleted or
+        get a new status, even without the models methods
+        """
+        flag_settings.LIMIT_FOR_OBJECT = 3
+        flag_instance = FlagInstance.objects.add(
+            self.user, self.model_without_author, comment='comment')
+        self.assertEqual(flag_instance.flagged_content.count, 1)
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        FlagInstance.objects.bulk_add(
+            [(self.user, self.model_with_author, 'comment')] * 2)
+        self.assertEqual(self.get_count(self.model_without_author), 2)
+        self.assertEqual(self.get_count(self.model_with_author), 2)
+
+        FlagInstance.objects.filter(id=flag_instance.id).delete()
+        self.assertEqual(self.get_count(self.model_without_author), 1)
+
+        FlaggedContent.objects.bulk_set_status(
+            FlaggedContent.objects.filter(
+                id=flag_instance.flagged_content.id), 2, self.staff_user)
+        self.assertEqual(self.get_count(self.model_without_author), 0)
+        self.assertEqual(self.get_count(self.model_with_author), 2)
+
+        FlagInstance.objects.add(self.user, self.model_with_author,
+                                 comment='comment')
+        self.assertEqual(self.get_count(self.model_with_author), 3)
+        self.assertRaises(ContentFlaggedEnoughException,
+                          FlagInstance.objects.add, self.user,
+                          self.model_with_author, comment='comment')
+
+    def test_install_counts(self):
+        """
+        Test that the counts are computed again when the triggers are
+        installed
+        """
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        FlaggedContent.objects.update(count=10)
+        triggers.install_triggers(connection)
+        self.assertEqual(self.get_count(self.model_without_author), 1)
+
+    def test_full_save(self):
+        """
+        Test that a full save of a flagged content does not write its stale
+        count
+        """
+        flag_instance = FlagInstance.objects.add(
+            self.user, self.model_without_author, comment='comment')
+        flagged_content = FlaggedContent.objects.get(
+            id=flag_instance.flagged_content_id)
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        flagged_content.status = 2
+        flagged_content.save()
+        flagged_content = FlaggedContent.objects.get(id=flagged_content.id)
+        self.assertEqual(flagged_content.status, 2)
+        self.assertEqual(flagged_content.count, 2)
+
+    def test_check(self):
+        """
+        Test that the system check fails only if the triggers are missing
+        with the 'trigger' COUNTER_ENGINE settings
+        """
+        self.assertEqual(triggers.check_triggers(), [])
+        triggers.remove_triggers(connection)
+        self.assertEqual([error.id for error in triggers.check_triggers()],
+                         ['flag.E002'])
+        flag_settings.COUNTER_ENGINE = 'db'
+        self.assertEqual(triggers.check_triggers(), [])
+
+
+class RateLimitTestCase(BaseTestCaseWithData):
+    """
+    Class to test the RATE_LIMIT settings
+    """
+
+    def setUp(self):
+        super(RateLimitTestCase, self).setUp()
+        ratelimit.get_cache().clear()
+        flag_settings.RATE_LIMIT = (2, 60)
+
+    def test_add(self):
+        """
+        Test that the flags above the limit are refused before any query
+        """
+        for i in range(2):
+            FlagInstance.objects.add(self.user, self.model_without_author,
+                                     comment='comment')
+        self.assertTrue(ratelimit.is_rate_limited(self.user,
+                                                  self.model_without_author))
+        with self.assertNumQueries(0):
+            self.assertRaises(FlagRateLimitException,
+                              FlagInstance.objects.add, self.user,
+                              self.model_without_author, comment='comment')
+        self.assertEqual(FlagInstance.objects.count(), 2)
+
+        # by user and by model, and not for the staff setting a status
+        self.assertFalse(ratelimit.is_rate_limited(self.author,
+                                                   self.model_without_author))
+        self.assertFalse(ratelimit.is_rate_limited(self.user,
+                                                   self.model_with_author))
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment', status=2)
+
+        # by model settings
+        flag_settings.MODELS_SETTINGS = {
+            'tests.modelwithoutauthor': {'RATE_LIMIT': None}}
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+
+    def test_refused_flag(self):
+        """
+        Test that a flag refused for another reason than the limit, or not
+        saved because the user is not trusted, is not counted, and that the
+        content type is not resolved without any limit
+        """
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 1
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        for i in range(2):
+            self.assertRaises(ContentAlreadyFlaggedByUserException,
+                              FlagInstance.objects.add, self.user,
+                              self.model_without_author, comment='comment')
+        # only the first flag is counted
+        self.assertFalse(ratelimit.is_rate_limited(self.user,
+                                                   self.model_without_author))
+
+        flag_settings.NEEDS_TRUST = True
+        untrusted_user = User.objects.create_user(
+                username='%s-untrusted' % self.USER_BASE,
+                email='%s-untrusted@example.com' % self.USER_BASE,
+                password=self.USER_BASE)
+        for i in range(2):
+            flag_instance = FlagInstance.objects.add(
+                untrusted_user, self.model_with_author, comment='comment')
+            self.assertEqual(flag_instance.pk, None)
+        self.assertFalse(ratelimit.is_rate_limited(untrusted_user,
+                                                   self.model_with_author))
+
+        flag_settings.RATE_LIMIT = None
+        ContentType.objects.clear_cache()
+        with self.assertNumQueries(0):
+            self.assertEqual(ratelimit.count_flag(self.user,
+                                                  self.model_with_author),
+                             None)
+
+    def test_view(self):
+        """
+        Test that the view refuses the flags above the limit before getting
+        the object
+        """
+        flag_settings.RATE_LIMIT = (1, 60)
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        request = RequestFactory().post(
+            '/flag/', {'content_type': 'tests.modelwithoutauthor',
+                       'object_pk': self.model_without_author.pk,
+                       'comment': 'comment'},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        request.user = self.user
+        with self.assertNumQueries(0):
+            response = views.flag(request)
+        self.assertEqual(response.status_code, 429)
+
+
+class BulkAddTestCase(BaseTestCaseWithData):
+    """
+    Class to test the `bulk_add` method of the FlagInstance manager
+    """
+
+    def test_bulk_add(self):
+        """
+        Test adding many flags at once, with limits
+        """
+        flag_settings.LIMIT_FOR_OBJECT = 3
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 2
+        flags = [(self.user, self.model_without_author, 'comment'),
+                 (self.user, self.model_with_author, 'comment'),
+                 (self.user, self.model_without_author, 'comment'),
+                 (self.user, self.model_without_author, 'comment'),
+                 (self.author, self.model_without_author, 'comment'),
+                 (self.author, self.model_without_author, 'comment'),
+                 (self.author, self.model_with_author, None)]
+        results = FlagInstance.objects.bulk_add(flags)
+
+        self.assertTrue(isinstance(results[0], FlagInstance))
+        self.assertTrue(isinstance(results[1], FlagInstance))
+        self.assertTrue(isinstance(results[2], FlagInstance))
+        self.assertTrue(isinstance(results[3],
+                                   ContentAlreadyFlaggedByUserException))
+        self.assertTrue(isinstance(results[4], FlagInstance))
+        self.assertTrue(isinstance(results[5],
+                                   ContentFlaggedEnoughException))
+        self.assertTrue(isinstance(results[6], FlagCommentException))
+
+        self.assertEqual(FlagInstance.objects.count(), 4)
+        self.assertEqual(FlaggedContent.objects.get_for_object(
+                self.model_without_author).count, 3)
+        self.assertEqual(FlaggedContent.objects.get_for_object(
+                self.model_with_author).count, 1)
+
+        # limits are checked with existing flags
+        results = FlagInstance.objects.bulk_add(
+            [(self.user, self.model_with_author, 'comment'),
+             (self.user, self.model_with_author, 'comment')])
+        self.assertTrue(isinstance(results[0], FlagInstance))
+        self.assertTrue(isinstance(results[1],
+                                   ContentAlreadyFlaggedByUserException))
+
+    def test_bulk_add_status(self):
+        """
+        Test that the status and moderator are updated
+        """
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        results = FlagInstance.objects.bulk_add(
+            [(self.staff_user, self.model_without_author, 'comment', 2),
+             (self.user, self.model_with_author, 'comment', 3)])
+        self.assertEqual(results[0].status, 2)
+
+        flagged_content = FlaggedContent.objects.get_for_object(
+                self.model_without_author)
+        self.assertEqual(flagged_content.status, 2)
+        self.assertEqual(flagged_content.moderator, self.staff_user)
+        self.assertEqual(flagged_content.count, 1)
+
+        flagged_content = FlaggedContent.objects.get_for_object(
+                self.model_with_author)
+        self.assertEqual(flagged_content.status, 3)
+        self.assertEqual(flagged_content.count, 0)
+
+    def test_bulk_set_status(self):
+        """
+        Test setting a status to many flagged contents and their flags, with
+        one signal
+        """
+        received = []
+
+        def receive_signal(sender, flagged_content_ids, status, moderator,
+                           **kwargs):
+            received.append((sorted(flagged_content_ids), status, moderator))
+
+        FlagInstance.objects.bulk_add(
+            [(self.user, self.model_without_author, 'comment'),
+             (self.user, self.model_with_author, 'comment'),
+             (self.author, self.model_with_author, 'comment')])
+        ids = sorted(FlaggedContent.objects.values_list('id', flat=True))
+
+        contents_status_changed.connect(receive_signal)
+        try:
+            count = FlaggedContent.objects.bulk_set_status(
+                FlaggedContent.objects.all(), 2, self.staff_user,
+                batch_size=1)
+        finally:
+            contents_status_changed.disconnect(receive_signal)
+
+        self.assertEqual(count, 2)
+        self.assertEqual(received, [(ids, 2, self.staff_user)])
+        for flagged_content in FlaggedContent.objects.all():
+            self.assertEqual(flagged_content.status, 2)
+            self.assertEqual(flagged_content.moderator, self.staff_user)
+            # like with the triggers: no flags with the default status
+            self.assertEqual(flagged_content.count, 0)
+        self.assertEqual(set(FlagInstance.objects.values_list('status',
+                                                              flat=True)),
+                         set([2]))
+
+        # back to the default status, the flags are counted again
+        FlaggedContent.objects.bulk_set_status(FlaggedContent.objects.all(),
+                                               1, self.staff_user)
+        self.assertEqual(FlaggedContent.objects.get_for_object(
+            self.model_without_author).count, 1)
+        self.assertEqual(FlaggedContent.objects.get_for_object(
+            self.model_with_author).count, 2)
+
+        self.assertEqual(FlaggedContent.objects.bulk_set_status(
+            FlaggedContent.objects.none(), 1, self.staff_user), 0)
+
+    def test_bulk_add_forbidden_model(self):
+        """
+        Test that flags on forbidden models are not added
+        """
+        flag_settings.MODELS = ('tests.modelwithauthor',)
+        results = FlagInstance.objects.bulk_add(
+            [(self.user, self.model_without_author, 'comment'),
+             (self.user, self.model_with_author, 'comment')])
+        self.assertTrue(isinstance(results[0], ModelCannotBeFlaggedException))
+        self.assertTrue(isinstance(results[1], FlagInstance))
+
+    def test_bulk_add_signal_and_mails(self):
+        """
+        Test that one signal is sent by chunk, and one mail by object
+        """
+        received = []
+
+        def receive_signal(sender, flagged_contents, flag_instances,
+                           **kwargs):
+            received.append((flagged_contents, flag_instances))
+
+        contents_flagged.connect(receive_signal)
+        mail.outbox = []
+        flag_settings.SEND_MAILS = True
+        flag_settings.SEND_MAILS_RULES = [(1, 1), (4, 3)]
+        try:
+            FlagInstance.objects.bulk_add(
+                [(self.user, self.model_without_author, 'comment')] * 3 +
+                [(self.user, self.model_with_author, 'comment')] * 2,
+                send_signal=True, send_mails=True, batch_size=3)
+        finally:
+            contents_flagged.disconnect(receive_signal)
+
+        self.assertEqual(len(received), 2)
+        self.assertEqual(len(received[0][0]), 1)
+        self.assertEqual(len(received[0][1]), 3)
+        self.assertEqual(len(received[1][0]), 1)
+        self.assertEqual(len(received[1][1]), 2)
+        self.assertEqual(len(mail.outbox), 2)
+
+        # 3, 4: one mail
+        mail.outbox = []
+        FlagInstance.objects.bulk_add(
+            [(self.user, self.model_with_author, 'comment')] * 2,
+            send_mails=True)
+        self.assertEqual(len(mail.outbox), 1)
+        # 5, 6: no rule match
+        mail.outbox = []
+        FlagInstance.objects.bulk_add(
+            [(self.user, self.model_with_author, 'comment')] * 2,
+            send_mails=True)
+        self.assertEqual(len(mail.outbox), 0)
+        # 7: match
+        FlagInstance.objects.bulk_add(
+            [(self.user, self.model_with_author, 'comment')],
+            send_mails=True)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_need_mails(self):
+        """
+        Test the rules of mails on ranges of counts
+        """
+        flagged_content = self._add_flagged_content(self.model_without_author)
+        flag_settings.SEND_MAILS = True
+        flag_settings.SEND_MAILS_RULES = [(1, 1), (4, 3), (10, 5)]
+        counts = [count for count in range(1, 30)
+                  if flagged_content.need_mails(count)]
+        self.assertEqual(counts, [1, 2, 3, 4, 7, 10, 15, 20, 25])
+        self.assertTrue(flagged_content.need_mails(5, 7))
+        self.assertFalse(flagged_content.need_mails(11, 14))
+        self.assertTrue(flagged_content.need_mails(11, 15))
+        flag_settings.LIMIT_FOR_OBJECT = 12
+        self.assertTrue(flagged_content.need_mails(11, 14))
+
+
+class FailingEmailBackend(BaseEmailBackend):
+    """
+    A mail backend which cannot send mails
+    """
+
+    def send_messages(self, email_messages):
+        raise IOError('SMTP server not available')
+
+
+class MailOutboxTestCase(BaseTestCaseWithData):
+    """
+    Class to test the mails stored in the outbox
+    """
+
+    def setUp(self):
+        super(MailOutboxTestCase, self).setUp()
+        flag_settings.SEND_MAILS = True
+        flag_settings.SEND_MAILS_OUTBOX = True
+        flag_settings.SEND_MAILS_TO = ('foo@example.com',
+                                       ('Bar', 'bar@example.com'))
+        mail.outbox = []
+
+    def test_outbox(self):
+        """
+        Test that mails are stored, then sent by the management command
+        """
+        flag_instance = FlagInstance.objects.add(
+            self.user, self.model_without_author, comment='comment',
+            send_mails=True)
+        self.assertEqual(len(mail.outbox), 0)
+        flag_mail = FlagMail.objects.get()
+        self.assertEqual(flag_mail.flag_instance, flag_instance)
+        self.assertEqual(flag_mail.recipients,
+                         'foo@example.com\nbar@example.com')
+
+        call_command('flag_dispatch_mail', verbosity=0)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject, flag_mail.subject)
+        self.assertEqual(mail.outbox[0].to, flag_mail.recipients.split('\n'))
+        self.assertEqual(FlagMail.objects.count(), 0)
+
+    def test_dispatch_batch(self):
+        """
+        Test that mails are sent by batch, over one connection
+        """
+        for i in range(5):
+            FlagInstance.objects.add(
+                self.user, self.model_without_author, comment='comment',
+                send_mails=True)
+        self.assertEqual(dispatch_mails(batch_size=3), (3, 0))
+        self.assertEqual(dispatch_mails(batch_size=3), (2, 0))
+        self.assertEqual(dispatch_mails(batch_size=3), (0, 0))
+        self.assertEqual(len(mail.outbox), 5)
+
+        # a claimed mail is not returned again
+        FlagInstance.objects.add(
+            self.user, self.model_without_author, comment='comment',
+            send_mails=True)
+        self.assertEqual(len(FlagMail.objects.claim()), 1)
+        self.assertEqual(FlagMail.objects.claim(), [])
+
+    def test_dispatch_retry(self):
+        """
+        Test that a mail not sent is sent again later, until the max tries
+        """
+        flag_settings.SEND_MAILS_OUTBOX_MAX_TRIES = 2
+        FlagInstance.objects.add(
+            self.user, self.model_without_author, comment='comment',
+            send_mails=True)
+
+        self.assertEqual(dispatch_mails(connection=FailingEmailBackend()),
+                         (0, 1))
+        flag_mail = FlagMail.objects.get()
+        self.assertEqual(flag_mail.tries, 1)
+        self.assertFalse(flag_mail.failed)
+        self.assertTrue('SMTP' in flag_mail.last_error)
+        # not now
+        self.assertEqual(dispatch_mails(), (0, 0))
+
+        # fail again: no more tries
+        FlagMail.objects.update(next_try=flag_mail.when_added)
+        self.assertEqual(dispatch_mails(connection=FailingEmailBackend()),
+                         (0, 1))
+        flag_mail = FlagMail.objects.get()
+        self.assertEqual(flag_mail.tries, 2)
+        self.assertTrue(flag_mail.failed)
+        FlagMail.objects.update(next_try=flag_mail.when_added)
+        self.assertEqual(dispatch_mails(), (0, 0))
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_workers(self):
+        """
+        Test that the worker threads are started at the first request of the
+        process only, and are stopped
+        """
+        flag_settings.SEND_MAILS_OUTBOX_WORKERS = 2
+        apps.get_app_config('flag').ready()
+        self.assertEqual(mails._workers, [])
+        # the workers wait to be stopped, without queries from other threads
+        run = mails.MailWorker.__dict__['run']
+        mails.MailWorker.run = lambda worker: mails._stop.wait()
+        try:
+            request_started.send(sender=self.__class__)
+            request_started.send(sender=self.__class__)
+            workers = list(mails._workers)
+            self.assertEqual(len(workers), 2)
+            self.assertTrue(all(worker.is_alive() for worker in workers))
+            # already started
+            mails.start_workers()
+            self.assertEqual(mails._workers, workers)
+        finally:
+            mails.stop_workers(timeout=5)
+            mails.MailWorker.run = run
+        self.assertEqual(mails._workers, [])
+        self.assertFalse(any(worker.is_alive() for worker in workers))
+
+
+class MailDigestTestCase(BaseTestCaseWithData):
+    """
+    Class to test the digest of mails
+    """
+
+    def setUp(self):
+        super(MailDigestTestCase, self).setUp()
+        flag_settings.SEND_MAILS = True
+        flag_settings.SEND_MAILS_DIGEST = True
+        flag_settings.SEND_MAILS_TO = ('foo@example.com', 'bar@example.com')
+        mail.outbox = []
+
+    def test_digest(self):
+        """
+        Test that flags and untrusted flaggers are sent in one mail by
+        recipient when the window is over
+        """
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment', send_mails=True)
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment', send_mails=True)
+        FlagInstance.objects.add(self.user, self.model_with_author,
+                                 comment='comment', send_mails=True)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(FlagDigestEntry.objects.count(), 6)
+        # one window by model
+        self.assertEqual(len(set(FlagDigestEntry.objects.values_list(
+            'flagged_content__content_type', 'due_at'))), 2)
+
+        # window not over
+        self.assertEqual(flush_digests(), 0)
+
+        # an untrusted user is added to the same digest
+        FlagDigestEntry.objects.update(due_at=timezone.now())
+        flag_settings.NEEDS_TRUST = True
+        untrusted_user = User.objects.create_user(
+                username='%s-untrusted' % self.USER_BASE,
+                email='%s-untrusted@example.com' % self.USER_BASE,
+                password=self.USER_BASE)
+        FlagInstance.objects.add(untrusted_user, self.model_with_author,
+                                 comment='comment', send_mails=True)
+        self.assertEqual(FlagDigestEntry.objects.filter(
+            untrusted=True).count(), 2)
+
+        self.assertEqual(flush_digests(), 2)
+        self.assertEqual(FlagDigestEntry.objects.count(), 0)
+        self.assertEqual(dispatch_mails(), (2, 0))
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         ['bar@example.com', 'foo@example.com'])
+        body = mail.outbox[0].body
+        self.assertTrue('#%s' % self.model_without_author.id in body)
+        self.assertTrue('#%s' % self.model_with_author.id in body)
+        self.assertTrue('New flags: 2 (total flags: 2)' in body)
+        self.assertTrue('non trusted users: 1' in body)
+        self.assertEqual(mail.outbox[0].subject, 'Flags on 2 objects')
+
+    def test_digest_by_model(self):
+        """
+        Test that the digest can be set by model
+        """
+        flag_settings.MODELS_SETTINGS = {
+            'tests.modelwithauthor': {'SEND_MAILS_DIGEST': False}}
+        FlagInstance.objects.add(self.user, self.model_with_author,
+                                 comment='comment', send_mails=True)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(FlagDigestEntry.objects.count(), 0)
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment', send_mails=True)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(FlagDigestEntry.objects.count(), 2)
+
+    def test_digest_settings_by_model(self):
+        """
+        Test that the window and the sender of the digests are taken from
+        the settings of the flagged models
+        """
+        flag_settings.MODELS_SETTINGS = {
+            'tests.modelwithauthor': {
+                'SEND_MAILS_DIGEST_WINDOW': 0,
+                'SEND_MAILS_FROM': 'authors@example.com'}}
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment', send_mails=True)
+        FlagInstance.objects.add(self.user, self.model_with_author,
+                                 comment='comment', send_mails=True)
+
+        # only the window of the model with author is over
+        self.assertEqual(flush_digests(), 2)
+        self.assertEqual(FlagDigestEntry.objects.count(), 2)
+        self.assertEqual(dispatch_mails(), (2, 0))
+        self.assertEqual(set(m.from_email for m in mail.outbox),
+                         set(['authors@example.com']))
+
+        # one digest by sender
+        FlagInstance.objects.add(self.user, self.model_with_author,
+                                 comment='comment', send_mails=True)
+        FlagDigestEntry.objects.update(due_at=timezone.now())
+        self.assertEqual(flush_digests(), 4)
+        self.assertEqual(dispatch_mails(), (4, 0))
+        self.assertEqual(sorted(m.from_email for m in mail.outbox[2:]),
+                         ['authors@example.com'] * 2 +
+                         [flag_settings.SEND_MAILS_FROM] * 2)
+
+
+class ModerationQueueTestCase(BaseTestCaseWithData):
+    """
+    Class to test the moderation queue and its view
+    """
+
+    def setUp(self):
+        super(ModerationQueueTestCase, self).setUp()
+        # 5 flagged contents, the two last ones with the same date
+        now = timezone.now()
+        self.flagged_contents = []
+        for i in range(5):
+            content_object = ModelWithoutAuthor.objects.create(
+                name='foo %s' % i)
+            flag_instance = FlagInstance.objects.add(
+                self.user, content_object, comment='comment')
+            flagged_content = flag_instance.flagged_content
+            FlaggedContent.objects.filter(id=flagged_content.id).update(
+                when_updated=now - timedelta(minutes=min(i, 3)))
+            self.flagged_contents.append(flagged_content)
+        FlagInstance.objects.add(self.user, self.model_with_author,
+                                 comment='comment', status=2)
+
+    def test_moderation_queue(self):
+        """
+        Test the pages of the moderation queue
+        """
+        ids = []
+        cursor = None
+        get_content_type_id(ModelWithoutAuthor)
+        while True:
+            with self.assertNumQueries(1):
+                flagged_contents, cursor = FlaggedContent.objects. \
+                    moderation_queue(status=1, model=ModelWithoutAuthor,
+                                     after=cursor, limit=2)
+                # joined
+                [(flagged_content.content_type, flagged_content.creator)
+                 for flagged_content in flagged_contents]
+            ids.extend(flagged_content.id
+                       for flagged_content in flagged_contents)
+            if cursor is None:
+                break
+        self.assertEqual(ids, [self.flagged_contents[0].id,
+                               self.flagged_contents[1].id,
+                               self.flagged_contents[2].id,
+                               self.flagged_contents[4].id,
+                               self.flagged_contents[3].id])
+
+        # other status / model
+        flagged_contents, cursor = FlaggedContent.objects.moderation_queue()
+        self.assertEqual(len(flagged_contents), 6)
+        self.assertEqual(cursor, None)
+        flagged_contents, cursor = FlaggedContent.objects.moderation_queue(
+            status=2)
+        self.assertEqual([flagged_content.content_object for flagged_content
+                          in flagged_contents], [self.model_with_author])
+        self.assertEqual(FlaggedContent.objects.moderation_queue(
+            status=1, model='tests.modelwithauthor'), ([], None))
+        self.assertRaises(ValueError, FlaggedContent.objects.moderation_queue,
+                          after='foo')
+
+    def test_moderation_queue_view(self):
+        """
+        Test the JSON view of the moderation queue
+        """
+        factory = RequestFactory()
+
+        request = factory.get('/', {'limit': 3, 'status': 1})
+        request.user = self.user
+        self.assertEqual(views.moderation_queue(request).status_code, 403)
+
+        request.user = self.staff_user
+        response = views.moderation_queue(request)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual([result['id'] for result in data['results']],
+                         [self.flagged_contents[0].id,
+                          self.flagged_contents[1].id,
+                          self.flagged_contents[2].id])
+        self.assertEqual(data['results'][0]['content_type'],
+                         'tests.modelwithoutauthor')
+        self.assertEqual(data['results'][0]['status_display'],
+                         dict(flag_settings.STATUSES)[1])
+
+        request = factory.get('/', {'limit': 3, 'status': 1,
+                                    'after': data['next']})
+        request.user = self.staff_user
+        data = json.loads(views.moderation_queue(request).content)
+        self.assertEqual(len(data['results']), 2)
+        self.assertEqual(data['next'], None)
+
+        for params in ({'after': 'foo'}, {'status': 'foo'},
+                       {'model': 'foo.bar'}):
+            request = factory.get('/', params)
+            request.user = self.staff_user
+            self.assertEqual(views.moderation_queue(request).status_code,
+                             400)
+
+
+class FlagApiTestCase(BaseTestCaseWithData):
+    """
+    Class to test the JSON `flag_api` view
+    """
+
+    def get_flag_data(self, content_object, **kwargs):
+        data = dict(get_default_form(content_object).initial,
+                    comment='comment')
+        data.update(kwargs)
+        return data
+
+    def post(self, data, user=None):
+        request = RequestFactory().post('/flag/api/', json.dumps(data),
+                                        content_type='application/json')
+        request.user = user or self.user
+        request.session = None
+        return views.flag_api(request)
+
+    def test_one_flag(self):
+        """
+        Test adding one flag, and the errors
+        """
+        response = self.post(self.get_flag_data(self.model_without_author))
+        self.assertEqual(response.status_code, 201)
+        flag_instance = FlagInstance.objects.get()
+        self.assertEqual(json.loads(response.content),
+                         {'status': 201, 'id': flag_instance.id})
+        self.assertEqual(flag_instance.comment, 'comment')
+
+        response = self.post(self.get_flag_data(self.model_without_author,
+                                                security_hash='0' * 40))
+        self.assertEqual(response.status_code, 400)
+        response = self.post(self.get_flag_data(self.model_without_author,
+                                                status=2))
+        self.assertEqual(response.status_code, 403)
+        response = self.post(self.get_flag_data(self.model_without_author,
+                                                comment=''))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.post('foo').status_code, 400)
+        for comment in ({'a': 1}, ['x'], 1):
+            response = self.post(self.get_flag_data(self.model_without_author,
+                                                    comment=comment))
+            self.assertEqual(response.status_code, 400)
+        response = self.post(self.get_flag_data(self.model_with_author,
+                                                creator_field=['author']))
+        self.assertEqual(response.status_code, 400)
+        flag_settings.ALLOW_COMMENTS = False
+        response = self.post(self.get_flag_data(self.model_without_author))
+        self.assertEqual(response.status_code, 400)
+        flag_settings.ALLOW_COMMENTS = True
+        self.assertEqual(FlagInstance.objects.count(), 1)
+
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 1
+        response = self.post(self.get_flag_data(self.model_without_author))
+        self.assertEqual(response.status_code, 409)
+
+        # not saved for an untrusted user
+        flag_settings.NEEDS_TRUST = True
+        untrusted_user = User.objects.create_user(
+                username='%s-untrusted' % self.USER_BASE,
+                email='%s-untrusted@example.com' % self.USER_BASE,
+                password=self.USER_BASE)
+        response = self.post(self.get_flag_data(self.model_with_author),
+                             user=untrusted_user)
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(json.loads(response.content)['status'], 403)
+        self.assertEqual(FlagInstance.objects.count(), 1)
+        flag_settings.NEEDS_TRUST = False
+
+        request = RequestFactory().post('/flag/api/', 'foo',
+                                        content_type='application/json')
+        request.user = AnonymousUser()
+        self.assertEqual(views.flag_api(request).status_code, 401)
+        request.user = self.user
+        self.assertEqual(views.flag_api(request).status_code, 400)
+
+    def test_batch(self):
+        """
+        Test adding many flags, with a result for each one
+        """
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 1
+        deleted_object = ModelWithAuthor.objects.create(name='foo',
+                                                        author=self.author)
+        deleted_object_data = self.get_flag_data(deleted_object)
+        deleted_object.delete()
+        response = self.post({'flags': [
+            self.get_flag_data(self.model_without_author),
+            self.get_flag_data(self.model_with_author,
+                               creator_field='author'),
+            self.get_flag_data(self.model_without_author),
+            deleted_object_data,
+        ]})
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.content)['results']
+        self.assertEqual([result['status'] for result in results],
+                         [201, 201, 409, 404])
+        self.assertEqual(FlagInstance.objects.count(), 2)
+        self.assertEqual(FlaggedContent.objects.get_for_object(
+            self.model_with_author).creator, self.author)
+
+        response = self.post({'flags': [
+            self.get_flag_data(self.model_without_author)] * 101})
+        self.assertEqual(response.status_code, 400)
+
+
+class FlagStatesTestCase(BaseTestCaseWithData):
+    """
+    Class to test the JSON `flag_states` view
+    """
+
+    def get(self, objects, user=None):
+        request = RequestFactory().get('/flag/states/', {'objects': objects})
+        request.user = user or AnonymousUser()
+        return views.flag_states(request)
+
+    def test_states(self):
+        """
+        Test the states of many objects, with a fixed number of queries
+        """
+        FlagInstance.objects.add(self.user, self.model_without_author, None,
+                                 'comment')
+        objects = ['tests.modelwithoutauthor:%s' %
+                   self.model_without_author.pk,
+                   'tests.modelwithauthor:%s' % self.model_with_author.pk,
+                   'tests.modelwithauthor:0', 'foo.bar:1', 'foo']
+
+        # one query by model, one for the flagged contents, one for the
+        # counts of the user (the content types are cached)
+        ContentType.objects.get_for_model(self.model_with_author)
+        with self.assertNumQueries(4):
+            response = self.get(','.join(objects), self.user)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('private' in response['Cache-Control'])
+        results = json.loads(response.content)['results']
+        self.assertEqual([result['object'] for result in results], objects)
+        self.assertEqual(results[0]['count'], 1)
+        self.assertEqual(results[0]['status'], flag_settings.DEFAULT_STATUS)
+        self.assertEqual(results[1]['count'], 0)
+        self.assertTrue(results[0]['can_flag'])
+        self.assertTrue(results[1]['can_flag'])
+        self.assertEqual(results[2]['error'], 'Object not found')
+        self.assertEqual(results[3]['error'], 'Invalid object')
+        self.assertEqual(results[4]['error'], 'Invalid object')
+
+        # the security data are accepted by the forms
+        data = dict((name, results[1][name]) for name in
+                    ('content_type', 'object_pk', 'timestamp',
+                     'security_hash'))
+        form = FlagForm(target_object=self.model_with_author,
+                        data=dict(data, comment='comment'))
+        self.assertTrue(form.is_valid())
+
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 1
+        results = json.loads(self.get(objects, self.user).content)['results']
+        self.assertFalse(results[0]['can_flag'])
+        self.assertTrue(results[1]['can_flag'])
+
+    def test_aliased_keys(self):
+        """
+        Test that keys for the same object get the same result
+        """
+        pk = self.model_with_author.pk
+        objects = ['tests.modelwithauthor:%s' % pk,
+                   'tests.modelwithauthor:0%s' % pk,
+                   'tests.ModelWithAuthor:%s' % pk,
+                   'tests.modelwithauthor:%s' % pk]
+        response = self.get(','.join(objects), self.user)
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.content)['results']
+        self.assertEqual([result['object'] for result in results], objects)
+        for result in results:
+            self.assertEqual(result['object_pk'], str(pk))
+            self.assertTrue(result['can_flag'])
+
+    def test_anonymous(self):
+        """
+        Test that the responses to anonymous users can be cached, and the
+        errors
+        """
+        response = self.get('tests.modelwithauthor:%s' %
+                            self.model_with_author.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('public' in response['Cache-Control'])
+        self.assertTrue('max-age=%d' % views.STATES_MAX_AGE in
+                        response['Cache-Control'])
+        self.assertFalse(json.loads(response.content)['results'][0]
+                         ['can_flag'])
+
+        self.assertEqual(self.get('').status_code, 400)
+        self.assertEqual(self.get(['foo.bar:1'] *
+                                  (views.STATES_MAX_OBJECTS + 1)).status_code,
+                         400)
+
+
+class AdminTestCase(BaseTestCaseWithData):
+    """
+    Class to test the admin of flagged contents
+    """
+
+    def test_status_filter(self):
+        """
+        Test the choices of the status filter
+        """
+        from django.contrib.admin import site
+        from flag.admin import StatusFilter, get_status_labels
+
+        flag_settings.STATUSES = [(1, 'flagged'), (2, 'rejected')]
+        flag_settings.MODELS_SETTINGS = {
+            'tests.modelwithauthor': {'STATUSES': [(1, 'flagged'),
+                                                   (2, 'refused'),
+                                                   (3, 'accepted')]}}
+        labels = get_status_labels()
+        self.assertEqual(labels[1], 'flagged')
+        self.assertEqual(unicode(labels[2]), 'rejected | refused')
+        self.assertEqual(labels[3], 'accepted')
+        self.assertTrue(get_status_labels() is labels)
+
+        FlagInstance.objects.add(self.user, self.model_with_author,
+                                 comment='comment', status=2)
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        FlagInstance.objects.add(self.staff_user, self.model_without_author,
+                                 comment='comment')
+        status_filter = StatusFilter(None, {}, FlaggedContent,
+                                     site._registry[FlaggedContent])
+        with self.assertNumQueries(1):
+            self.assertEqual([(status, unicode(label)) for status, label in
+                              status_filter.lookups(
+                                  None, site._registry[FlaggedContent])],
+                             [(1, 'flagged'), (2, 'rejected | refused')])
+
+
+    def test_changelist_queries(self):
+        """
+        Test that the rows of the changelist are displayed without a query
+        for each one
+        """
+        from django.contrib.admin import site
+        from django.contrib.admin.utils import lookup_field
+
+        for i in range(5):
+            FlagInstance.objects.add(
+                self.user, ModelWithoutAuthor.objects.create(name='foo'),
+                comment='comment')
+            last_object = ModelWithAuthor.objects.create(name='bar',
+                                                         author=self.author)
+            FlagInstance.objects.add(self.user, last_object, self.author,
+                                     comment='comment')
+        model_admin = site._registry[FlaggedContent]
+        request = RequestFactory().get('/')
+        request.user = self.staff_user
+
+        # one query for the rows, one for the objects of each model
+        with self.assertNumQueries(3):
+            rows = [[lookup_field(name, obj, model_admin)[2]
+                     for name in model_admin.list_display]
+                    for obj in model_admin.get_queryset(request)]
+        self.assertEqual(len(rows), 10)
+        self.assertEqual(rows[0][1],
+                         u'tests.modelwithauthor #%s' % last_object.id)
+        self.assertEqual(rows[0][2], last_object)
+        self.assertEqual(rows[0][5], self.author)
+        self.assertEqual(rows[0][6], u'-')
+
+    def test_set_status_actions(self):
+        """
+        Test the actions setting a status to the selected flagged contents
+        """
+        from django.contrib.admin import site
+        from flag.admin import FlaggedContentAdmin
+
+        flag_settings.STATUSES = [(1, 'flagged'), (2, 'rejected')]
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        model_admin = FlaggedContentAdmin(FlaggedContent, site)
+        request = RequestFactory().get('/')
+        request.user = self.staff_user
+        actions = model_admin.get_actions(request)
+        self.assertEqual(unicode(actions['set_status_2'][2]),
+                         'Set status: rejected')
+
+        model_admin.message_user = lambda request, message: None
+        actions['set_status_2'][0](model_admin, request,
+                                   FlaggedContent.objects.all())
+        flagged_content = FlaggedContent.objects.get_for_object(
+            self.model_without_author)
+        self.assertEqual(flagged_content.status, 2)
+        self.assertEqual(flagged_content.moderator, self.staff_user)
+        self.assertEqual(flagged_content.flag_instances.get().status, 2)
+
+        # no actions in popups, or if they are disabled
+        request = RequestFactory().get('/', {'_popup': '1'})
+        request.user = self.staff_user
+        self.assertEqual(len(model_admin.get_actions(request)), 0)
+        model_admin.actions = None
+        request = RequestFactory().get('/')
+        request.user = self.staff_user
+        self.assertEqual(len(model_admin.get_actions(request)), 0)
+
+    def test_change_form(self):
+        """
+        Test the pages of flags and the summary of the change form
+        """
+        from django.contrib.admin import site
+        from flag.admin import InlineFlagInstance
+
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 0
+        flag_settings.STATUSES = [(1, 'flagged'), (2, 'rejected')]
+        rejected_ids = []
+        for i in range(7):
+            flag_instance = FlagInstance.objects.add(
+                self.user, self.model_without_author, comment='comment')
+            if i % 3:
+                rejected_ids.append(flag_instance.id)
+            if not i:
+                first_flag = flag_instance
+        FlagInstance.objects.filter(id__in=rejected_ids).update(status=2)
+        flagged_content = flag_instance.flagged_content
+        FlagInstance.objects.filter(id=flag_instance.id).update(
+            when_added=flag_instance.when_added - timedelta(days=1))
+
+        with self.assertNumQueries(2):
+            summary = flagged_content.get_flags_summary()
+        self.assertEqual(summary['total'], 7)
+        self.assertEqual(summary['by_status'], [(1, 'flagged', 3),
+                                                (2, 'rejected', 4)])
+        self.assertEqual([count for day, count in summary['by_day']], [6, 1])
+
+        inline = InlineFlagInstance(FlaggedContent, site)
+        inline.per_page = 3
+        request = RequestFactory().get('/', {'flags_page': '3'})
+        request.user = self.staff_user
+        formset = inline.get_formset(request, flagged_content)(
+            instance=flagged_content)
+        self.assertEqual(formset.max_id, flag_instance.id)
+        self.assertEqual(len(formset.forms), 1)
+        self.assertEqual(formset.forms[0].instance, first_flag)
+        self.assertEqual(formset.forms[0].fields['status'].choices,
+                         flag_settings.STATUSES)
+
+        model_admin = site._registry[FlaggedContent]
+        self.staff_user.is_superuser = True
+        response = model_admin.change_view(request, str(flagged_content.id))
+        self.assertEqual(response.context_data['flags_summary'], summary)
+        self.assertEqual(response.context_data['flags_page'], 3)
+        self.assertEqual(len(response.context_data['flags_pages']), 1)
+        self.assertEqual(response.context_data['flags_max_id'],
+                         flag_instance.id)
+
+        # the flags added after the display do not shift the pages
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        request = RequestFactory().get('/', {'flags_page': '3',
+                                             'flags_max_id': formset.max_id})
+        request.user = self.staff_user
+        formset_class = inline.get_formset(request, flagged_content)
+        self.assertEqual(
+            len(formset_class(instance=flagged_content).forms), 1)
+        prefix = formset_class.get_default_prefix()
+        data = {prefix + '-TOTAL_FORMS': '1',
+                prefix + '-INITIAL_FORMS': '1',
+                prefix + '-0-id': str(first_flag.id),
+                prefix + '-0-user': str(self.user.id),
+                prefix + '-0-comment': 'comment',
+                prefix + '-0-status': '2'}
+        formset = formset_class(data, instance=flagged_content)
+        self.assertTrue(formset.is_valid())
+        self.assertEqual(formset.forms[0].instance, first_flag)
+
+        # but the submitted flags not in the page anymore are refused
+        FlagInstance.objects.filter(id=rejected_ids[0]).delete()
+        formset = formset_class(data, instance=flagged_content)
+        self.assertFalse(formset.is_valid())
+        self.assertEqual(len(formset.non_form_errors()), 1)
+
+    def test_page_range(self):
+        """
+        Test that only the pages around the current one and at both ends are
+        linked when there are many pages of flags
+        """
+        from flag.admin import get_page_range
+
+        self.assertEqual(get_page_range(1, 10), range(1, 11))
+        self.assertEqual(get_page_range(1, 1000),
+                         [1, 2, 3, 4, None, 999, 1000])
+        self.assertEqual(get_page_range(500, 1000),
+                         [1, 2, None, 497, 498, 499, 500, 501, 502, 503,
+                          None, 999, 1000])
+        self.assertEqual(get_page_range(1000, 1000),
+                         [1, 2, None, 997, 998, 999, 1000])
+        self.assertEqual(get_page_range(5000, 1000),
+                         [1, 2, None, 997, 998, 999, 1000])
+
+
+class QueryPlanTestCase(BaseTestCaseWithData):
+    """
+    Class to check, with SQLite, that the queries of the managers use indexes
+    """
+
+    def _explain_queries(self, func, *args, **kwargs):
+        """
+        Call the function and return the plans of the queries it ran, with
+        `EXPLAIN QUERY PLAN`, as a list of `(sql, plan lines)` tuples
+        """
+        # keep the queries with their params instead of their debug string
+        last_executed_query = connection.ops.last_executed_query
+        connection.ops.last_executed_query = \
+            lambda cursor, sql, params: (sql, params)
+        try:
+            with CaptureQueriesContext(connection) as context:
+                func(*args, **kwargs)
+        finally:
+            connection.ops.last_executed_query = last_executed_query
+
+        plans = []
+        cursor = connection.cursor()
+        for query in context.captured_queries:
+            sql, params = query['sql']
+            if sql.split()[0].upper() not in ('SELECT', 'UPDATE', 'DELETE'):
+                continue
+            cursor.execute('EXPLAIN QUERY PLAN %s' % sql, params or ())
+            plans.append((sql, [row[-1] for row in cursor.fetchall()]))
+        return plans
+
+    def assertNoTableScan(self, func, *args, **kwargs):
+        """
+        Check that no query done by the function scans a whole table
+        """
+        for sql, plan in self._explain_queries(func, *args, **kwargs):
+            for line in plan:
+                self.assertFalse(line.startswith('SCAN'),
+                                 'Full scan in "%s": %s' % (sql, plan))
+
+    def test_query_plans(self):
+        """
+        Test the plans of the queries of the managers
+        """
+        if connection.vendor != 'sqlite':
+            self.skipTest('EXPLAIN QUERY PLAN is only available with SQLite')
+
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 10
+        flag_settings.LIMIT_FOR_OBJECT = 10
+        flag_settings.SEND_MAILS = True
+        flag_settings.SEND_MAILS_TO = ('foo@example.com',)
+        flag_settings.SEND_MAILS_OUTBOX = True
+        content_type = ContentType.objects.get_for_model(ModelWithAuthor)
+
+        self.assertNoTableScan(
+            FlagInstance.objects.add, self.user, self.model_with_author,
+            self.author, comment='comment', send_mails=True)
+        self.assertNoTableScan(
+            FlagInstance.objects.bulk_add,
+            [(self.user, self.model_with_author, 'comment'),
+             (self.author, self.model_without_author, 'comment')])
+        flagged_content = FlaggedContent.objects.get_for_object(
+            self.model_with_author)
+
+        self.assertNoTableScan(FlaggedContent.objects.get_for_object,
+                               self.model_with_author)
+        self.assertNoTableScan(list, FlaggedContent.objects.filter_for_model(
+            ModelWithAuthor))
+        self.assertNoTableScan(FlaggedContent.objects.in_bulk_for_keys,
+                               [(content_type.id, self.model_with_author.id)])
+        self.assertNoTableScan(
+            FlaggedContent.objects.get_for_objects,
+            [self.model_with_author, self.model_without_author], self.user)
+        self.assertNoTableScan(flagged_content.count_flags_by_user,
+                               self.user)
+        self.assertNoTableScan(list, flagged_content.flag_instances.all())
+        self.assertNoTableScan(list, FlagInstance.objects.filter(
+            flagged_content=flagged_content, user=self.user))
+        self.assertNoTableScan(list, FlaggedContent.objects.filter(
+            status=1).order_by('-when_updated'))
+        self.assertNoTableScan(list, FlaggedContent.objects.filter(
+            creator=self.author, status=1))
+        cursor = FlaggedContent.objects.moderation_cursor(flagged_content)
+        self.assertNoTableScan(FlaggedContent.objects.moderation_queue,
+                               status=1, after=cursor)
+        self.assertNoTableScan(FlaggedContent.objects.moderation_queue,
+                               after=cursor)
+        self.assertNoTableScan(FlaggedContent.objects.moderation_queue,
+                               status=1, model=ModelWithAuthor, after=cursor)
+
+        # mails
+        self.assertNoTableScan(FlagMail.objects.claim)
+        flag_settings.SEND_MAILS_DIGEST = True
+        self.assertNoTableScan(
+            FlagInstance.objects.add, self.user, self.model_with_author,
+            comment='comment', send_mails=True)
+        FlagDigestEntry.objects.update(due_at=timezone.now())
+        self.assertNoTableScan(flush_digests)
+
+
 class FlagTestSettings(BaseTestCase):
     """
     Class to tests settings and settings by model
@@ -790,6 +2311,109 @@ class FlagTestSettings(BaseTestCase):
                           'INEXISTING_SETTINGS')
 
 
+    def test_content_type_id(self):
+        """
+        Test the resolution of content type ids, and its cache
+        """
+        content_type = ContentType.objects.get_for_model(ModelWithAuthor)
+        clear_content_type_cache()
+
+        # resolved without the cache
+        self.assertEqual(get_content_type_id(content_type), content_type.id)
+        self.assertEqual(get_content_type_id(content_type.id),
+                         content_type.id)
+        self.assertEqual(get_content_type_id(str(content_type.id)),
+                         content_type.id)
+        self.assertEqual(content_type_cache_info().currsize, 0)
+
+        # resolved with the cache
+        self.assertEqual(get_content_type_id(ModelWithAuthor),
+                         content_type.id)
+        self.assertEqual(get_content_type_id('tests.modelwithauthor'),
+                         content_type.id)
+        info = content_type_cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (0, 2, 2))
+        with self.assertNumQueries(0):
+            self.assertEqual(get_content_type_id(ModelWithAuthor()),
+                             content_type.id)
+            self.assertEqual(get_content_type_id('tests.modelwithauthor'),
+                             content_type.id)
+        info = content_type_cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (2, 2, 2))
+
+        self.assertRaises(Exception, get_content_type_id, 'foobar')
+        self.assertRaises(Exception, get_content_type_id, Exception)
+
+        # the flaggable models are checked without query
+        flag_settings.MODELS = ('tests.modelwithauthor',)
+        other_content_type = ContentType.objects.get_for_model(
+                ModelWithoutAuthor)
+        FlaggedContent.objects.model_can_be_flagged(ModelWithAuthor)
+        with self.assertNumQueries(0):
+            self.assertTrue(FlaggedContent.objects.model_can_be_flagged(
+                ModelWithAuthor))
+            self.assertFalse(FlaggedContent.objects.model_can_be_flagged(
+                other_content_type.id))
+
+    def test_settings_for_content_type(self):
+        """
+        Test the compiled settings by content type
+        """
+        model_name = 'tests.modelwithauthor'
+        content_type = ContentType.objects.get_for_model(ModelWithAuthor)
+        other_content_type = ContentType.objects.get_for_model(
+                ModelWithoutAuthor)
+
+        flag_settings.MODELS_SETTINGS = {
+            model_name: {'SEND_MAILS': True, 'MODELS': ()}}
+        flag_settings.SEND_MAILS = False
+        flag_settings.LIMIT_FOR_OBJECT = 3
+
+        model_settings = flag_settings.get_for_content_type(content_type.id)
+        self.assertTrue(model_settings.SEND_MAILS)
+        self.assertEqual(model_settings.LIMIT_FOR_OBJECT, 3)
+        self.assertEqual(model_settings.MODELS, flag_settings.MODELS)
+        self.assertRaises(AttributeError, setattr, model_settings,
+                          'SEND_MAILS', False)
+        self.assertRaises(AttributeError, getattr, model_settings,
+                          'INEXISTING_SETTINGS')
+
+        # the global settings are used for other models
+        model_settings = flag_settings.get_for_content_type(
+                other_content_type.id)
+        self.assertFalse(model_settings.SEND_MAILS)
+        flag_settings.LIMIT_FOR_OBJECT = 5
+        self.assertEqual(model_settings.LIMIT_FOR_OBJECT, 5)
+
+        # compiled again if MODELS_SETTINGS is replaced
+        flag_settings.MODELS_SETTINGS = {}
+        self.assertFalse(flag_settings.get_for_content_type(
+                content_type.id).SEND_MAILS)
+
+        # ... or with the `setting_changed` signal
+        with override_settings(FLAG_MODELS_SETTINGS={
+                model_name: {'LIMIT_FOR_OBJECT': 10}}):
+            self.assertEqual(flag_settings.get_for_content_type(
+                    content_type.id).LIMIT_FOR_OBJECT, 10)
+        self.assertEqual(flag_settings.get_for_content_type(
+                content_type.id).LIMIT_FOR_OBJECT, 5)
+
+    def test_mails_schedule(self):
+        """
+        Test the compiled SEND_MAILS_RULES settings
+        """
+        rules = [(1, 1), (4, 3), (10, 5)]
+        schedule = flag_settings.get_mails_schedule(rules)
+        self.assertTrue(schedule is flag_settings.get_mails_schedule(rules))
+        self.assertEqual([count for count in range(0, 30)
+                          if schedule.matches(count, count)],
+                         [1, 2, 3, 4, 7, 10, 15, 20, 25])
+        self.assertFalse(schedule.matches(0, 0))
+        self.assertTrue(schedule.matches(5, 7))
+        self.assertFalse(schedule.matches(11, 14))
+        self.assertFalse(flag_settings.get_mails_schedule([]).matches(1, 10))
+
+
 class FlagTemplateTagsTestCase(BaseTestCaseWithData):
     """
     Class to test all template tags and filters
@@ -884,6 +2508,45 @@ class FlagTemplateTagsTestCase(BaseTestCaseWithData):
         self.assertFalse(flag_tags.can_be_flagged_by(self.model_with_author,
                                                      Exception))
 
+    def test_prefetch_flags(self):
+        """
+        Test the `prefetch_flags` templatetag, and the use of the prefetched
+        data by the filters
+        """
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 2
+        FlagInstance.objects.add(self.user, self.model_with_author,
+                                 comment='comment')
+        FlagInstance.objects.add(self.user, self.model_with_author,
+                                 comment='comment')
+        FlagInstance.objects.add(self.author, self.model_with_author,
+                                 comment='comment')
+
+        objects = [ModelWithAuthor.objects.get(id=self.model_with_author.id),
+                   ModelWithoutAuthor.objects.get(
+                        id=self.model_without_author.id)]
+        ContentType.objects.get_for_model(self.model_without_author)
+
+        with self.assertNumQueries(2):
+            flag_tags.prefetch_flags({'user': self.user}, objects)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(flag_tags.flag_count(objects[0]), 3)
+            self.assertEqual(flag_tags.flag_status(objects[0]),
+                             flag_settings.DEFAULT_STATUS)
+            self.assertFalse(flag_tags.can_be_flagged_by(objects[0],
+                                                         self.user))
+            self.assertEqual(flag_tags.flag_count(objects[1]), 0)
+            self.assertEqual(flag_tags.flag_status(objects[1]), None)
+            self.assertTrue(flag_tags.can_be_flagged_by(objects[1],
+                                                        self.user))
+
+        # for another user
+        objects = [ModelWithAuthor.objects.get(id=self.model_with_author.id)]
+        FlaggedContent.objects.get_for_objects(objects, self.author)
+        with self.assertNumQueries(0):
+            self.assertTrue(flag_tags.can_be_flagged_by(objects[0],
+                                                        self.author))
+
     def test_flag_confirm_url(self):
         """
         Test the `flag_confirm_url` filter (and also urls btw)
@@ -963,6 +2626,74 @@ class FlagTemplateTagsTestCase(BaseTestCaseWithData):
         result = flag_tags.flag_with_status({}, self.model_without_author)
         self.assertTrue(isinstance(result['form'], FlagFormWithStatus))
 
+    def _get_widget_data(self, html):
+        """
+        Return the values of the inputs of a form rendered by `flag_widget`
+        """
+        return dict(re.findall(r'name="(\w+)" value="([^"]*)"', html))
+
+    def test_flag_widget(self):
+        """
+        Test the `flag_widget` templatetag, and that its form is valid
+        """
+        self.assertEqual(flag_tags.flag_widget({}, None), '')
+
+        request = RequestFactory().get('/foo/')
+        context = {'request': request, 'csrf_token': 'token'}
+        html = flag_tags.flag_widget(context, self.model_with_author,
+                                     'author', True)
+        data = self._get_widget_data(html)
+        self.assertEqual(data['csrfmiddlewaretoken'], 'token')
+        self.assertEqual(data['next'], '/foo/')
+        self.assertEqual(data['creator_field'], 'author')
+        self.assertTrue('<select name="status">' in html)
+        data.update(comment='comment', status='1')
+        form = FlagFormWithCreatorAndStatus(target_object=self.model_with_author,
+                                            data=data)
+        self.assertTrue(form.is_valid())
+
+        # same hash as the forms, one generator by request
+        generators = request._flag_security_data_generators
+        generator = generators[None]
+        security_data = generator.generate(self.model_without_author)
+        form = FlagForm(self.model_without_author)
+        self.assertEqual(security_data['security_hash'],
+                         form.initial_security_hash(generator.timestamp))
+        flag_tags.flag_widget(context, self.model_without_author)
+        self.assertEqual(request._flag_security_data_generators,
+                         {None: generator})
+
+    def test_flag_widget_cache(self):
+        """
+        Test that the forms of the `flag_widget` templatetag are kept in the
+        cache, without the values of the request
+        """
+        flag_settings.WIDGET_CACHE_TIMEOUT = 600
+        caches[flag_settings.WIDGET_CACHE].clear()
+        html = flag_tags.flag_widget({'csrf_token': 'token1'},
+                                     self.model_without_author)
+        data = self._get_widget_data(html)
+        self.assertEqual(int(data['timestamp']) % 600, 0)
+        html = flag_tags.flag_widget({'csrf_token': 'token2'},
+                                     self.model_without_author)
+        self.assertEqual(self._get_widget_data(html),
+                         dict(data, csrfmiddlewaretoken='token2'))
+
+        # one generator by request for the objects not in the cache
+        request = RequestFactory().get('/foo/')
+        context = {'request': request}
+        flag_tags.flag_widget(context, self.model_without_author)
+        flag_tags.flag_widget(context, self.model_with_author)
+        self.assertEqual(request._flag_security_data_generators.keys(),
+                         [int(data['timestamp'])])
+
+        # the forms are not kept so long that they expire
+        flag_settings.WIDGET_CACHE_TIMEOUT = SECURITY_TIMESTAMP_MAX_AGE * 2
+        html = flag_tags.flag_widget({}, self.model_without_author)
+        timestamp = int(self._get_widget_data(html)['timestamp'])
+        self.assertEqual(timestamp % MAX_CACHE_TIMEOUT, 0)
+        self.assertTrue(time.time() - timestamp < MAX_CACHE_TIMEOUT)
+
 
 class FlagFormTestCase(BaseTestCaseWithData):
     """
@@ -1296,6 +3027,13 @@ def dummy_eval_trust(user):
     return True
 
 
+def dummy_batch_eval_trust(users):
+    dummy_batch_eval_trust.calls.append(sorted(user.pk for user in users))
+    return dict((user.pk, user.is_staff) for user in users)
+
+dummy_batch_eval_trust.calls = []
+
+
 class TrustedTestCase(BaseTestCaseWithData):
 
     def _create_flag(self, obj):
@@ -1344,3 +3082,152 @@ class TrustedTestCase(BaseTestCaseWithData):
         self._test_flag_instance(self.model_with_author, True)
         flag_settings.TRUST_EVAL_FUNC = old_trust_eval_func
         reload(flag.models)  # force reimport
+
+    def test_batch_eval_func(self):
+        """
+        Test that the users are evaluated at once by the batch function, and
+        kept in the cache
+        """
+        flag_settings.TRUST_EVAL_BATCH_FUNC = \
+            'flag.tests.tests.dummy_batch_eval_trust'
+        flag_settings.TRUST_CACHE_TIMEOUT = 60
+        caches[flag_settings.TRUST_CACHE].clear()
+        dummy_batch_eval_trust.calls = []
+
+        self.assertEqual(are_users_trusted([self.user, self.staff_user]),
+                         {self.user.pk: False, self.staff_user.pk: True})
+        self.assertEqual(are_users_trusted([self.user, self.author]),
+                         {self.user.pk: False, self.author.pk: False})
+        self.assertEqual(dummy_batch_eval_trust.calls,
+                         [sorted([self.user.pk, self.staff_user.pk]),
+                          [self.author.pk]])
+
+        flag_settings.NEEDS_TRUST = True
+        results = FlagInstance.objects.bulk_add(
+            [(self.staff_user, self.model_without_author, 'comment'),
+             (self.user, self.model_without_author, 'comment')])
+        self.assertTrue(isinstance(results[0], FlagInstance))
+        self.assertTrue(isinstance(results[1], FlagUserNotTrustedException))
+        self.assertEqual(len(dummy_batch_eval_trust.calls), 2)
+
+
+class BenchmarkTestCase(BaseTestCase):
+    """
+    Class to test the `flag_benchmark` management command
+    """
+
+    def test_benchmark(self):
+        """
+        Test running some benchmarks, with the JSON output, and that the
+        database is left untouched
+        """
+        names = ['add', 'add_limits', 'add_mails', 'list_page',
+                 'list_page_prefetch']
+        output = os.path.join(mkdtemp(), 'benchmark.json')
+        call_command('flag_benchmark', *names, iterations=4, objects=2,
+                     users=3, label='test', output=output, verbosity=0)
+        with open(output) as report_file:
+            report = json.load(report_file)
+        self.assertEqual(report['label'], 'test')
+        self.assertEqual(sorted(report['results']), sorted(names))
+        for result in report['results'].values():
+            self.assertEqual(result['iterations'], 4)
+            self.assertTrue(result['p50_ms'] <= result['p99_ms'])
+            self.assertTrue(result['queries_per_op'] > 0)
+        # the flags of the users are read only once with `prefetch_flags`
+        self.assertTrue(report['results']['list_page_prefetch']
+                        ['queries_per_op'] <
+                        report['results']['list_page']['queries_per_op'])
+
+        self.assertEqual(FlagInstance.objects.count(), 0)
+        self.assertEqual(User.objects.count(), 0)
+        self.assertEqual(flag_settings.LIMIT_FOR_OBJECT,
+                         flag_settings._DEFAULTS['LIMIT_FOR_OBJECT'])
+
+    def test_failing_benchmark(self):
+        """
+        Test that a benchmark which cannot run in the project is skipped, and
+        the next ones are run, but that other errors are raised
+        """
+        def not_installed(data):
+            reverse('flag-benchmark-missing-url')
+
+        def broken(data):
+            User.objects.create(username=data.user.username)
+
+        benchmarks.BENCHMARKS.insert(0, ('not_installed', {}, not_installed))
+        benchmarks.BENCHMARKS.insert(1, ('broken', {}, broken))
+        try:
+            report = benchmarks.run_benchmarks(
+                iterations=2, nb_objects=2, nb_users=2,
+                names=['not_installed', 'add'])
+            self.assertRaises(IntegrityError, benchmarks.run_benchmarks,
+                              iterations=2, nb_objects=2, nb_users=2,
+                              names=['broken'])
+        finally:
+            del benchmarks.BENCHMARKS[:2]
+        self.assertTrue(report['results']['not_installed'][
+            'skipped'].startswith('NoReverseMatch'))
+        self.assertEqual(report['results']['add']['iterations'], 2)
+
+
+class GenerateDataTestCase(BaseTestCase):
+    """
+    Class to test the `flag_generate_data` management command
+    """
+
+    def generate(self, **options):
+        call_command('flag_generate_data', contents=20, flags=200, users=10,
+                     models='tests.modelwithauthor:1,tests.modelwithoutauthor',
+                     chunk_size=50, verbosity=0, **options)
+
+    def test_generate_data(self):
+        """
+        Test that the generated rows are consistent, skewed, and the same
+        for the same seed
+        """
+        self.generate()
+        self.assertEqual(User.objects.count(), 10)
+        self.assertEqual(FlaggedContent.objects.count(), 20)
+        nb_flags = FlagInstance.objects.count()
+        self.assertTrue(180 <= nb_flags <= 220)
+        self.assertEqual(FlagUserCount.objects.aggregate(
+            total=Sum('count'))['total'], nb_flags)
+
+        # the counts are the numbers of flags with the default status
+        for flagged_content in FlaggedContent.objects.all():
+            flags = flagged_content.flag_instances.all()
+            self.assertEqual(flagged_content.count, flags.filter(
+                status=flag_settings.DEFAULT_STATUS).count())
+            self.assertEqual(set(flags.values_list('status', flat=True)),
+                             set([flagged_content.status]))
+            self.assertEqual(flagged_content.when_updated,
+                             max(flags.values_list('when_added', flat=True)))
+        counts = sorted(flagged_content.flag_instances.count() for
+                        flagged_content in FlaggedContent.objects.all())
+        self.assertTrue(counts[-1] > 5 * counts[len(counts) // 2])
+
+        # new objects, and the same flags for the same seed
+        self.generate()
+        self.assertEqual(User.objects.count(), 10)
+        self.assertEqual(FlaggedContent.objects.count(), 40)
+        self.assertEqual(FlaggedContent.objects.filter(
+            content_type=ContentType.objects.get_for_model(ModelWithAuthor),
+            object_id=1).count(), 1)
+        flagged_contents = list(FlaggedContent.objects.order_by('id'))
+        self.assertEqual([(flagged_content.content_type_id,
+                           flagged_content.status, flagged_content.count)
+                          for flagged_content in flagged_contents[:20]],
+                         [(flagged_content.content_type_id,
+                           flagged_content.status, flagged_content.count)
+                          for flagged_content in flagged_contents[20:]])
+
+    def test_invalid_models(self):
+        """
+        Test that unknown models are refused before any row is created
+        """
+        for models in ('tests.unknown', 'unknown', 'tests.modelwithauthor:x'):
+            self.assertRaises(CommandError, call_command,
+                              'flag_generate_data', models=models,
+                              verbosity=0)
+        self.assertEqual(User.objects.count(), 0)
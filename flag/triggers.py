@@ -0,0 +1,235 @@
+"""
+Database triggers maintaining the `count` field of the FlaggedContent objects,
+used with the 'trigger' COUNTER_ENGINE settings
+With them, `count` is the number of flags with the DEFAULT_STATUS status, kept
+right when flags are added, deleted (even with `QuerySet.delete` or raw SQL)
+or get a new status, without any query from the python code.
+The triggers are installed by the `0007_count_triggers` migration if the
+COUNTER_ENGINE settings is 'trigger' when it is applied (with the
+DEFAULT_STATUS value at this time), else by `install_triggers` (or the
+`flag_count_triggers` management command). The `check_triggers` system check
+fails if they are missing while the COUNTER_ENGINE settings is 'trigger'.
+The names of the tables and columns are taken from the models.
+Supported databases: SQLite and PostgreSQL
+"""
+from django.core import checks
+from django.db import DatabaseError, connections, router, transaction
+
+from flag import settings as flag_settings
+
+# names of the triggers and of the PostgreSQL function
+TRIGGER_PREFIX = 'flag_count'
+
+_SQLITE_INSTALL = [
+    """CREATE TRIGGER %(prefix)s_insert AFTER INSERT ON %(flags)s
+    WHEN NEW.%(status_column)s = %(status)d
+    BEGIN
+        UPDATE %(contents)s SET %(count)s = %(count)s + 1
+        WHERE %(id)s = NEW.%(content_column)s;
+    END""",
+    """CREATE TRIGGER %(prefix)s_delete AFTER DELETE ON %(flags)s
+    WHEN OLD.%(status_column)s = %(status)d
+    BEGIN
+        UPDATE %(contents)s SET %(count)s = %(count)s - 1
+        WHERE %(id)s = OLD.%(content_column)s;
+    END""",
+    """CREATE TRIGGER %(prefix)s_update
+    AFTER UPDATE OF %(status_column)s, %(content_column)s ON %(flags)s
+    WHEN (OLD.%(status_column)s = %(status)d
+          OR NEW.%(status_column)s = %(status)d)
+        AND (OLD.%(status_column)s <> NEW.%(status_column)s
+             OR OLD.%(content_column)s <> NEW.%(content_column)s)
+    BEGIN
+        UPDATE %(contents)s SET %(count)s = %(count)s - 1
+        WHERE %(id)s = OLD.%(content_column)s
+            AND OLD.%(status_column)s = %(status)d;
+        UPDATE %(contents)s SET %(count)s = %(count)s + 1
+        WHERE %(id)s = NEW.%(content_column)s
+            AND NEW.%(status_column)s = %(status)d;
+    END""",
+]
+
+_SQLITE_REMOVE = [
+    "DROP TRIGGER IF EXISTS %(prefix)s_insert",
+    "DROP TRIGGER IF EXISTS %(prefix)s_delete",
+    "DROP TRIGGER IF EXISTS %(prefix)s_update",
+]
+
+_POSTGRESQL_INSTALL = [
+    """CREATE OR REPLACE FUNCTION %(prefix)s() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('DELETE', 'UPDATE')
+                AND OLD.%(status_column)s = %(status)d THEN
+            UPDATE %(contents)s SET %(count)s = %(count)s - 1
+            WHERE %(id)s = OLD.%(content_column)s;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE')
+                AND NEW.%(status_column)s = %(status)d THEN
+            UPDATE %(contents)s SET %(count)s = %(count)s + 1
+            WHERE %(id)s = NEW.%(content_column)s;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql""",
+    """CREATE TRIGGER %(prefix)s
+    AFTER INSERT OR DELETE OR UPDATE OF %(status_column)s, %(content_column)s
+    ON %(flags)s FOR EACH ROW EXECUTE PROCEDURE %(prefix)s()""",
+]
+
+_POSTGRESQL_REMOVE = [
+    "DROP TRIGGER IF EXISTS %(prefix)s ON %(flags)s",
+    "DROP FUNCTION IF EXISTS %(prefix)s()",
+]
+
+# the count of each flagged content, computed from its flags
+_SYNC_COUNTS = """UPDATE %(contents)s SET %(count)s = (
+    SELECT COUNT(*) FROM %(flags)s
+    WHERE %(flags)s.%(content_column)s = %(contents)s.%(id)s
+    AND %(flags)s.%(status_column)s = %(status)d)"""
+
+
+def is_enabled():
+    """
+    Return True if the counts are maintained by the triggers
+    """
+    return flag_settings.COUNTER_ENGINE == 'trigger'
+
+
+def triggers_supported(connection):
+    """
+    Return True if the triggers can be installed on the given database
+    connection
+    """
+    return connection.vendor in ('sqlite', 'postgresql')
+
+
+def triggers_installed(connection):
+    """
+    Return True if the triggers are installed on the given database
+    connection
+    """
+    cursor = connection.cursor()
+    try:
+        if connection.vendor == 'sqlite':
+            names = ['%s_%s' % (TRIGGER_PREFIX, operation)
+                     for operation in ('insert', 'delete', 'update')]
+            cursor.execute("SELECT COUNT(*) FROM sqlite_master "
+                           "WHERE type = 'trigger' AND name IN (%s, %s, %s)",
+                           names)
+        else:
+            names = [TRIGGER_PREFIX]
+            cursor.execute("SELECT COUNT(*) FROM pg_trigger "
+                           "WHERE tgname = %s", names)
+        return cursor.fetchone()[0] == len(names)
+    finally:
+        cursor.close()
+
+
+def check_triggers(app_configs=None, **kwargs):
+    """
+    System check failing if the COUNTER_ENGINE settings is 'trigger' but the
+    triggers are not installed (the settings was set after the
+    `0007_count_triggers` migration was applied), as the counts would then
+    silently stop changing. Nothing is checked while this migration is not
+    applied, or if the database cannot be read
+    """
+    if not is_enabled():
+        return []
+    from django.db.migrations.recorder import MigrationRecorder
+    from flag.models import FlaggedContent
+    connection = connections[router.db_for_write(FlaggedContent)]
+    if not triggers_supported(connection):
+        return [checks.Error(
+            'The flag count triggers are not supported by the %s database '
+            'backend' % connection.vendor,
+            hint="Set FLAG_COUNTER_ENGINE to 'db' or 'cache'.",
+            id='flag.E001')]
+    recorder = MigrationRecorder(connection)
+    try:
+        if recorder.Migration._meta.db_table not in \
+                connection.introspection.table_names():
+            return []
+        if not recorder.migration_qs.filter(
+                app='flag', name='0007_count_triggers').exists():
+            return []
+        installed = triggers_installed(connection)
+    except DatabaseError:
+        return []
+    if installed:
+        return []
+    return [checks.Error(
+        "FLAG_COUNTER_ENGINE is 'trigger' but the flag count triggers are not "
+        "installed on the '%s' database" % connection.alias,
+        hint='Run the flag_count_triggers management command.',
+        id='flag.E002')]
+
+
+def _get_statements(connection, statements, flagged_content_model=None,
+                    flag_instance_model=None):
+    """
+    Return the given statements with the names of the tables and of their
+    columns, and the DEFAULT_STATUS value
+    """
+    if flagged_content_model is None:
+        from flag.models import FlaggedContent as flagged_content_model
+    if flag_instance_model is None:
+        from flag.models import FlagInstance as flag_instance_model
+    quote_name = connection.ops.quote_name
+    flags_opts = flag_instance_model._meta
+    contents_opts = flagged_content_model._meta
+    params = dict(prefix=TRIGGER_PREFIX,
+                  flags=quote_name(flags_opts.db_table),
+                  contents=quote_name(contents_opts.db_table),
+                  id=quote_name(contents_opts.pk.column),
+                  count=quote_name(contents_opts.get_field('count').column),
+                  content_column=quote_name(
+                      flags_opts.get_field('flagged_content').column),
+                  status_column=quote_name(
+                      flags_opts.get_field('status').column),
+                  status=int(flag_settings.DEFAULT_STATUS))
+    return [statement % params for statement in statements]
+
+
+def _run(connection, statements, **models):
+    cursor = connection.cursor()
+    try:
+        for statement in _get_statements(connection, statements, **models):
+            cursor.execute(statement)
+    finally:
+        cursor.close()
+
+
+def install_triggers(connection=None, **models):
+    """
+    Install the triggers on the given database connection (the one used to
+    write FlaggedContent objects by default), and compute again the `count`
+    field of all the FlaggedContent objects.
+    The models can be given (with the `flagged_content_model` and
+    `flag_instance_model` arguments) to be used in migrations
+    """
+    if connection is None:
+        from flag.models import FlaggedContent
+        connection = connections[router.db_for_write(FlaggedContent)]
+    if connection.vendor == 'sqlite':
+        statements = _SQLITE_REMOVE + _SQLITE_INSTALL
+    elif connection.vendor == 'postgresql':
+        statements = _POSTGRESQL_REMOVE + _POSTGRESQL_INSTALL
+    else:
+        raise NotImplementedError('Triggers are not supported by the %s '
+                                  'database backend' % connection.vendor)
+    with transaction.atomic(using=connection.alias):
+        _run(connection, statements + [_SYNC_COUNTS], **models)
+
+
+def remove_triggers(connection=None, **models):
+    """
+    Remove the triggers from the given database connection (the one used to
+    write FlaggedContent objects by default), if they are installed
+    """
+    if connection is None:
+        from flag.models import FlaggedContent
+        connection = connections[router.db_for_write(FlaggedContent)]
+    if connection.vendor == 'sqlite':
+        _run(connection, _SQLITE_REMOVE, **models)
+    elif connection.vendor == 'postgresql':
+        _run(connection, _POSTGRESQL_REMOVE, **models)
@@ -15,5 +15,9 @@ urlpatterns = [
     url(
         r'(?P<app_label>\w+)/(?P<object_name>\w+)/(?P<object_id>\d+)/$',
         views.confirm, name="flag_confirm"),
+    url(r"^moderation/$", views.moderation_queue,
+        name="flag_moderation_queue"),
+    url(r"^api/$", views.flag_api, name="flag_api"),
+    url(r"^states/$", views.flag_states, name="flag_states"),
     url(r"^$", views.flag, name="flag_content"),
 ]
@@ -1,4 +1,6 @@
+from collections import namedtuple, OrderedDict
 from datetime import date
+from threading import Lock
 
 from django.contrib.contenttypes.models import ContentType
 from django.conf import settings
@@ -43,6 +45,131 @@ def get_content_type_tuple(content_type):
     return app_label, model
 
 
+# max number of entries kept by `get_content_type_id`
+CONTENT_TYPE_CACHE_SIZE = 1000
+
+ContentTypeCacheInfo = namedtuple('ContentTypeCacheInfo',
+                                  ['hits', 'misses', 'maxsize', 'currsize'])
+
+_content_type_cache = OrderedDict()
+_content_type_cache_stats = {'hits': 0, 'misses': 0}
+_content_type_cache_lock = Lock()
+
+
+def _content_type_cache_key(content_type):
+    """
+    Return the key to use in the cache for "something" (see
+    `get_content_type_tuple`), or the content type id if it is known without
+    any lookup
+    """
+    if isinstance(content_type, (int, long)):
+        return None, content_type
+    if isinstance(content_type, ContentType):
+        return None, content_type.id
+    if isinstance(content_type, basestring):
+        if content_type.isdigit():
+            return None, int(content_type)
+        return content_type, None
+    if not isinstance(content_type, type):
+        # an instance of a model
+        content_type = content_type.__class__
+    return content_type, None
+
+
+def _resolve_content_type_id(key):
+    """
+    Find the content type id for a model or an `app_label.model_name` string
+    """
+    if isinstance(key, basestring):
+        app_label, model = key.split('.', 1)
+        return ContentType.objects.get_by_natural_key(app_label, model).id
+    # `_meta` is checked to not create a content type for a non-model
+    key._meta
+    return ContentType.objects.get_for_model(key,
+                                             for_concrete_model=False).id
+
+
+def get_content_type_id(content_type):
+    """
+    Return the content type id for "something" (see `get_content_type_tuple`)
+    Models and `app_label.model_name` strings are resolved once and kept in a
+    LRU cache of CONTENT_TYPE_CACHE_SIZE entries, see
+    `content_type_cache_info`
+    Raise an exception if the content type cannot be found
+    """
+    key, content_type_id = _content_type_cache_key(content_type)
+    if key is None:
+        return content_type_id
+
+    with _content_type_cache_lock:
+        try:
+            content_type_id = _content_type_cache.pop(key)
+        except KeyError:
+            pass
+        else:
+            _content_type_cache[key] = content_type_id
+            _content_type_cache_stats['hits'] += 1
+            return content_type_id
+
+    # not in cache: resolve it outside of the lock
+    content_type_id = _resolve_content_type_id(key)
+    with _content_type_cache_lock:
+        _content_type_cache_stats['misses'] += 1
+        _content_type_cache[key] = content_type_id
+        while len(_content_type_cache) > CONTENT_TYPE_CACHE_SIZE:
+            _content_type_cache.popitem(last=False)
+    return content_type_id
+
+
+def content_type_cache_info():
+    """
+    Return the hits, misses, max size and current size of the cache used by
+    `get_content_type_id`
+    """
+    with _content_type_cache_lock:
+        return ContentTypeCacheInfo(_content_type_cache_stats['hits'],
+                                    _content_type_cache_stats['misses'],
+                                    CONTENT_TYPE_CACHE_SIZE,
+                                    len(_content_type_cache))
+
+
+# sets of content type ids, by id of the list of models they come from
+_content_type_ids_sets = {}
+
+
+def get_content_type_ids(models):
+    """
+    Return a frozenset with the content type ids of the given list of
+    `app_label.model_name` strings (like the MODELS settings), computed only
+    once for a list. Models without content type are ignored.
+    """
+    entry = _content_type_ids_sets.get(id(models))
+    if entry is None or entry[0] is not models:
+        content_type_ids = set()
+        for model in models:
+            try:
+                content_type_ids.add(get_content_type_id(model))
+            except Exception:
+                pass
+        if len(_content_type_ids_sets) > 100:
+            _content_type_ids_sets.clear()
+        entry = _content_type_ids_sets[id(models)] = \
+            (models, frozenset(content_type_ids))
+    return entry[1]
+
+
+def clear_content_type_cache():
+    """
+    Empty the caches used by `get_content_type_id` and
+    `get_content_type_ids` and reset the counters.
+    Needed if content types are deleted or created
+    """
+    with _content_type_cache_lock:
+        _content_type_cache.clear()
+        _content_type_cache_stats.update(hits=0, misses=0)
+    _content_type_ids_sets.clear()
+
+
 def can_user_be_trusted(user):
     """
     This method is used to test if the given user meets the requirements to add a flag.
@@ -50,3 +177,13 @@ def can_user_be_trusted(user):
     settings.FLAG_TRUST_TIME should be a number of days
     """
     return ((date.today() - user.date_joined.date()).days > settings.FLAG_TRUST_TIME)
+
+
+def can_users_be_trusted(users):
+    """
+    Same as `can_user_be_trusted` for many users at once: return a dict with
+    True or False for the pk of each given user.
+    A function with this signature can be set in FLAG_TRUST_EVAL_BATCH_FUNC,
+    to evaluate many users in one query
+    """
+    return dict((user.pk, can_user_be_trusted(user)) for user in users)
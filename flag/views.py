@@ -1,10 +1,12 @@
+import json
 import urlparse
 
-from django.http import Http404, HttpResponseBadRequest, HttpResponse
+from django.http import (Http404, HttpResponseBadRequest, HttpResponse,
+                         JsonResponse)
 from django.shortcuts import redirect, render
 from django.template.loader import render_to_string
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
-from django.core.urlresolvers import reverse
+from django.core.urlresolvers import reverse, NoReverseMatch
 from django.contrib.auth.decorators import login_required
 from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext as _
@@ -12,14 +14,28 @@ from django.contrib import messages
 from django.utils.html import escape
 from django.apps import apps
 from django.conf import settings
+from django.db import transaction
+from django.views.decorators.http import require_GET, require_POST
+from django.utils.cache import patch_cache_control, patch_vary_headers
 
 from flag import settings as flag_settings
 from flag.forms import (FlagForm, FlagFormWithCreator, get_default_form,
-                        FlagFormWithStatus, FlagFormWithCreatorAndStatus)
+                        FlagFormWithStatus, FlagFormWithCreatorAndStatus,
+                        check_security_data, SecurityDataGenerator)
 
 from flag.models import FlaggedContent, FlagInstance
+from flag.ratelimit import is_rate_limited
 from flag.exceptions import FlagException, FlagUserNotTrustedException, \
-    OnlyStaffCanUpdateStatus
+    OnlyStaffCanUpdateStatus, ModelCannotBeFlaggedException, \
+    ContentAlreadyFlaggedByUserException, ContentFlaggedEnoughException, \
+    FlagRateLimitException
+
+# max number of flags in a request to the `flag_api` view
+API_MAX_FLAGS = 100
+# max number of objects in a request to the `flag_states` view, and number of
+# seconds during which its responses to anonymous users can be cached
+STATES_MAX_OBJECTS = 100
+STATES_MAX_AGE = 60
 
 
 def _validate_next_parameter(request, next):
@@ -54,6 +70,7 @@ def can_be_flagged_by(content_object, user):
     We check that the user is authenticated, but also that the
     LIMIT_SAME_OBJECT_FOR_USER is not raised
     Usage: {% if some_object|can_by_flagged_by:request.user %}...{% endif %}
+    Use the `prefetch_flags` templatetag to avoid queries on lists.
     """
     try:
         if not (user and user.is_active and user.is_authenticated()):
@@ -61,8 +78,8 @@ def can_be_flagged_by(content_object, user):
         if not FlaggedContent.objects.model_can_be_flagged(content_object):
             return False
         try:
-            flagged_content = FlaggedContent.objects.get_for_object(
-                    content_object)
+            flagged_content = FlaggedContent.objects. \
+                get_prefetched_for_object(content_object)
             return flagged_content.can_be_flagged_by_user(user)
         except ObjectDoesNotExist:
             # no FlaggedContent, we know it canbe flagged
@@ -85,6 +102,17 @@ class FlagBadRequest(HttpResponseBadRequest):
                                             {"why": why})
 
 
+def reverse_flag_url(name, kwargs=None):
+    """
+    Return the url of the given view of `flag.urls`, included with its `flag`
+    namespace or without namespace
+    """
+    try:
+        return reverse('flag:%s' % name, kwargs=kwargs)
+    except NoReverseMatch:
+        return reverse(name, kwargs=kwargs)
+
+
 def get_confirm_url_for_object(content_object,
                                creator_field=None,
                                with_status=False):
@@ -93,7 +121,7 @@ def get_confirm_url_for_object(content_object,
     `creator_field` and `with_status` will be passed in the query string
     TODO : raise if the object cannot be flagged ?
     """
-    url = reverse('flag_confirm', kwargs=dict(
+    url = reverse_flag_url('flag_confirm', kwargs=dict(
             app_label=content_object._meta.app_label,
             object_name=content_object._meta.model_name,
             object_id=content_object.pk))
@@ -169,6 +197,22 @@ def flag(request):
         # only staff can update status
         with_status = 'status' in post_data
 
+        # reject the flags of a user above the RATE_LIMIT before any query
+        if not with_status and post_data.get('content_type'):
+            try:
+                rate_limited = is_rate_limited(request.user,
+                                               post_data['content_type'])
+            except (ValueError, ObjectDoesNotExist):
+                # invalid content type, checked below
+                rate_limited = False
+            if rate_limited:
+                if request.is_ajax():
+                    return HttpResponse(status=429)
+                messages.error(
+                    request,
+                    _('You added too many flags, please try again later'))
+                return redirect(get_next(request))
+
         # the object to flag
         object_pk = post_data.get('object_pk')
         content_object = get_content_object(post_data.get("content_type"),
@@ -209,7 +253,8 @@ def flag(request):
                     creator = reduce(getattr, creator_field.split('.'),
                                      content_object)
             # manage comment
-            if flag_settings.get_for_model(content_object, 'ALLOW_COMMENTS'):
+            if flag_settings.get_for_content_type(
+                    content_type.id).ALLOW_COMMENTS:
                 comment = form.cleaned_data['comment']
             else:
                 comment = None
@@ -319,3 +364,270 @@ def confirm(request, app_label, object_name, object_id, form=None):
                  'flag/confirm.html']
 
     return render(request, templates, context)
+
+
+@login_required
+def moderation_queue(request):
+    """
+    Return, in JSON, a page of the moderation queue (see
+    `FlaggedContentManager.moderation_queue`), for moderators only.
+    Accepted GET parameters: `status`, `model` ("app_label.model_name"),
+    `after` (the `next` cursor of the previous page) and `limit` (max 100)
+    """
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Only staff can moderate flags'},
+                            status=403)
+
+    try:
+        status = request.GET.get('status') or None
+        if status is not None:
+            status = int(status)
+        limit = min(int(request.GET.get('limit') or 50), 100)
+        flagged_contents, next_cursor = FlaggedContent.objects. \
+            moderation_queue(status=status,
+                             model=request.GET.get('model') or None,
+                             after=request.GET.get('after') or None,
+                             limit=max(limit, 1))
+    except (ValueError, ObjectDoesNotExist):
+        return JsonResponse({'error': 'Invalid parameters'}, status=400)
+
+    results = []
+    for flagged_content in flagged_contents:
+        content_type = flagged_content.content_type
+        creator = flagged_content.creator
+        results.append(dict(
+            id=flagged_content.id,
+            content_type='%s.%s' % (content_type.app_label,
+                                    content_type.model),
+            object_id=flagged_content.object_id,
+            status=flagged_content.status,
+            status_display=flagged_content.get_status_display(),
+            count=flagged_content.current_count,
+            creator=unicode(creator) if creator is not None else None,
+            moderator_id=flagged_content.moderator_id,
+            when_updated=flagged_content.when_updated,
+        ))
+    return JsonResponse({'results': results, 'next': next_cursor})
+
+
+class FlagApiError(Exception):
+    """
+    Raised when a flag sent to the `flag_api` view cannot be added, with the
+    status code to return
+    """
+
+    def __init__(self, status, message):
+        super(FlagApiError, self).__init__(message)
+        self.status = status
+
+
+# status codes returned by `flag_api` for the exceptions raised by `add`
+_API_EXCEPTIONS_STATUSES = (
+    (FlagRateLimitException, 429),
+    (ContentAlreadyFlaggedByUserException, 409),
+    (ContentFlaggedEnoughException, 409),
+    (OnlyStaffCanUpdateStatus, 403),
+)
+
+
+def _add_api_flag(user, data):
+    """
+    Validate the data of one flag sent to `flag_api`, without a form, and add
+    it. Return the new FlagInstance, or raise a FlagApiError
+    """
+    if not isinstance(data, dict):
+        raise FlagApiError(400, 'Invalid flag')
+    ctype, object_pk = data.get('content_type'), data.get('object_pk')
+    if not ctype or object_pk is None:
+        raise FlagApiError(400, 'Missing content_type or object_pk field')
+    if not check_security_data(ctype, object_pk, data.get('timestamp'),
+                               data.get('security_hash')):
+        raise FlagApiError(400, 'Security verification failed')
+
+    status = data.get('status')
+    if status is not None:
+        if not user.is_staff:
+            raise FlagApiError(403, "Only staff can update a flag's status")
+        try:
+            status = int(status)
+        except (TypeError, ValueError):
+            raise FlagApiError(400, 'Invalid status')
+
+    try:
+        model = apps.get_model(*unicode(ctype).split('.', 1))
+        FlaggedContent.objects.assert_model_can_be_flagged(model)
+        content_object = model._default_manager.get(pk=object_pk)
+    except (LookupError, TypeError, ValueError, ValidationError,
+            ModelCannotBeFlaggedException):
+        raise FlagApiError(400, 'Invalid content_type or object_pk field')
+    except ObjectDoesNotExist:
+        raise FlagApiError(404, 'Object not found')
+
+    model_settings = flag_settings.get_for_content_type(
+        ContentType.objects.get_for_model(model).id)
+    if status is not None and status not in dict(model_settings.STATUSES):
+        raise FlagApiError(400, 'Invalid status')
+    comment = data.get('comment') or None
+    if comment is not None and not isinstance(comment, basestring):
+        raise FlagApiError(400, 'Invalid comment')
+    # same checks as `FlagForm.clean`
+    if model_settings.ALLOW_COMMENTS and not comment:
+        raise FlagApiError(400, _('You must add a comment'))
+    if not model_settings.ALLOW_COMMENTS and comment:
+        raise FlagApiError(400, _('You are not allowed to add a comment'))
+
+    creator = None
+    if data.get('creator_field'):
+        if not isinstance(data['creator_field'], basestring):
+            raise FlagApiError(400, 'Invalid creator_field')
+        try:
+            creator = reduce(getattr, data['creator_field'].split('.'),
+                             content_object)
+        except (AttributeError, ObjectDoesNotExist):
+            raise FlagApiError(400, 'Invalid creator_field')
+
+    try:
+        flag_instance = FlagInstance.objects.add(
+            user, content_object, creator, comment, status or None,
+            send_signal=True, send_mails=True)
+    except FlagException, e:
+        for exception_class, status_code in _API_EXCEPTIONS_STATUSES:
+            if isinstance(e, exception_class):
+                raise FlagApiError(status_code, unicode(e))
+        raise FlagApiError(400, unicode(e))
+    if flag_instance.pk is None:
+        # not saved because the user is not trusted (see NEEDS_TRUST)
+        raise FlagApiError(403, _('You are not trusted to flag this'))
+    return flag_instance
+
+
+@require_POST
+def flag_api(request):
+    """
+    Add flags sent in JSON, without forms nor messages (so without writing
+    the session), and return the result in JSON.
+    The body is a flag, or `{"flags": [...]}` with at most API_MAX_FLAGS
+    flags, added in one transaction. A flag has the same fields as the flag
+    form: `content_type`, `object_pk`, `timestamp`, `security_hash`, and
+    optionally `comment`, `creator_field` and `status` (for the staff).
+    Each result has the `status` code (201 if added, the `id` of the
+    flag is then given) or an `error`. For a single flag, the response has the
+    same status code, for a batch it is 200
+    """
+    if not request.user.is_authenticated():
+        return JsonResponse({'error': 'Authentication required'}, status=401)
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+
+    batch = isinstance(data, dict) and 'flags' in data
+    flags = data['flags'] if batch else [data]
+    if not isinstance(flags, list) or not flags:
+        return JsonResponse({'error': 'No flags'}, status=400)
+    if len(flags) > API_MAX_FLAGS:
+        return JsonResponse({'error': 'Too many flags (max %d)' %
+                                      API_MAX_FLAGS}, status=400)
+
+    results = []
+    with transaction.atomic():
+        for flag_data in flags:
+            try:
+                # a savepoint, to not keep the writes of a refused flag
+                with transaction.atomic():
+                    flag_instance = _add_api_flag(request.user, flag_data)
+            except FlagApiError, e:
+                results.append({'status': e.status, 'error': unicode(e)})
+            else:
+                results.append({'status': 201, 'id': flag_instance.id})
+
+    if batch:
+        return JsonResponse({'results': results})
+    return JsonResponse(results[0], status=results[0]['status'])
+
+
+def _get_states_objects(keys):
+    """
+    Load the objects for the given `"app_label.model_name:pk"` keys asked to
+    `flag_states`, with one query by model.
+    Return a dict with the objects, or the error, by key
+    """
+    result = {}
+    by_model = {}
+    for key in keys:
+        ctype, _sep, object_pk = key.rpartition(':')
+        try:
+            model = apps.get_model(*ctype.split('.', 1))
+            FlaggedContent.objects.assert_model_can_be_flagged(model)
+            pk = model._meta.pk.to_python(object_pk)
+        except (LookupError, TypeError, ValueError, ValidationError,
+                ModelCannotBeFlaggedException):
+            result[key] = 'Invalid object'
+        else:
+            # different keys can give the same pk ("01", "auth.User"...)
+            by_model.setdefault(model, {}).setdefault(pk, []).append(key)
+    for model, keys_by_pk in by_model.items():
+        content_objects = model._default_manager.in_bulk(keys_by_pk.keys())
+        for pk, pk_keys in keys_by_pk.items():
+            for key in pk_keys:
+                result[key] = content_objects.get(pk, 'Object not found')
+    return result
+
+
+@require_GET
+def flag_states(request):
+    """
+    Return, in JSON, the flag state of many objects, to render the flag
+    buttons on the client side (for pages kept in a cache).
+    The objects are given by the `objects` GET parameter (repeated or comma
+    separated), with `"app_label.model_name:pk"` values, at most
+    STATES_MAX_OBJECTS. For each one, in the same order, the result has the
+    `count` and `status` of the object, `can_flag` (True if the user can flag
+    it) and the security data of the flag form (`content_type`, `object_pk`,
+    `timestamp` and `security_hash`), or an `error`.
+    Whatever the number of objects, the states are read with one query by
+    model and two for the flags (see `FlaggedContent.objects.get_for_objects`).
+    The responses to anonymous users can be cached for STATES_MAX_AGE seconds
+    """
+    keys = []
+    for value in request.GET.getlist('objects'):
+        keys.extend(key.strip() for key in value.split(',') if key.strip())
+    if not keys:
+        return JsonResponse({'error': 'No objects'}, status=400)
+    if len(keys) > STATES_MAX_OBJECTS:
+        return JsonResponse({'error': 'Too many objects (max %d)' %
+                                      STATES_MAX_OBJECTS}, status=400)
+
+    user = request.user
+    content_objects = _get_states_objects(keys)
+    FlaggedContent.objects.get_for_objects(
+        [content_object for content_object in content_objects.values()
+         if not isinstance(content_object, basestring)], user)
+
+    generator = SecurityDataGenerator()
+    results = []
+    for key in keys:
+        content_object = content_objects[key]
+        if isinstance(content_object, basestring):
+            results.append({'object': key, 'error': content_object})
+            continue
+        try:
+            flagged_content = FlaggedContent.objects. \
+                get_prefetched_for_object(content_object)
+        except ObjectDoesNotExist:
+            count, status = 0, flag_settings.DEFAULT_STATUS
+        else:
+            count, status = flagged_content.current_count, \
+                flagged_content.status
+        result = generator.generate(content_object)
+        result.update(object=key, count=count, status=status,
+                      can_flag=can_be_flagged_by(content_object, user))
+        results.append(result)
+
+    response = JsonResponse({'results': results})
+    if user.is_authenticated():
+        patch_cache_control(response, private=True, max_age=0)
+    else:
+        patch_cache_control(response, public=True, max_age=STATES_MAX_AGE)
+    patch_vary_headers(response, ('Cookie',))
+    return response
@@ -0,0 +1,164 @@
+"""
+Rendering of the flag forms of many objects without building a form for each
+one (see the `flag_widget` templatetag).
+The `flag/flag_widget.html` template is rendered only once for a model (with
+the same `creator_field` and `with_status` parameters and the same language),
+with placeholders, which are then replaced by the values of each object.
+The forms are still validated by the `SecurityForm` ones.
+"""
+import time
+
+from django.core.cache import caches
+from django.template.loader import render_to_string
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+from django.utils.translation import get_language
+
+from flag import settings as flag_settings
+from flag.forms import SecurityDataGenerator, SECURITY_TIMESTAMP_MAX_AGE
+from flag.utils import get_content_type_id
+
+# the values replaced for each object, and the ones replaced for each request
+OBJECT_FIELDS = ('content_type', 'object_pk', 'timestamp', 'security_hash')
+REQUEST_FIELDS = ('csrf_token', 'next')
+
+# prefix of the keys of the forms kept in the cache
+CACHE_KEY_PREFIX = 'flag:widget:'
+# max seconds during which the forms are kept in the cache (the value of the
+# WIDGET_CACHE_TIMEOUT settings is lowered to it), to let at least half the
+# validity of their timestamp to the users to send them
+MAX_CACHE_TIMEOUT = SECURITY_TIMESTAMP_MAX_AGE // 2
+
+# the renderers, by model, parameters, language and settings
+_renderers = {}
+
+
+def _placeholder(name):
+    return u'FLAGWIDGET%sPLACEHOLDER' % name.upper().replace('_', '')
+
+
+class WidgetRenderer(object):
+    """
+    The `flag/flag_widget.html` template rendered for a model, to render the
+    form of any of its objects with a string formatting
+    """
+
+    def __init__(self, content_type_id, creator_field=None,
+                 with_status=False):
+        model_settings = flag_settings.get_for_content_type(content_type_id)
+        context = dict((name, _placeholder(name))
+                       for name in OBJECT_FIELDS + REQUEST_FIELDS)
+        context.update(creator_field=creator_field,
+                       allow_comments=model_settings.ALLOW_COMMENTS,
+                       statuses=model_settings.STATUSES if with_status
+                       else None)
+        html = render_to_string('flag/flag_widget.html', context)
+        html = html.replace(u'%', u'%%')
+        for name in OBJECT_FIELDS:
+            html = html.replace(_placeholder(name), u'%%(%s)s' % name)
+        self.template = html
+
+    def render_object(self, security_data):
+        """
+        Return the form for the object with the given security data (see
+        `SecurityDataGenerator`), without the values of the request
+        """
+        return self.template % dict((name, escape(security_data[name]))
+                                    for name in OBJECT_FIELDS)
+
+    def render(self, fragment, csrf_token, next):
+        """
+        Return the form from a result of `render_object`, with the values of
+        the request
+        """
+        fragment = fragment.replace(_placeholder('csrf_token'),
+                                    escape(csrf_token or u''))
+        return mark_safe(fragment.replace(_placeholder('next'),
+                                          escape(next or u'')))
+
+
+def get_renderer(content_type_id, creator_field=None, with_status=False):
+    """
+    Return the renderer for the given parameters, created only once (again
+    if the STATUSES, ALLOW_COMMENTS or MODELS_SETTINGS settings are
+    replaced)
+    """
+    key = (content_type_id, creator_field, bool(with_status), get_language(),
+           id(flag_settings.STATUSES), flag_settings.ALLOW_COMMENTS,
+           id(flag_settings.MODELS_SETTINGS))
+    renderer = _renderers.get(key)
+    if renderer is None:
+        if len(_renderers) > 1000:
+            _renderers.clear()
+        renderer = _renderers[key] = WidgetRenderer(content_type_id,
+                                                    creator_field,
+                                                    with_status)
+    return renderer
+
+
+def clear_renderers():
+    """
+    Forget the renderers, to render the template again
+    """
+    _renderers.clear()
+
+
+def get_generator(generators=None, timestamp=None):
+    """
+    Return a `SecurityDataGenerator` for the given timestamp (the current
+    time if None), from the given dict of generators by timestamp (kept for
+    a request), where it is added if needed
+    """
+    if generators is None:
+        return SecurityDataGenerator(timestamp)
+    generator = generators.get(timestamp)
+    if generator is None:
+        generator = generators[timestamp] = SecurityDataGenerator(timestamp)
+    return generator
+
+
+def render_widgets(content_objects, csrf_token=None, next=None,
+                   creator_field=None, with_status=False, generators=None):
+    """
+    Return the flag forms of the given objects, in a list. The security data
+    are generated by a `SecurityDataGenerator`, taken from the `generators`
+    dict if given (see `get_generator`), so the key of the HMAC is derived
+    once for all the calls with this dict.
+    If the WIDGET_CACHE_TIMEOUT settings is set, the forms are kept in the
+    cache (at most MAX_CACHE_TIMEOUT seconds), and got with one request to
+    the cache
+    """
+    content_objects = list(content_objects)
+    timeout = min(flag_settings.WIDGET_CACHE_TIMEOUT, MAX_CACHE_TIMEOUT)
+    fragments = {}
+    generator = None
+    if timeout:
+        # the forms of a period share the timestamp of its start
+        bucket = int(time.time() // timeout)
+        keys = ['%s%s:%s:%s:%s:%s:%d:%d' % (
+            CACHE_KEY_PREFIX, get_content_type_id(content_object),
+            content_object.pk, creator_field, bool(with_status),
+            get_language(), timeout, bucket)
+            for content_object in content_objects]
+        cache = caches[flag_settings.WIDGET_CACHE]
+        fragments = cache.get_many(keys)
+        if len(fragments) < len(keys):
+            generator = get_generator(generators, bucket * timeout)
+    else:
+        generator = get_generator(generators)
+
+    result = []
+    missing = {}
+    for index, content_object in enumerate(content_objects):
+        renderer = get_renderer(get_content_type_id(content_object),
+                                creator_field, with_status)
+        fragment = fragments.get(keys[index]) if timeout else None
+        if fragment is None:
+            fragment = renderer.render_object(
+                generator.generate(content_object))
+            if timeout:
+                missing[keys[index]] = fragment
+        result.append(renderer.render(fragment, csrf_token, next))
+    if missing:
+        cache.set_many(missing, timeout)
+    return result
@@ -1,11 +1,9 @@
-from django.conf.urls.defaults import patterns, include, url
-from views import UserListView
-
-# Uncomment the next two lines to enable the admin:
+from django.conf.urls import include, url
 from django.contrib import admin
-admin.autodiscover()
 
-urlpatterns = patterns('',
+from testproject.views import UserListView
+
+urlpatterns = [
     # Examples:
     # url(r'^$', 'testproject.views.home', name='home'),
     # url(r'^testproject/', include('testproject.foo.urls')),
@@ -13,12 +11,11 @@ urlpatterns = patterns('',
     # Uncomment the admin/doc line below to enable admin documentation:
     # url(r'^admin/doc/', include('django.contrib.admindocs.urls')),
 
-    # Uncomment the next line to enable the admin:
     url(r'^admin/', include(admin.site.urls)),
 
     # flags
-    url(r'^flag/', include('flag.urls')),
+    url(r'^flag/', include('flag.urls', namespace='flag', app_name='flag')),
 
     # users
-    url(r'^$', UserListView.as_view())
-)
+    url(r'^$', UserListView.as_view()),
+]